@@ -1,27 +1,44 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
-import subprocess
+from metrics import Counter, Histogram, PROFILE_FORMATS, record_profile, render_gauges
 import os
 import psutil
 import sys
 import base64
 import io
 import matplotlib.pyplot as plt
-from contextlib import redirect_stdout
+import numpy as np
+from contextlib import redirect_stdout, redirect_stderr, ExitStack
 import time
-from typing import Optional
+from typing import Optional, Literal, List, Dict
 from pathlib import Path
 import asyncio
 import ast
-from multiprocessing import Process, Queue
-import tempfile
+import functools
+import hashlib
+import marshal
+from multiprocessing import Process, Pipe
+from collections import deque, OrderedDict, defaultdict
+import threading
+import uuid
 import json
+import re
+import tempfile
+import itertools
+import math
+import importlib
+import pickle
+import types
+import email.utils
+import urllib.parse
+import zipfile
 
 app = FastAPI()
-FILES_DIR = Path("/sandbox/files")  # Directory for file uploads/downloads
-MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
+FILES_DIR = Path(os.environ.get("SANDBOX_FILES_DIR", "/sandbox/files"))  # Directory for file uploads/downloads
+MAX_FILE_SIZE = int(os.environ.get("SANDBOX_MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10MB
+MAX_UPLOAD_SIZE = int(os.environ.get("SANDBOX_MAX_UPLOAD_SIZE", str(1024 * 1024 * 1024)))  # 分块上传 1GB
 
 import multiprocessing
 multiprocessing.set_start_method('fork')
@@ -29,52 +46,406 @@ multiprocessing.set_start_method('fork')
 class LimitUploadSizeMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         content_length = request.headers.get("Content-Length")
-        if content_length and int(content_length) > MAX_FILE_SIZE:
-            return JSONResponse(status_code=413, content={"detail": f"File too large. Max size is {MAX_FILE_SIZE}"})
+        # 恢复快照的压缩包按分块上传的总大小限制
+        limit = MAX_UPLOAD_SIZE if request.url.path.endswith("/checkpoint/restore") else MAX_FILE_SIZE
+        if content_length and int(content_length) > limit:
+            return JSONResponse(status_code=413, content={"detail": f"File too large. Max size is {limit}"})
         return await call_next(request)
 
 app.add_middleware(LimitUploadSizeMiddleware)
 
+###############################
+#    Metrics                  #
+###############################
+
+# 阶段：queue（等待执行槽位）、compile、acquire（取得 worker 或 kernel）、exec、figures（保存图像）、
+# transfer（与 worker 之间的管道传输）、publish（图像入索引和 base64 编码）
+execution_stage_seconds = Histogram("sandbox_execution_stage_seconds",
+                                    "Time spent in each stage of a code execution.", ("language", "stage"))
+execution_seconds = Histogram("sandbox_execution_seconds", "End-to-end time of a code execution.", ("language",))
+executions_total = Counter("sandbox_executions_total", "Code executions by outcome.", ("language", "outcome"))
+
+def record_execution(language: str, timings: dict, outcome: str):
+    for stage, seconds in timings.items():
+        execution_stage_seconds.observe(seconds, language, stage)
+    execution_seconds.observe(sum(timings.values()), language)
+    executions_total.inc(language, outcome)
+
 ###############################
 #    Process Management       #
 ###############################
 
+PROCESS_SNAPSHOT_TTL = float(os.environ.get("SANDBOX_PROCESS_SNAPSHOT_TTL", "2"))  # 进程列表的缓存时间（秒）
+PROCESS_KILL_TIMEOUT = 3  # terminate 之后等待多久再 kill（秒）
+PROCESS_LIST_MAX_LIMIT = 1000  # 单页最多返回的进程数
+
+def direct_children(pid: int) -> list:
+    """Child pids of pid read from /proc/<pid>/task/*/children, without scanning every process."""
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    children = []
+    for tid in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children += [int(child) for child in f.read().split()]
+        except FileNotFoundError:
+            # 内核没有 CONFIG_PROC_CHILDREN 时退回到 psutil（需要扫描全部进程）
+            try:
+                return [child.pid for child in psutil.Process(pid).children()]
+            except psutil.Error:
+                return []
+        except OSError:
+            continue
+    return children
+
+def descendants(process: psutil.Process) -> list:
+    """All descendants of process, walked with direct_children instead of psutil's full /proc scan."""
+    found, pending = [], [process.pid]
+    while pending:
+        for child in direct_children(pending.pop()):
+            try:
+                found.append(psutil.Process(child))
+            except psutil.Error:
+                continue
+            pending.append(child)
+    return found
+
+def describe_process(process: psutil.Process, now: float) -> dict:
+    with process.oneshot():
+        started_at = process.create_time()
+        return {
+            "pid": process.pid,
+            "ppid": process.ppid(),
+            "name": process.name(),
+            "cmdline": process.cmdline(),
+            "status": process.status(),
+            "cpu_percent": process.cpu_percent(None),
+            "rss": process.memory_info().rss,
+            "num_threads": process.num_threads(),
+            "started_at": started_at,
+            "runtime": now - started_at,
+        }
+
+class ProcessTracker:
+    """
+    记录每个 session 拥有的进程：执行期间借用的 worker、session 的常驻 kernel，以及执行结束后仍在运行的子进程。
+    列表只遍历这些进程及其子进程，而不是主机上的全部进程，并按 session 缓存 ttl 秒。
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.owned = defaultdict(dict)  # sessionid -> {pid: psutil.Process}
+        self.owners = {}  # pid -> sessionid
+        self.handles = {}  # sessionid -> {pid: psutil.Process}，复用同一个对象 cpu_percent 才有两次采样之间的值
+        self.snapshots = {}  # sessionid -> (time.monotonic(), [进程信息])
+        self.locks = defaultdict(asyncio.Lock)
+        self.lock = threading.Lock()
+        self.stats = {"snapshots": 0, "cache_hits": 0, "killed": 0}
+
+    def attach(self, sessionid: Optional[str], pid: int):
+        """Attribute pid (a borrowed worker or a kernel) to the session."""
+        if not sessionid:
+            return
+        try:
+            process = psutil.Process(pid)
+        except psutil.Error:
+            return
+        with self.lock:
+            self.owned[sessionid][pid] = process
+            self.owners[pid] = sessionid
+        self.snapshots.pop(sessionid, None)
+
+    def detach(self, sessionid: Optional[str], pid: int):
+        """Stop attributing pid to the session; children it leaves running remain the session's."""
+        if not sessionid:
+            return
+        orphans = []
+        for child in direct_children(pid):
+            try:
+                orphans.append(psutil.Process(child))
+            except psutil.Error:
+                continue
+        with self.lock:
+            self.owned[sessionid].pop(pid, None)
+            self.owners.pop(pid, None)
+            for process in orphans:
+                if process.pid not in self.owners:
+                    self.owned[sessionid][process.pid] = process
+                    self.owners[process.pid] = sessionid
+            if not self.owned[sessionid]:
+                del self.owned[sessionid]
+        self.snapshots.pop(sessionid, None)
+
+    def members(self, sessionid: str) -> dict:
+        """Every live process of the session: owned processes and their descendants."""
+        with self.lock:
+            roots = list(self.owned.get(sessionid, {}).values())
+            owners = dict(self.owners)
+        members = {}
+        for root in roots:
+            if not root.is_running():
+                with self.lock:
+                    self.owned.get(sessionid, {}).pop(root.pid, None)
+                    if self.owners.get(root.pid) == sessionid:
+                        del self.owners[root.pid]
+                continue
+            for process in [root] + descendants(root):
+                # 池中的 worker 上可能还挂着其他 session 留下的子进程
+                if owners.get(process.pid, sessionid) == sessionid:
+                    members.setdefault(process.pid, process)
+        return members
+
+    def collect(self, sessionid: str) -> list:
+        previous = self.handles.get(sessionid, {})
+        handles, processes = {}, []
+        now = time.time()
+        for pid, process in self.members(sessionid).items():
+            handle = previous.get(pid)
+            if handle is None or not handle.is_running():
+                handle = process
+            try:
+                processes.append(describe_process(handle, now))
+            except psutil.Error:
+                continue
+            handles[pid] = handle
+        self.handles[sessionid] = handles
+        return processes
+
+    async def list(self, sessionid: str, refresh: bool = False) -> tuple:
+        """Return (processes, age of the snapshot in seconds), collecting at most once per ttl."""
+        async with self.locks[sessionid]:
+            cached = self.snapshots.get(sessionid)
+            if cached and not refresh and time.monotonic() - cached[0] < self.ttl:
+                self.stats["cache_hits"] += 1
+                return cached[1], time.monotonic() - cached[0]
+            processes = await asyncio.to_thread(self.collect, sessionid)
+            self.stats["snapshots"] += 1
+            if processes or sessionid in self.owned:
+                self.snapshots[sessionid] = (time.monotonic(), processes)
+            else:
+                self.handles.pop(sessionid, None)
+                self.locks.pop(sessionid, None)
+            return processes, 0.0
+
+    def kill(self, sessionid: str, pid: int, tree: bool = True) -> list:
+        """Terminate pid (and its descendants) if it belongs to the session; kill what survives the grace period."""
+        target = self.members(sessionid).get(pid)
+        if target is None:
+            raise HTTPException(status_code=404, detail="Process not found")
+        victims = [target]
+        if tree:
+            victims += descendants(target)
+        for process in victims:
+            try:
+                process.terminate()
+            except psutil.Error:
+                pass
+        _, alive = psutil.wait_procs(victims, timeout=PROCESS_KILL_TIMEOUT)
+        for process in alive:
+            try:
+                process.kill()
+            except psutil.Error:
+                pass
+        with self.lock:
+            # 被杀死的子进程在父进程 wait 之前是僵尸进程，is_running() 仍然为真，直接停止跟踪
+            for process in victims:
+                self.owned.get(sessionid, {}).pop(process.pid, None)
+                if self.owners.get(process.pid) == sessionid:
+                    del self.owners[process.pid]
+        self.snapshots.pop(sessionid, None)
+        self.stats["killed"] += len(victims)
+        return sorted(process.pid for process in victims)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"sessions": len(self.owned), "tracked": len(self.owners), "ttl": self.ttl, **self.stats}
+
+process_tracker = ProcessTracker(PROCESS_SNAPSHOT_TTL)
+
+PROCESS_SORT_KEYS = {"pid": (lambda process: process["pid"], False),
+                     "cpu": (lambda process: process["cpu_percent"], True),
+                     "rss": (lambda process: process["rss"], True),
+                     "runtime": (lambda process: process["runtime"], True)}
+
 @app.get("/{sessionid}/processes")
-async def list_processes():
-    processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        processes.append({
-            "pid": proc.info['pid'],
-            "name": proc.info['name'],
-            "cmdline": proc.info['cmdline']
-        })
-    return {"processes": processes}
+async def list_processes(sessionid: str, name: Optional[str] = None, status: Optional[str] = None,
+                         sort: Literal["pid", "cpu", "rss", "runtime"] = "pid",
+                         offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=PROCESS_LIST_MAX_LIMIT),
+                         refresh: bool = False):
+    """
+    列出该 session 的进程（执行中的 worker、常驻 kernel 和它们创建的子进程）及其 CPU、内存和运行时长。
+    name 按进程名或命令行的子串过滤，status 按 psutil 的进程状态过滤；结果最多缓存 SANDBOX_PROCESS_SNAPSHOT_TTL 秒，
+    refresh=true 时重新采集。
+    """
+    processes, age = await process_tracker.list(sessionid, refresh)
+    if name:
+        processes = [process for process in processes
+                     if name in process["name"] or any(name in part for part in process["cmdline"])]
+    if status:
+        processes = [process for process in processes if process["status"] == status]
+    key, reverse = PROCESS_SORT_KEYS[sort]
+    processes = sorted(processes, key=key, reverse=reverse)
+    return {"processes": processes[offset:offset + limit], "total": len(processes),
+            "offset": offset, "limit": limit, "snapshot_age": round(age, 3)}
 
 @app.post("/{sessionid}/process/kill/{pid}")
-async def kill_process(pid: int):
-    try:
-        process = psutil.Process(pid)
-        process.terminate()
-        return {"message": f"Process {pid} terminated"}
-    except psutil.NoSuchProcess:
-        raise HTTPException(status_code=404, detail="Process not found")
+async def kill_process(sessionid: str, pid: int, tree: bool = True):
+    """只能终止该 session 自己的进程；默认连同所有子进程一起终止，宽限期后仍未退出的进程会被 kill。"""
+    killed = await asyncio.to_thread(process_tracker.kill, sessionid, pid, tree)
+    return {"message": f"Process {pid} terminated", "killed": killed}
 
 ###############################
 #    File Management          #
 ###############################
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 流式写盘时每次读取的字节数
+DOWNLOAD_CHUNK_SIZE = 256 * 1024  # 下载和打包时每次读取的字节数
+UPLOADS_DIR = ".uploads"  # 分块上传的中间文件目录，位于文件区内以便 rename 是原子的
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+LIST_MAX_LIMIT = 1000  # 单页最多返回的文件数
+upload_locks = defaultdict(asyncio.Lock)
+
+def session_dir(sessionid: str) -> Path:
+    """Every session owns its own directory under FILES_DIR."""
+    if not SESSION_ID_PATTERN.fullmatch(sessionid):
+        raise HTTPException(status_code=400, detail=f"Invalid session id {sessionid}")
+    return FILES_DIR / sessionid
+
+def resolve_file(sessionid: str, filename: str) -> Path:
+    """Map a client supplied filename into the session directory, rejecting paths and hidden names."""
+    if not filename or filename.startswith(".") or "/" in filename or "\\" in filename:
+        raise HTTPException(status_code=400, detail=f"Invalid filename {filename}")
+    return session_dir(sessionid) / filename
+
+def describe_file(path: Path, sha256: Optional[str] = None) -> dict:
+    """Stat a file and hash its content, unless the caller already computed the digest."""
+    stat = path.stat()
+    if sha256 is None:
+        digest = hashlib.sha256()
+        with path.open("rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+        sha256 = digest.hexdigest()
+    return {"filename": path.name, "size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+
+class FileIndex:
+    """
+    每个 session 文件区的元数据索引（大小、修改时间、sha256）。
+    第一次访问时扫描一次目录，之后由上传、删除和图像写入增量维护，列出文件时不再遍历磁盘。
+    """
+    def __init__(self):
+        self.sessions = {}  # sessionid -> {filename: entry}
+        self.locks = defaultdict(asyncio.Lock)
+        self.stats = {"scans": 0, "rehashed": 0}
+
+    def scan(self, sessionid: str, known: Optional[dict] = None) -> dict:
+        """List the directory, reusing entries from known whose size and mtime did not change."""
+        directory = session_dir(sessionid)
+        entries = {}
+        known = known or {}
+        if directory.is_dir():
+            for path in directory.iterdir():
+                if not path.name.startswith(".") and path.is_file():
+                    entry = known.get(path.name)
+                    stat = path.stat()
+                    if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                        entry = describe_file(path)
+                    entries[path.name] = entry
+        self.stats["scans"] += 1
+        return entries
+
+    async def entries(self, sessionid: str, refresh: bool = False) -> dict:
+        async with self.locks[sessionid]:
+            if refresh or sessionid not in self.sessions:
+                self.sessions[sessionid] = await asyncio.to_thread(self.scan, sessionid)
+            return self.sessions[sessionid]
+
+    async def lookup(self, sessionid: str, filename: str) -> Optional[dict]:
+        """
+        返回文件的索引项。如果文件在索引之外被修改过（大小或 mtime 不一致），
+        重新计算一次；文件已不存在时从索引中删除。
+        """
+        path = resolve_file(sessionid, filename)
+        entries = await self.entries(sessionid)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            entries.pop(filename, None)
+            return None
+        entry = entries.get(filename)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = entries[filename] = await asyncio.to_thread(describe_file, path)
+            self.stats["rehashed"] += 1
+        return entry
+
+    async def sync(self, sessionid: str) -> dict:
+        """
+        重新列出目录，只为大小或 mtime 变化过的文件重新计算 sha256，
+        用于做快照前发现用户代码直接写入或删除的文件。
+        """
+        async with self.locks[sessionid]:
+            self.sessions[sessionid] = await asyncio.to_thread(self.scan, sessionid, self.sessions.get(sessionid))
+            return self.sessions[sessionid]
+
+    def update(self, sessionid: str, entry: dict):
+        # 还没有加载过的 session 会在第一次访问时扫描目录，这里不需要记录
+        entries = self.sessions.get(sessionid)
+        if entries is not None:
+            entries[entry["filename"]] = entry
+
+    def remove(self, sessionid: str, filename: str):
+        self.sessions.get(sessionid, {}).pop(filename, None)
+
+file_index = FileIndex()
+
+def publish_file(temp_path: Path, file_path: Path):
+    """Atomically move a fully written temp file into place without overwriting."""
+    try:
+        # link 在目标已存在时失败，保证不会覆盖已有文件
+        os.link(temp_path, file_path)
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail=f"File {file_path.name} already exists")
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+async def write_stream(chunks, f, written: int, limit: int, digest=None) -> int:
+    """Append an async byte stream to f, failing with 413 as soon as it exceeds limit."""
+    async for chunk in chunks:
+        written += len(chunk)
+        if written > limit:
+            raise HTTPException(status_code=413, detail=f"Uploaded file exceeds {limit} bytes")
+        await asyncio.to_thread(f.write, chunk)
+        if digest is not None:
+            digest.update(chunk)
+    return written
+
+async def iter_upload_file(file: UploadFile):
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
 @app.post("/{sessionid}/files/upload")
-async def upload_file(file: UploadFile = File(...)):
-    file_path = FILES_DIR / file.filename
+async def upload_file(sessionid: str, file: UploadFile = File(...)):
+    file_path = resolve_file(sessionid, file.filename)
+    temp_path = None
     try:
         if file_path.exists():
             raise HTTPException(status_code=409, detail=f"File {file.filename} already exists")
         file_path.parent.mkdir(parents=True, exist_ok=True)
-        with file_path.open("wb") as f:
-            content = await file.read()
-            if len(content) > MAX_FILE_SIZE:
-                raise HTTPException(status_code=413, detail="Uploaded file exceeds 10MB")
-            f.write(content)
+        fd, temp_name = tempfile.mkstemp(dir=file_path.parent, prefix=".upload-")
+        temp_path = Path(temp_name)
+        os.fchmod(fd, 0o644)  # mkstemp 默认是 0600，与直接写入的文件保持一致
+        digest = hashlib.sha256()
+        with os.fdopen(fd, "wb") as f:
+            await write_stream(iter_upload_file(file), f, 0, MAX_FILE_SIZE, digest)
+        publish_file(temp_path, file_path)
+        file_index.update(sessionid, describe_file(file_path, digest.hexdigest()))
         return {"message": f"Uploaded file {file.filename}"}
     except PermissionError:
         raise HTTPException(status_code=403, detail="Permission denied")
@@ -83,14 +454,95 @@ async def upload_file(file: UploadFile = File(...)):
     except Exception as e:
         print("Failed to upload file due to " + str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
+
+class UploadSession(BaseModel):
+    filename: str
+    size: Optional[int] = None  # 预期的文件总大小，超过上限时提前拒绝
+
+def upload_paths(sessionid: str, upload_id: str):
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id):
+        raise HTTPException(status_code=404, detail="Upload not found")
+    directory = session_dir(sessionid) / UPLOADS_DIR
+    meta_path = directory / f"{upload_id}.json"
+    if not meta_path.exists():
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return json.loads(meta_path.read_text()), meta_path, directory / f"{upload_id}.part"
+
+@app.post("/{sessionid}/files/uploads")
+async def create_upload(sessionid: str, session: UploadSession):
+    """开始一个可续传的分块上传，返回 upload_id。"""
+    file_path = resolve_file(sessionid, session.filename)
+    if file_path.exists():
+        raise HTTPException(status_code=409, detail=f"File {session.filename} already exists")
+    if session.size is not None and session.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"Uploaded file exceeds {MAX_UPLOAD_SIZE} bytes")
+    upload_id = uuid.uuid4().hex
+    directory = session_dir(sessionid) / UPLOADS_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{upload_id}.part").touch()
+    (directory / f"{upload_id}.json").write_text(json.dumps(session.dict()))
+    return {"upload_id": upload_id, "offset": 0, "max_chunk_size": MAX_FILE_SIZE, "max_size": MAX_UPLOAD_SIZE}
+
+@app.get("/{sessionid}/files/uploads/{upload_id}")
+async def get_upload(sessionid: str, upload_id: str):
+    meta, _, part_path = upload_paths(sessionid, upload_id)
+    return {"upload_id": upload_id, "offset": part_path.stat().st_size, **meta}
+
+@app.put("/{sessionid}/files/uploads/{upload_id}")
+async def append_upload(sessionid: str, upload_id: str, offset: int, request: Request):
+    """
+    追加一个分块。offset 必须等于服务端已收到的字节数，否则返回 409，
+    客户端可以通过 GET 查询 offset 后从断点继续上传。
+    """
+    async with upload_locks[upload_id]:
+        meta, _, part_path = upload_paths(sessionid, upload_id)
+        current = part_path.stat().st_size
+        if offset != current:
+            raise HTTPException(status_code=409, detail=f"Offset mismatch, expected {current}")
+        limit = min(meta["size"], MAX_UPLOAD_SIZE) if meta.get("size") is not None else MAX_UPLOAD_SIZE
+        with part_path.open("ab") as f:
+            try:
+                written = await write_stream(request.stream(), f, current, limit)
+            except BaseException:
+                # 丢弃写了一半的分块，保证 offset 始终落在分块边界上
+                f.truncate(current)
+                raise
+        return {"upload_id": upload_id, "offset": written}
+
+@app.post("/{sessionid}/files/uploads/{upload_id}/complete")
+async def complete_upload(sessionid: str, upload_id: str):
+    async with upload_locks[upload_id]:
+        meta, meta_path, part_path = upload_paths(sessionid, upload_id)
+        size = part_path.stat().st_size
+        if meta.get("size") is not None and size != meta["size"]:
+            raise HTTPException(status_code=400, detail=f"Upload incomplete, received {size} of {meta['size']} bytes")
+        file_path = resolve_file(sessionid, meta["filename"])
+        publish_file(part_path, file_path)
+        meta_path.unlink(missing_ok=True)
+    upload_locks.pop(upload_id, None)
+    file_index.update(sessionid, await asyncio.to_thread(describe_file, file_path))
+    return {"message": f"Uploaded file {meta['filename']}", "size": size}
+
+@app.delete("/{sessionid}/files/uploads/{upload_id}")
+async def abort_upload(sessionid: str, upload_id: str):
+    async with upload_locks[upload_id]:
+        _, meta_path, part_path = upload_paths(sessionid, upload_id)
+        part_path.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+    upload_locks.pop(upload_id, None)
+    return {"message": f"Aborted upload {upload_id}"}
 
 @app.delete("/{sessionid}/files/delete/{filename}")
-async def delete_file(filename: str):
-    file_path = FILES_DIR / filename
+async def delete_file(sessionid: str, filename: str):
+    file_path = resolve_file(sessionid, filename)
     try:
         if not file_path.exists():
             raise HTTPException(status_code=404, detail=f"File {filename} not found")
         file_path.unlink()
+        file_index.remove(sessionid, filename)
         return {"message": f"Deleted file {filename}"}
     except PermissionError:
         raise HTTPException(status_code=403, detail="Permission denied")
@@ -99,12 +551,149 @@ async def delete_file(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/{sessionid}/files/list")
+async def list_files(sessionid: str, offset: int = 0, limit: int = 100, refresh: bool = False):
+    """
+    按文件名排序分页列出文件区中的文件，数据来自内存中的索引；
+    refresh=true 时重新扫描目录（例如用户代码直接写入了文件区）。
+    """
+    if offset < 0 or not 0 < limit <= LIST_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"offset must be >= 0 and limit in 1..{LIST_MAX_LIMIT}")
+    entries = await file_index.entries(sessionid, refresh)
+    names = sorted(entries)
+    return {"files": [entries[name] for name in names[offset:offset + limit]],
+            "total": len(names), "offset": offset, "limit": limit}
+
+def content_disposition(filename: str) -> str:
+    quoted = urllib.parse.quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def parse_range(header: str, size: int) -> Optional[tuple]:
+    """
+    Parse a single "bytes=start-end" range into an inclusive (start, end) pair.
+    Returns None when the header should be ignored and the whole file served.
+    """
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None  # 多段 range 等不支持的格式按 RFC 7233 忽略
+    first, last = match.groups()
+    if first == "":
+        start, end = max(size - int(last), 0), size - 1
+        if int(last) == 0:
+            start = size  # bytes=-0 不可满足
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+    if start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def etag_matches(header: str, etag: str) -> bool:
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+def iter_file(path: Path, start: int, length: int):
+    with path.open("rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
 @app.get("/{sessionid}/files/download/{filename}")
-async def download_file(filename: str):
-    file_path = FILES_DIR / filename
-    if not file_path.exists():
+async def download_file(sessionid: str, filename: str, request: Request):
+    """
+    下载文件，ETag 为文件的 sha256。支持 If-None-Match（返回 304）、
+    单段 Range（返回 206）以及 If-Range。
+    """
+    entry = await file_index.lookup(sessionid, filename)
+    if entry is None:
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(path=file_path, filename=filename, media_type="application/octet-stream")
+    etag = f'"{entry["sha256"]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(entry["mtime"], usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    size = entry["size"]
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range(range_header, size)
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    headers["Content-Disposition"] = content_disposition(filename)
+    return StreamingResponse(iter_file(resolve_file(sessionid, filename), start, end - start + 1),
+                             status_code=status_code, headers=headers,
+                             media_type="application/octet-stream")
+
+class ZipStream(io.RawIOBase):
+    """Write-only sink for ZipFile; the generator drains what was written after each chunk."""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_zip(paths: list, compression: int, arcnames: Optional[list] = None, documents: Optional[dict] = None):
+    """
+    边读文件边生成 zip。输出流不可 seek，ZipFile 会使用 data descriptor，
+    所以不需要先把整个压缩包写到磁盘或内存中。
+    arcnames 为每个文件在压缩包中的名字（默认使用文件名），documents 中的 {名字: bytes} 写在文件之前。
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w", compression=compression) as archive:
+        for arcname, data in (documents or {}).items():
+            archive.writestr(arcname, data)
+            yield stream.drain()
+        for path, arcname in zip(paths, arcnames or [path.name for path in paths]):
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = compression
+            with archive.open(info, "w", force_zip64=True) as dest, path.open("rb") as src:
+                while chunk := src.read(DOWNLOAD_CHUNK_SIZE):
+                    dest.write(chunk)
+                    data = stream.drain()
+                    if data:
+                        yield data
+            yield stream.drain()
+    yield stream.drain()
+
+@app.get("/{sessionid}/files/archive")
+async def download_archive(sessionid: str, filename: Optional[List[str]] = Query(None), compress: bool = True):
+    """以 zip 流的方式批量下载文件，不指定 filename 时打包整个文件区。"""
+    entries = await file_index.entries(sessionid)
+    names = filename or sorted(entries)
+    paths = [resolve_file(sessionid, name) for name in names]
+    for path in paths:
+        if not path.is_file():
+            raise HTTPException(status_code=404, detail=f"File {path.name} not found")
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    return StreamingResponse(iter_zip(paths, compression), media_type="application/zip",
+                             headers={"Content-Disposition": content_disposition(f"{sessionid}.zip")})
 
 ###############################
 #    Code Execution           #
@@ -113,157 +702,1159 @@ async def download_file(filename: str):
 class CodeRequest(BaseModel):
     code: str
     timeout: int = 30  # Default timeout 30 seconds
+    persistent: bool = False  # 使用会话级的常驻 kernel，变量在多次调用之间保留
+    figure_format: Literal["png", "jpeg", "webp", "svg"] = "png"
+    figure_dpi: Optional[int] = None  # 默认使用 figure 自身的 dpi
+    figure_max_size: Optional[int] = None  # 图像最长边的像素上限
+    inline_images: bool = False  # 为 True 时才把图像 base64 编码后放进响应
 
 import matplotlib
 matplotlib.use('Agg')
 
-def execute_python_in_process(code: str, result_queue: Queue):
-    """Execute Python code in a subprocess with stdin closed."""
+FIGURE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp", "svg": "svg"}
+
+def default_figure_options(sessionid: Optional[str] = None) -> dict:
+    # 图像写入该 session 的文件区；每次执行使用唯一的前缀，避免并发执行的图像文件互相覆盖
+    directory = session_dir(sessionid) if sessionid else FILES_DIR
+    return {"dir": str(directory), "prefix": f"figure-{uuid.uuid4().hex[:12]}",
+            "format": "png", "dpi": None, "max_size": None}
+
+def default_spill_options(sessionid: Optional[str] = None) -> dict:
+    # 截断的输出和结果使用自己的前缀，不会被当作图像
+    directory = session_dir(sessionid) if sessionid else FILES_DIR
+    return {"dir": str(directory), "prefix": f"spill-{uuid.uuid4().hex[:12]}"}
+
+def request_figure_options(request: CodeRequest) -> dict:
+    return {"format": request.figure_format, "dpi": request.figure_dpi, "max_size": request.figure_max_size}
+
+def save_figures(options: dict) -> list:
+    """Write every open matplotlib figure to the files area and describe the files."""
+    figures = []
+    fignums = plt.get_fignums()
+    if not fignums:
+        return figures
+    directory = Path(options["dir"])
+    directory.mkdir(parents=True, exist_ok=True)
+    fmt = options.get("format") or "png"
+    for index, num in enumerate(fignums):
+        fig = plt.figure(num)
+        width, height = fig.get_size_inches()
+        dpi = options.get("dpi") or fig.dpi
+        if options.get("max_size"):
+            dpi = min(dpi, options["max_size"] / max(width, height))
+        filename = f"{options['prefix']}-{index}.{FIGURE_EXTENSIONS[fmt]}"
+        path = directory / filename
+        fig.savefig(path, format=fmt, dpi=dpi)
+        figures.append({
+            "filename": filename,
+            "format": fmt,
+            "width": round(width * dpi),
+            "height": round(height * dpi),
+            "size": path.stat().st_size,
+        })
+    plt.close('all')
+    return figures
+
+def read_figures_base64(figures: list, directory: Path) -> list:
+    return [base64.b64encode((directory / figure["filename"]).read_bytes()).decode('utf-8')
+            for figure in figures]
+
+def write_inline_figure(image_base64: str, options: dict) -> dict:
+    """Store an image returned inline (Node.js/Plotly) as a PNG figure file."""
+    directory = Path(options["dir"])
+    directory.mkdir(parents=True, exist_ok=True)
+    filename = f"{options['prefix']}-0.png"
+    data = base64.b64decode(image_base64)
+    (directory / filename).write_bytes(data)
+    return {"filename": filename, "format": "png", "width": None, "height": None, "size": len(data)}
+
+MAX_OUTPUT_CHARS = int(os.environ.get("SANDBOX_MAX_OUTPUT_CHARS", str(1000 * 1000)))  # 响应中 stdout 的最大字符数
+MAX_RESULT_BYTES = int(os.environ.get("SANDBOX_MAX_RESULT_BYTES", str(1024 * 1024)))  # result 编码成 JSON 后的最大字节数
+MAX_RESULT_ITEMS = int(os.environ.get("SANDBOX_MAX_RESULT_ITEMS", "1000"))  # result 中每个容器最多保留的元素数
+MAX_RESULT_DEPTH = 20  # 更深的嵌套用 repr 表示
+MAX_REPR_CHARS = 1000  # 无法转换为 JSON 的对象用 repr 表示时的最大长度
+
+def write_spill(options: dict, suffix: str, data, files: list, kind: str) -> dict:
+    """Write an oversized payload to the files area under the spill prefix of this execution and describe it."""
+    directory = Path(options["dir"])
+    directory.mkdir(parents=True, exist_ok=True)
+    filename = f"{options['prefix']}-{suffix}"
+    path = directory / filename
+    if isinstance(data, np.ndarray):
+        # 直接从数组的内存写文件，不经过管道，也不做 tolist 转换
+        np.save(path, data, allow_pickle=False)
+    else:
+        path.write_bytes(data)
+    entry = {"kind": kind, "filename": filename, "size": path.stat().st_size}
+    files.append(entry)
+    return entry
+
+def cap_output(output: str, options: dict, files: list) -> tuple:
+    """
+    超过 MAX_OUTPUT_CHARS 的输出只在响应中保留开头部分并加上截断标记，完整输出写入文件。
+    返回 (output, 是否截断)。
+    """
+    if len(output) <= MAX_OUTPUT_CHARS:
+        return output, False
+    entry = write_spill(options, "output.txt", output.encode("utf-8", "surrogateescape"), files, "output")
+    marker = f"\n...[输出已截断：共 {len(output)} 个字符，完整输出见文件 {entry['filename']}]"
+    return output[:MAX_OUTPUT_CHARS] + marker, True
+
+def safe_repr(value) -> str:
     try:
-        sys.stdin.close()
-        output = io.StringIO()
-        globals_dict = {}
-        with redirect_stdout(output):
-            tree = ast.parse(code, mode='exec')
-            if not tree.body:
-                result_queue.put({"result": None, "output": output.getvalue(), "image": None})
-                return
+        text = repr(value)
+    except Exception:
+        text = f"<{type(value).__name__} object>"
+    if len(text) > MAX_REPR_CHARS:
+        text = text[:MAX_REPR_CHARS] + "...[已截断]"
+    return text
+
+def to_jsonable(value, depth: int = 0, path: Optional[set] = None):
+    """
+    Convert a result into plain JSON values. Containers keep at most MAX_RESULT_ITEMS elements,
+    NaN/Infinity become strings and anything else (figures, artists, modules...) becomes its repr.
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value) if math.isfinite(value) else repr(value)
+    if isinstance(value, np.generic):
+        return to_jsonable(value.item(), depth, path)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value[:MAX_RESULT_ITEMS])
+        return {"type": "bytes", "size": len(value), "truncated": len(value) > MAX_RESULT_ITEMS,
+                "base64": base64.b64encode(data).decode("ascii")}
+    path = path or set()
+    if depth >= MAX_RESULT_DEPTH or id(value) in path:
+        return safe_repr(value)
+    if isinstance(value, np.ndarray):
+        if value.size <= MAX_RESULT_ITEMS:
+            return to_jsonable(value.tolist(), depth, path)
+        return {"type": "ndarray", "shape": list(value.shape), "dtype": str(value.dtype), "truncated": True,
+                "head": to_jsonable(value.ravel()[:MAX_RESULT_ITEMS].tolist(), depth, path)}
+    path.add(id(value))
+    try:
+        if isinstance(value, dict):
+            converted = {(key if isinstance(key, str) else safe_repr(key)): to_jsonable(item, depth + 1, path)
+                         for key, item in itertools.islice(value.items(), MAX_RESULT_ITEMS)}
+            if len(value) > MAX_RESULT_ITEMS:
+                converted["..."] = f"[共 {len(value)} 项，已截断]"
+            return converted
+        if isinstance(value, (list, tuple, set, frozenset, deque)):
+            converted = [to_jsonable(item, depth + 1, path) for item in itertools.islice(value, MAX_RESULT_ITEMS)]
+            if len(value) > MAX_RESULT_ITEMS:
+                converted.append(f"...[共 {len(value)} 项，已截断]")
+            return converted
+    finally:
+        path.discard(id(value))
+    return safe_repr(value)
+
+def package_result(value, options: dict, files: list) -> tuple:
+    """
+    把 result 转换为可以 JSON 编码的值，返回 (result, 是否截断)。
+    大数组和大块二进制直接写入文件；转换后编码超过 MAX_RESULT_BYTES 的 result 也写入文件，响应中只返回文件的引用。
+    """
+    if value is None:
+        return None, False
+    if isinstance(value, np.ndarray) and value.nbytes > MAX_RESULT_BYTES and value.dtype != object:
+        entry = write_spill(options, "result.npy", value, files, "result")
+        return {"type": "ndarray", "shape": list(value.shape), "dtype": str(value.dtype), **entry}, True
+    if isinstance(value, (bytes, bytearray, memoryview)) and len(value) > MAX_RESULT_BYTES:
+        entry = write_spill(options, "result.bin", value, files, "result")
+        return {"type": "bytes", **entry}, True
+    converted = to_jsonable(value)
+    encoded = json.dumps(converted, ensure_ascii=False).encode("utf-8", "surrogateescape")
+    if len(encoded) <= MAX_RESULT_BYTES:
+        return converted, False
+    entry = write_spill(options, "result.json", encoded, files, "result")
+    return {"type": "json", **entry}, True
+
+async def publish_figures(result: dict, sessionid: Optional[str], options: dict, spill: dict,
+                          inline_images: bool) -> dict:
+    """
+    图像以文件形式保存在文件区，响应中只返回下载地址；
+    只有客户端要求 inline_images 时才读取文件并做 base64 编码。
+    """
+    figures = result.get("figures") or []
+    if result.get("image") and not figures:
+        figures = [await asyncio.to_thread(write_inline_figure, result["image"], options)]
+    files = result.get("files") or []
+    if not result.get("output_truncated") and len(result.get("output") or "") > MAX_OUTPUT_CHARS:
+        # Node.js 的输出在这里截断，Python 的输出已经在 worker 中截断
+        result["output"], result["output_truncated"] = await asyncio.to_thread(
+            cap_output, result["output"], spill, files)
+    directory = Path(options["dir"])
+    published = figures + files
+    entries = await asyncio.to_thread(lambda: [describe_file(directory / item["filename"]) for item in published])
+    for item, entry in zip(published, entries):
+        item["url"] = f"/{sessionid}/files/download/{item['filename']}"
+        file_index.update(sessionid, entry)
+    if result.get("result_truncated"):
+        result["result"]["url"] = f"/{sessionid}/files/download/{result['result']['filename']}"
+    result["figures"] = figures
+    result["files"] = files
+    result.setdefault("output_truncated", False)
+    result.setdefault("result_truncated", False)
+    result["image"] = None
+    if inline_images and figures:
+        encoded = await asyncio.to_thread(read_figures_base64, figures, directory)
+        for figure, data in zip(figures, encoded):
+            figure["data"] = data
+        result["image"] = encoded[0]
+    return result
+
+COMPILE_CACHE_MAX_ENTRIES = int(os.environ.get("SANDBOX_COMPILE_CACHE_ENTRIES", "1024"))
+COMPILE_CACHE_MAX_BYTES = int(os.environ.get("SANDBOX_COMPILE_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+def compile_python_snippet(code: str) -> tuple:
+    """
+    Parse code and compile it into marshalled (statements, last_expression) code objects.
+    The trailing expression, if any, is compiled in eval mode so its value becomes the result.
+    """
+    tree = ast.parse(code, mode='exec')
+    if not tree.body:
+        return None, None
+    last_node = tree.body[-1]
+    if not isinstance(last_node, ast.Expr):
+        return marshal.dumps(compile(tree, '<string>', 'exec', dont_inherit=True)), None
+    statements = None
+    if len(tree.body) > 1:
+        module = ast.Module(tree.body[:-1], type_ignores=[])
+        statements = marshal.dumps(compile(module, '<string>', 'exec', dont_inherit=True))
+    expression = ast.Expression(last_node.value)
+    last_expression = marshal.dumps(compile(expression, '<string>', 'eval', dont_inherit=True))
+    return statements, last_expression
+
+class CompileCache:
+    """
+    按代码的 sha256 缓存编译结果的 LRU，同时限制条目数和 code object 的总字节数。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, code: str) -> tuple:
+        key = hashlib.sha256(code.encode('utf-8', 'surrogatepass')).hexdigest()
+        compiled = self._entries.get(key)
+        if compiled is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return compiled
+        self.misses += 1
+        compiled = compile_python_snippet(code)
+        size = sum(len(part) for part in compiled if part)
+        if size <= self.max_bytes:
+            self._entries[key] = compiled
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= sum(len(part) for part in evicted if part)
+        return compiled
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"entries": len(self._entries), "bytes": self._bytes, "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+compile_cache = CompileCache(COMPILE_CACHE_MAX_ENTRIES, COMPILE_CACHE_MAX_BYTES)
+
+STREAM_CHUNK_SIZE = 8 * 1024  # 流式输出时单个分片的最大字符数
+STREAM_FLUSH_INTERVAL = 0.05  # 秒，缓冲的输出最多等待这么久就会被发出
+
+class StreamWriter(io.TextIOBase):
+    """
+    File-like stdout/stderr replacement that forwards writes to emit() in chunks.
+    Writes are batched for up to STREAM_FLUSH_INTERVAL seconds (or until a chunk
+    fills up) so tight print loops do not turn into one message per line.
+    """
+
+    def __init__(self, name: str, emit):
+        self.name = name
+        self.emit = emit
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._finished = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if not isinstance(text, str):
+            raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        with self._lock:
+            if self._finished:
+                # 执行结束后用户线程的输出直接丢弃，避免混入下一个任务
+                return len(text)
+            self._buffer.append(text)
+            self._size += len(text)
+            if self._size >= STREAM_CHUNK_SIZE:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = threading.Timer(STREAM_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def finish(self):
+        with self._lock:
+            self._flush_locked()
+            self._finished = True
 
-            if len(tree.body) > 1:
-                exec(compile(ast.Module(tree.body[:-1], []), '<string>', 'exec'), globals_dict)
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            data = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+            for start in range(0, len(data), STREAM_CHUNK_SIZE):
+                self.emit(self.name, data[start:start + STREAM_CHUNK_SIZE])
 
-            last_node = tree.body[-1] if tree.body else None
-            if isinstance(last_node, ast.Expr):
-                last_line_code = code.splitlines()[-1]
-                result = eval(last_line_code, globals_dict)
-                globals_dict['result'] = result
+def execute_python_snippet(compiled: tuple, globals_dict: Optional[dict] = None, emit=None,
+                           figure_options: Optional[dict] = None, spill_options: Optional[dict] = None) -> dict:
+    """
+    Execute a snippet compiled by compile_python_snippet in the current process
+    and collect its output.
+    Passing the same globals_dict across calls keeps variables between snippets.
+    When emit is given, stdout/stderr are streamed through it instead of buffered.
+    Open figures are written to files described by figure_options,
+    oversized output and results to files described by spill_options.
+    """
+    persistent = globals_dict is not None
+    if globals_dict is None:
+        globals_dict = {}
+    # 常驻 kernel 中 result 可能是上一次留下的
+    previous_result = globals_dict.get('result', None)
+    try:
+        with ExitStack() as stack:
+            if emit is None:
+                output = stack.enter_context(redirect_stdout(io.StringIO()))
             else:
-                exec(code, globals_dict)
-
-            image_base64 = None
-            if plt.get_fignums():
-                buf = io.BytesIO()
-                plt.savefig(buf, format='png')
-                buf.seek(0)
-                image_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-                plt.close('all')
-
-        result_queue.put({
-            "result": globals_dict.get('result', None),
-            "output": output.getvalue(),
-            "image": image_base64
-        })
+                output = io.StringIO()
+                stdout_writer = stack.enter_context(redirect_stdout(StreamWriter("stdout", emit)))
+                stderr_writer = stack.enter_context(redirect_stderr(StreamWriter("stderr", emit)))
+                stack.callback(stderr_writer.finish)
+                stack.callback(stdout_writer.finish)
+            statements, last_expression = compiled
+            options = figure_options or default_figure_options()
+            started = time.perf_counter()
+            if statements is not None:
+                exec(marshal.loads(statements), globals_dict)
+            if last_expression is not None:
+                # 最后一个表达式的值即使与上一次的 result 是同一个对象也返回
+                result = globals_dict['result'] = eval(marshal.loads(last_expression), globals_dict)
+            else:
+                result = globals_dict.get('result', None)
+                if persistent and result is previous_result:
+                    # 本次执行没有改变 result，不返回上一次留下的值
+                    result = None
+            executed = time.perf_counter()
+
+            figures = save_figures(options)
+
+        saved = time.perf_counter()
+        # 在 worker 中转换和截断，管道只传输可以 JSON 编码、大小受限的结果
+        files = []
+        spill = spill_options or default_spill_options()
+        result, result_truncated = package_result(result, spill, files)
+        output, output_truncated = cap_output(output.getvalue(), spill, files)
+        return {
+            "result": result,
+            "result_truncated": result_truncated,
+            "output": output,
+            "output_truncated": output_truncated,
+            "image": None,
+            "figures": figures,
+            "files": files,
+            "timings": {"exec": executed - started, "figures": saved - executed,
+                        "package": time.perf_counter() - saved},
+        }
     except SyntaxError as e:
-        result_queue.put({"error": f"语法错误: {str(e)}", "status_code": 400})
+        return {"error": f"语法错误: {str(e)}", "status_code": 400}
     except ValueError as e:
         if "I/O operation on closed file" in str(e):
-            result_queue.put({"error": "无法读取输入（标准输入已关闭）", "status_code": 400})
-        else:
-            result_queue.put({"error": f"执行错误: {str(e)}", "status_code": 400})
+            return {"error": "无法读取输入（标准输入已关闭）", "status_code": 400}
+        return {"error": f"执行错误: {str(e)}", "status_code": 400}
     except EOFError:
-        result_queue.put({"error": "无法读取输入（标准输入已关闭）", "status_code": 400})
+        return {"error": "无法读取输入（标准输入已关闭）", "status_code": 400}
     except Exception as e:
-        result_queue.put({"error": f"执行错误: {str(e)}", "status_code": 400})
+        return {"error": f"执行错误: {str(e)}", "status_code": 400}
+    finally:
+        plt.close('all')
 
-def execute_nodejs_in_process(code: str, result_queue: Queue, timeout: int):
-    """Execute Node.js code in a subprocess using vm2 sandbox."""
-    try:
-        sys.stdin.close()
-        # Create a temporary file for the JavaScript code
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as temp_file:
-            temp_file.write(code)
-            temp_file_path = temp_file.name
-
-        print(f"code is {code}")
-        # Execute the code using sandbox.js
+###############################
+#    Python Worker Pool       #
+###############################
+
+POOL_SIZE = int(os.environ.get("SANDBOX_POOL_SIZE", "4"))
+POOL_MAX_TASKS_PER_WORKER = int(os.environ.get("SANDBOX_POOL_MAX_TASKS", "100"))
+
+def send_to_parent(conn, lock: threading.Lock, kind: str, payload):
+    # stdout/stderr 的 flush 定时器运行在其他线程，发送需要加锁
+    with lock:
+        conn.send((kind, payload))
+
+def dump_namespace(namespace: dict, path: str) -> dict:
+    """
+    把常驻 kernel 中可以 pickle 的变量写入 path，模块只记录名字，恢复时重新导入。
+    无法 pickle 的变量（代码中定义的函数和类、打开的文件等）被跳过，名字在 skipped 中返回。
+    """
+    variables, modules, skipped = {}, {}, []
+    for name, value in namespace.items():
+        if name.startswith("__"):
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            skipped.append(name)
+            continue
+        variables[name] = value
+    # 一次性 pickle 所有变量，保留变量之间共享的引用
+    with open(path, "wb") as f:
+        pickle.dump({"variables": variables, "modules": modules}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"variables": sorted(variables), "modules": modules, "skipped": sorted(skipped),
+            "size": os.path.getsize(path)}
+
+def load_namespace(namespace: dict, path: str) -> dict:
+    """Load variables written by dump_namespace into namespace and re-import its modules."""
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    skipped = []
+    for name, module in state["modules"].items():
+        try:
+            namespace[name] = importlib.import_module(module)
+        except ImportError:
+            skipped.append(name)
+    namespace.update(state["variables"])
+    return {"variables": sorted(state["variables"]), "modules": state["modules"], "skipped": sorted(skipped)}
+
+def python_worker_main(conn, persistent: bool = False):
+    """
+    Worker loop: run snippets received on the pipe until it is closed.
+    A persistent worker keeps one namespace for its whole lifetime.
+    """
+    sys.stdin.close()
+    namespace = {} if persistent else None
+    send_lock = threading.Lock()
+    # 预先触发 pyplot 的字体缓存、后端初始化，避免第一次请求承担这部分开销
+    plt.figure()
+    plt.close('all')
+    cwd = os.getcwd()
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, ConnectionError):
+            break
+        if task is None:
+            break
+        # 流式任务：输出分片以 (kind, data) 发回，管道写满时会阻塞在这里，形成背压
+        emit = functools.partial(send_to_parent, conn, send_lock) if task.get("stream") else None
         try:
-            result = subprocess.run(
-                ["node", "sandbox.js", temp_file_path, str(timeout)],
-                stdin=subprocess.DEVNULL,
-                capture_output=True,
-                text=True,
-                timeout=timeout
-            )
-            stdout = result.stdout
-            stderr = result.stderr
-
-            # Parse output
-            captured_output = ""
-            error = None
-            image_base64 = None
-            for line in stdout.splitlines():
-                if line.startswith('__OUTPUT__:'):
-                    captured_output = json.loads(line.replace('__OUTPUT__:', '')) or []
-                    captured_output = '\n'.join(captured_output)
-                elif line.startswith('__ERROR__:'):
-                    error = json.loads(line.replace('__ERROR__:', ''))
-                    error = f"{error['name']}: {error['message']}"
-
-            # Check for Plotly image
-            plot_path = "/tmp/plot.png"
-            if os.path.exists(plot_path):
-                with open(plot_path, "rb") as f:
-                    image_base64 = base64.b64encode(f.read()).decode('utf-8')
-                os.unlink(plot_path)
-
-            if result.returncode != 0 or error:
-                result_queue.put({"error": error or f"执行错误: {stderr}", "status_code": 400})
+            if "dump_namespace" in task or "load_namespace" in task:
+                # 快照只作用于常驻 kernel 的命名空间
+                try:
+                    if "dump_namespace" in task:
+                        result = dump_namespace(namespace or {}, task["dump_namespace"])
+                    else:
+                        result = load_namespace(namespace if namespace is not None else {}, task["load_namespace"])
+                except Exception as e:
+                    result = {"error": f"命名空间快照失败: {type(e).__name__}: {e}", "status_code": 500}
+            else:
+                result = execute_python_snippet(task["compiled"], namespace, emit, task.get("figures"),
+                                                task.get("spill"))
+            send_to_parent(conn, send_lock, "done", result)
+        finally:
+            # 清理上一次执行留下的全局状态，避免泄漏到下一个请求
+            os.chdir(cwd)
+            matplotlib.rcdefaults()
+
+class PythonWorker:
+    """A pre-forked interpreter connected to the parent by a duplex pipe."""
+
+    def __init__(self, persistent: bool = False):
+        parent_conn, child_conn = Pipe()
+        self.process = Process(target=python_worker_main, args=(child_conn, persistent))
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.tasks = 0
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self):
+        """Hard kill the worker; used for timeouts and recycling."""
+        try:
+            if self.process.is_alive():
+                self.process.kill()
+        finally:
+            # 不在这里 join，僵尸进程会在下一次 Process.start() 时被 multiprocessing 回收
+            self.conn.close()
+
+class PythonWorkerPool:
+    """
+    预先 fork 好、已导入 matplotlib 的 Python 解释器池。
+    请求优先使用空闲的热 worker；没有空闲 worker 时才同步 fork（cold start）。
+    worker 执行超过 max_tasks 次或超时被杀死后，会在后台补充新的 worker。
+    """
+
+    def __init__(self, size: int, max_tasks: int):
+        self.size = size
+        self.max_tasks = max_tasks
+        self._idle = deque()
+        self._live = 0
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._closed = False
+        self.stats = {"pool_hits": 0, "cold_starts": 0, "recycled": 0, "killed": 0}
+
+    def start(self):
+        self._closed = False
+        self._refill()
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for worker in idle:
+            worker.kill()
+
+    def try_acquire(self) -> Optional[PythonWorker]:
+        """Take an idle warm worker, or return None if the pool is empty."""
+        with self._lock:
+            while self._idle:
+                worker = self._idle.popleft()
+                if worker.is_alive():
+                    self.stats["pool_hits"] += 1
+                    return worker
+                self._live -= 1
+                worker.kill()
+        return None
+
+    def cold_start(self) -> PythonWorker:
+        """Fork a worker synchronously because no warm one was available."""
+        with self._lock:
+            self.stats["cold_starts"] += 1
+            self._live += 1
+        return PythonWorker()
+
+    def acquire(self) -> PythonWorker:
+        return self.try_acquire() or self.cold_start()
+
+    def release(self, worker: PythonWorker, healthy: bool):
+        """Return a worker after a task; unhealthy or worn-out workers are replaced."""
+        worker.tasks += 1
+        with self._lock:
+            if healthy and worker.is_alive() and worker.tasks < self.max_tasks \
+                    and len(self._idle) < self.size and not self._closed:
+                self._idle.append(worker)
+                return
+            self._live -= 1
+            self.stats["killed" if not healthy else "recycled"] += 1
+        worker.kill()
+        self._schedule_refill()
+
+    def _schedule_refill(self):
+        with self._lock:
+            if self._refilling or self._closed or self._live >= self.size:
                 return
+            self._refilling = True
+        threading.Thread(target=self._refill, daemon=True).start()
 
-            result_queue.put({
-                "result": None,
-                "output": captured_output,
-                "image": image_base64
-            })
+    def _refill(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._closed or self._live >= self.size:
+                        return
+                    self._live += 1
+                worker = PythonWorker()
+                with self._lock:
+                    self._idle.append(worker)
         finally:
-            pass
-            # os.unlink(temp_file_path)  # Clean up temporary file
-    except subprocess.TimeoutExpired:
-        result_queue.put({"error": "代码执行超时", "status_code": 408})
+            with self._lock:
+                self._refilling = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "idle": len(self._idle), "live": self._live,
+                    "max_tasks_per_worker": self.max_tasks, **self.stats}
+
+python_pool = PythonWorkerPool(POOL_SIZE, POOL_MAX_TASKS_PER_WORKER)
+
+@app.on_event("startup")
+def start_python_pool():
+    python_pool.start()
+
+@app.on_event("shutdown")
+def stop_python_pool():
+    python_pool.shutdown()
+
+###############################
+#    Node.js Worker Pool      #
+###############################
+
+NODE_POOL_SIZE = int(os.environ.get("SANDBOX_NODE_POOL_SIZE", "2"))
+NODE_POOL_MAX_TASKS_PER_WORKER = int(os.environ.get("SANDBOX_NODE_POOL_MAX_TASKS", "200"))
+NODE_SANDBOX_JS = Path(__file__).with_name("sandbox.js")
+NODE_RESULT_PREFIX = b"__RESULT__:"
+NODE_FRAME_LIMIT = 64 * 1024 * 1024  # 单个结果帧的最大字节数
+
+class NodeWorker:
+    """A long-lived `node sandbox.js` process speaking the line-framed JSON protocol."""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.tasks = 0
+        self._next_id = 0
+
+    @classmethod
+    async def spawn(cls) -> "NodeWorker":
+        process = await asyncio.create_subprocess_exec(
+            "node", str(NODE_SANDBOX_JS),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=str(NODE_SANDBOX_JS.parent),
+            limit=NODE_FRAME_LIMIT,
+        )
+        return cls(process)
+
+    def is_alive(self) -> bool:
+        return self.process.returncode is None
+
+    async def run(self, code: str, timeout: float, on_event=None) -> dict:
+        """Run one job; with on_event, console output frames are streamed to it."""
+        self._next_id += 1
+        job_id = self._next_id
+        job = json.dumps({"id": job_id, "code": code, "timeout": timeout,
+                          "stream": on_event is not None}) + "\n"
+        self.process.stdin.write(job.encode("utf-8"))
+        await self.process.stdin.drain()
+        while True:
+            line = await self.process.stdout.readline()
+            if not line:
+                raise EOFError("node worker exited")
+            if not line.startswith(NODE_RESULT_PREFIX):
+                continue
+            frame = json.loads(line[len(NODE_RESULT_PREFIX):])
+            if frame.get("id") != job_id:
+                continue
+            if frame.get("type") == "stdout":
+                await on_event("stdout", frame["data"])
+                continue
+            return frame
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+
+class NodeWorkerPool:
+    """
+    常驻的 Node.js worker 池，替代每次请求 fork Python 子进程再启动 `node sandbox.js`。
+    代码通过 stdin 发送给 worker，每个任务在独立的 vm2 上下文中执行。
+    """
+
+    def __init__(self, size: int, max_tasks: int):
+        self.size = size
+        self.max_tasks = max_tasks
+        self._idle = deque()
+        self._live = 0
+        self._refill_task = None
+        self._closed = False
+        self.stats = {"pool_hits": 0, "cold_starts": 0, "recycled": 0, "killed": 0}
+
+    async def start(self):
+        self._closed = False
+        await self._refill()
+
+    async def shutdown(self):
+        self._closed = True
+        while self._idle:
+            worker = self._idle.popleft()
+            worker.kill()
+            await worker.process.wait()
+
+    async def acquire(self) -> NodeWorker:
+        while self._idle:
+            worker = self._idle.popleft()
+            if worker.is_alive():
+                self.stats["pool_hits"] += 1
+                return worker
+            self._live -= 1
+        self.stats["cold_starts"] += 1
+        self._live += 1
+        try:
+            return await NodeWorker.spawn()
+        except Exception:
+            self._live -= 1
+            raise
+
+    def release(self, worker: NodeWorker, healthy: bool):
+        worker.tasks += 1
+        if healthy and worker.is_alive() and worker.tasks < self.max_tasks \
+                and len(self._idle) < self.size and not self._closed:
+            self._idle.append(worker)
+            return
+        self._live -= 1
+        self.stats["killed" if not healthy else "recycled"] += 1
+        worker.kill()
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        while not self._closed and self._live < self.size:
+            self._live += 1
+            try:
+                worker = await NodeWorker.spawn()
+            except Exception as e:
+                self._live -= 1
+                print(f"Failed to start node worker due to {e}")
+                return
+            self._idle.append(worker)
+
+    def snapshot(self) -> dict:
+        return {"size": self.size, "idle": len(self._idle), "live": self._live,
+                "max_tasks_per_worker": self.max_tasks, **self.stats}
+
+node_pool = NodeWorkerPool(NODE_POOL_SIZE, NODE_POOL_MAX_TASKS_PER_WORKER)
+
+@app.on_event("startup")
+async def start_node_pool():
+    try:
+        await node_pool.start()
     except Exception as e:
-        result_queue.put({"error": f"执行错误: {str(e)}", "status_code": 400})
+        print(f"Failed to start node pool due to {e}")
+
+@app.on_event("shutdown")
+async def stop_node_pool():
+    await node_pool.shutdown()
+
+###############################
+#    Execution Supervisor     #
+###############################
+
+MAX_CONCURRENT_EXECUTIONS = int(os.environ.get("SANDBOX_MAX_CONCURRENT_EXECUTIONS", "8"))
+
+async def wait_readable(fd: int, timeout: float) -> bool:
+    """
+    在事件循环上等待 fd 可读（子进程写回结果或退出），不阻塞其他请求。
+    超时由 loop.call_later 定时器触发，返回 False。
+    """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
 
-async def run_in_process(code: str, timeout: float, language: str = "python"):
-    process = None
+    def finish(value: bool):
+        if not ready.done():
+            ready.set_result(value)
+
+    loop.add_reader(fd, finish, True)
+    timer = loop.call_later(timeout, finish, False)
     try:
-        result_queue = Queue()
-        if language == "python":
-            process = Process(target=execute_python_in_process, args=(code, result_queue))
+        return await ready
+    finally:
+        timer.cancel()
+        loop.remove_reader(fd)
+
+class ExecutionSupervisor:
+    """
+    asyncio 原生的执行调度器：通过 add_reader 等待 worker 的管道或进程 sentinel，
+    用事件循环定时器处理超时，并用信号量限制同时执行的代码数量。
+    """
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+        self.waiting = 0
+
+    async def run(self, code: str, timeout: float, language: str,
+                  sessionid: Optional[str] = None, persistent: bool = False, on_event=None,
+                  figures: Optional[dict] = None, spill: Optional[dict] = None) -> dict:
+        if language == "python" and persistent:
+            runner = functools.partial(kernel_manager.execute, sessionid)
+        elif language == "python":
+            runner = functools.partial(self._run_python, sessionid=sessionid)
         elif language == "javascript":
-            process = Process(target=execute_nodejs_in_process, args=(code, result_queue, timeout))
+            runner = functools.partial(self._run_nodejs, sessionid=sessionid)
         else:
             raise HTTPException(status_code=400, detail=f"不支持的语言: {language}")
 
-        process.start()
-        process.join(timeout)
+        timings = {}
+        if language == "python":
+            # 解析和编译在父进程完成并缓存，worker 只接收编译好的 code object
+            started = time.perf_counter()
+            try:
+                code = {"compiled": compile_cache.get(code), "figures": figures, "spill": spill}
+            except (SyntaxError, ValueError) as e:
+                executions_total.inc(language, "error")
+                raise HTTPException(status_code=400, detail=f"语法错误: {str(e)}")
+            timings["compile"] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        timings["queue"] = time.perf_counter() - started
+        self.running += 1
+        outcome = "failed"
+        try:
+            result = await runner(code, timeout, on_event)
+            timings.update(result.pop("timings", {}))
+            outcome = "error" if "error" in result else "ok"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            self.running -= 1
+            self._slots.release()
+            record_execution(language, timings, outcome)
 
-        if process.is_alive():
-            process.terminate()
-            time.sleep(0.1)
-            if process.is_alive():
-                process.kill()
-            raise asyncio.TimeoutError
+        if "error" in result:
+            raise HTTPException(status_code=result["status_code"], detail=result["error"])
+        result["timings"] = timings
+        return result
 
-        if not result_queue.empty():
-            result = result_queue.get()
-            if "error" in result:
-                raise HTTPException(status_code=result["status_code"], detail=result["error"])
+    async def _run_python(self, task: dict, timeout: float, on_event=None, sessionid: Optional[str] = None) -> dict:
+        started = time.perf_counter()
+        worker = python_pool.try_acquire() or await asyncio.to_thread(python_pool.cold_start)
+        acquired = time.perf_counter() - started
+        process_tracker.attach(sessionid, worker.process.pid)
+        healthy = False
+        try:
+            result = await run_on_worker(worker, task, timeout, on_event)
+            healthy = True
+            result.setdefault("timings", {})["acquire"] = acquired
             return result
-        else:
+        finally:
+            process_tracker.detach(sessionid, worker.process.pid)
+            python_pool.release(worker, healthy)
+
+    async def _run_nodejs(self, code: str, timeout: float, on_event=None, sessionid: Optional[str] = None) -> dict:
+        started = time.perf_counter()
+        worker = await node_pool.acquire()
+        acquired = time.perf_counter()
+        process_tracker.attach(sessionid, worker.process.pid)
+        healthy = False
+        try:
+            # vm2 自身会在 timeout 后中断同步代码，这里再留一点余量做硬超时
+            frame = await asyncio.wait_for(worker.run(code, timeout, on_event), timeout + 1)
+            healthy = True
+        except (EOFError, ConnectionError):
             raise HTTPException(status_code=500, detail="服务器内部错误: 无结果返回")
+        finally:
+            process_tracker.detach(sessionid, worker.process.pid)
+            node_pool.release(worker, healthy)
+
+        # Node.js 的 exec 包含与 worker 之间的管道传输
+        timings = {"acquire": acquired - started, "exec": time.perf_counter() - acquired}
+        error = frame.get("error")
+        if error:
+            return {"error": f"{error['name']}: {error['message']}", "status_code": 400, "timings": timings}
+        return {
+            "result": None,
+            "output": '\n'.join(frame.get("output") or []),
+            "image": frame.get("image"),
+            "timings": timings,
+        }
+
+    def snapshot(self) -> dict:
+        return {"max_concurrent": self.max_concurrent, "running": self.running, "waiting": self.waiting}
+
+async def run_on_worker(worker: PythonWorker, task: dict, timeout: float, on_event=None) -> dict:
+    """
+    Send one snippet to a worker and wait for its reply on the event loop.
+    With on_event, output chunks are streamed to it; the pipe is not read
+    while on_event is blocked, which pushes back on the worker.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    started = time.perf_counter()
+    try:
+        worker.conn.send({**task, "stream": on_event is not None})
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0 or not await wait_readable(worker.conn.fileno(), remaining):
+                raise asyncio.TimeoutError
+            kind, payload = worker.conn.recv()
+            if kind == "done":
+                # worker 内部的耗时之外都算作管道传输（包括序列化和流式输出时的背压）
+                timings = payload.get("timings")
+                if timings is not None:
+                    timings["transfer"] = max(0.0, time.perf_counter() - started - sum(timings.values()))
+                return payload
+            if on_event is not None:
+                await on_event(kind, payload)
+    except (EOFError, ConnectionError):
+        raise HTTPException(status_code=500, detail="服务器内部错误: 无结果返回")
+
+supervisor = ExecutionSupervisor(MAX_CONCURRENT_EXECUTIONS)
+
+###############################
+#    Session Kernels          #
+###############################
+
+KERNEL_IDLE_TTL = float(os.environ.get("SANDBOX_KERNEL_IDLE_TTL", "900"))  # 秒
+KERNEL_MAX_RSS = int(os.environ.get("SANDBOX_KERNEL_MAX_RSS", str(256 * 1024 * 1024)))  # 字节
+KERNEL_REAP_INTERVAL = float(os.environ.get("SANDBOX_KERNEL_REAP_INTERVAL", "30"))
+
+class SessionKernel:
+    """A long-lived persistent worker owned by one session."""
+
+    def __init__(self, sessionid: str):
+        self.sessionid = sessionid
+        self.worker = PythonWorker(persistent=True)
+        self.lock = asyncio.Lock()
+        self.started_at = time.time()
+        self.last_used = self.started_at
+        self.executions = 0
+
+    def rss(self) -> int:
+        try:
+            return psutil.Process(self.worker.process.pid).memory_info().rss
+        except psutil.Error:
+            return 0
+
+    def describe(self) -> dict:
+        return {
+            "sessionid": self.sessionid,
+            "pid": self.worker.process.pid,
+            "alive": self.worker.is_alive(),
+            "executions": self.executions,
+            "rss": self.rss(),
+            "started_at": self.started_at,
+            "last_used": self.last_used,
+        }
+
+class KernelManager:
+    """
+    管理每个 session 的常驻 Python kernel。
+    kernel 在空闲超过 idle_ttl 或内存超过 max_rss 后被回收，超时的 kernel 会被直接杀掉。
+    """
+
+    def __init__(self, idle_ttl: float, max_rss: int):
+        self.idle_ttl = idle_ttl
+        self.max_rss = max_rss
+        self.kernels = {}
+        self.stats = {"started": 0, "evicted_idle": 0, "evicted_memory": 0, "killed": 0, "reset": 0}
+
+    async def get_or_start(self, sessionid: str) -> SessionKernel:
+        kernel = self.kernels.get(sessionid)
+        if kernel and kernel.worker.is_alive():
+            return kernel
+        kernel = await asyncio.to_thread(SessionKernel, sessionid)
+        # to_thread 期间可能有并发请求已经创建了 kernel
+        if sessionid in self.kernels and self.kernels[sessionid].worker.is_alive():
+            kernel.worker.kill()
+            return self.kernels[sessionid]
+        self.kernels[sessionid] = kernel
+        process_tracker.attach(sessionid, kernel.worker.process.pid)
+        self.stats["started"] += 1
+        return kernel
+
+    async def execute(self, sessionid: str, task: dict, timeout: float, on_event=None) -> dict:
+        started = time.perf_counter()
+        kernel = await self.get_or_start(sessionid)
+        async with kernel.lock:
+            acquired = time.perf_counter() - started
+            healthy = False
+            try:
+                result = await run_on_worker(kernel.worker, task, timeout, on_event)
+                result.setdefault("timings", {})["acquire"] = acquired
+                healthy = True
+            finally:
+                kernel.executions += 1
+                kernel.last_used = time.time()
+                if not healthy:
+                    self.stats["killed"] += 1
+                    self.discard(sessionid, kernel)
+        if kernel.rss() > self.max_rss:
+            self.stats["evicted_memory"] += 1
+            self.discard(sessionid, kernel)
+        return result
+
+    async def call(self, sessionid: str, task: dict, timeout: float, start: bool = False) -> Optional[dict]:
+        """
+        Run a namespace task (dump_namespace / load_namespace) on the session's kernel.
+        Returns None when the session has no kernel and start is False.
+        """
+        kernel = self.kernels.get(sessionid)
+        if start:
+            kernel = await self.get_or_start(sessionid)
+        elif kernel is None or not kernel.worker.is_alive():
+            return None
+        async with kernel.lock:
+            healthy = False
+            try:
+                result = await run_on_worker(kernel.worker, task, timeout)
+                healthy = True
+            finally:
+                if not healthy:
+                    self.stats["killed"] += 1
+                    self.discard(sessionid, kernel)
+        if "error" in result:
+            raise HTTPException(status_code=result["status_code"], detail=result["error"])
+        return result
+
+    def discard(self, sessionid: str, kernel: Optional[SessionKernel] = None) -> bool:
+        current = self.kernels.get(sessionid)
+        if current is None or (kernel is not None and current is not kernel):
+            return False
+        del self.kernels[sessionid]
+        process_tracker.detach(sessionid, current.worker.process.pid)
+        current.worker.kill()
+        return True
+
+    def reap(self):
+        now = time.time()
+        for sessionid, kernel in list(self.kernels.items()):
+            if kernel.lock.locked():
+                continue
+            if now - kernel.last_used > self.idle_ttl:
+                self.stats["evicted_idle"] += 1
+                self.discard(sessionid, kernel)
+            elif kernel.rss() > self.max_rss:
+                self.stats["evicted_memory"] += 1
+                self.discard(sessionid, kernel)
+            elif not kernel.worker.is_alive():
+                self.discard(sessionid, kernel)
+
+    async def reap_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.reap()
+            except Exception as e:
+                print(f"Failed to reap kernels due to {e}")
+
+    def shutdown(self):
+        for sessionid in list(self.kernels):
+            self.discard(sessionid)
+
+    def snapshot(self) -> dict:
+        return {"active": len(self.kernels), "idle_ttl": self.idle_ttl, "max_rss": self.max_rss, **self.stats}
+
+kernel_manager = KernelManager(KERNEL_IDLE_TTL, KERNEL_MAX_RSS)
+
+@app.on_event("startup")
+async def start_kernel_reaper():
+    asyncio.create_task(kernel_manager.reap_forever(KERNEL_REAP_INTERVAL))
+
+@app.on_event("shutdown")
+def stop_kernels():
+    kernel_manager.shutdown()
+
+@app.get("/{sessionid}/kernel")
+async def get_kernel(sessionid: str):
+    kernel = kernel_manager.kernels.get(sessionid)
+    if kernel is None:
+        raise HTTPException(status_code=404, detail="Kernel not found")
+    return kernel.describe()
+
+@app.post("/{sessionid}/kernel/reset")
+async def reset_kernel(sessionid: str):
+    if kernel_manager.discard(sessionid):
+        kernel_manager.stats["reset"] += 1
+        return {"message": f"Kernel for session {sessionid} reset"}
+    return {"message": f"No kernel running for session {sessionid}"}
+
+@app.get("/pool/stats")
+async def pool_stats():
+    return {**python_pool.snapshot(), "executions": supervisor.snapshot(),
+            "kernels": kernel_manager.snapshot(), "nodejs": node_pool.snapshot(),
+            "compile_cache": compile_cache.snapshot(), "jobs": job_queue.snapshot(),
+            "processes": process_tracker.snapshot()}
+
+async def run_in_process(code: str, timeout: float, language: str = "python",
+                         sessionid: Optional[str] = None, persistent: bool = False, on_event=None,
+                         figures: Optional[dict] = None, inline_images: bool = False):
+    """
+    Run code and publish its figures. The result carries "timings": milliseconds spent in each
+    stage, which are also recorded in the /metrics histograms.
+    """
+    figures = {**default_figure_options(sessionid), **(figures or {})}
+    spill = default_spill_options(sessionid)
+    result = await supervisor.run(code, timeout, language, sessionid, persistent, on_event, figures, spill)
+    started = time.perf_counter()
+    result = await publish_figures(result, sessionid, figures, spill, inline_images)
+    timings = result.pop("timings")
+    timings["publish"] = time.perf_counter() - started
+    execution_stage_seconds.observe(timings["publish"], language, "publish")
+    result["timings"] = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+    return result
+
+STREAM_QUEUE_SIZE = int(os.environ.get("SANDBOX_STREAM_QUEUE_SIZE", "64"))
+
+async def stream_execution(request: CodeRequest, language: str, sessionid: str):
+    """
+    以 NDJSON 的形式边执行边返回事件：stdout/stderr 分片、最终的 result 或 error。
+    事件队列有上限，客户端读得慢时会停止读取 worker 的管道，从而对 worker 形成背压。
+    """
+    events = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+
+    async def on_event(kind: str, data: str):
+        await events.put({"type": kind, "data": data})
+
+    async def produce():
+        try:
+            result = await run_in_process(request.code, request.timeout, language=language,
+                                          sessionid=sessionid, persistent=request.persistent,
+                                          on_event=on_event, figures=request_figure_options(request),
+                                          inline_images=request.inline_images)
+            await events.put({"type": "result", **result})
+        except asyncio.TimeoutError:
+            await events.put({"type": "error", "status_code": 408, "detail": "代码执行超时"})
+        except HTTPException as e:
+            await events.put({"type": "error", "status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            await events.put({"type": "error", "status_code": 500, "detail": f"服务器内部错误: {str(e)}"})
+        await events.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            yield json.dumps(event, ensure_ascii=False, default=str) + "\n"
     finally:
-        if process and process.is_alive():
-            process.terminate()
-            time.sleep(0.1)
-            if process.is_alive():
-                process.kill()
-            process.close()
+        # 客户端断开时取消执行，worker 会被当作不健康的 worker 回收
+        producer.cancel()
+
+def streaming_response(request: CodeRequest, language: str, sessionid: str) -> StreamingResponse:
+    return StreamingResponse(stream_execution(request, language, sessionid),
+                             media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.post("/{sessionid}/exec/python")
-async def execute_python(request: CodeRequest):
-    print(f'timeout is {request.timeout}')
+async def execute_python(sessionid: str, request: CodeRequest):
     try:
-        result = await run_in_process(request.code, request.timeout, language="python")
+        result = await run_in_process(request.code, request.timeout, language="python",
+                                      sessionid=sessionid, persistent=request.persistent,
+                                      figures=request_figure_options(request), inline_images=request.inline_images)
         return result
     except asyncio.TimeoutError:
         raise HTTPException(status_code=408, detail="代码执行超时")
@@ -272,15 +1863,568 @@ async def execute_python(request: CodeRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
 
+@app.post("/{sessionid}/exec/python/stream")
+async def execute_python_stream(sessionid: str, request: CodeRequest):
+    return streaming_response(request, "python", sessionid)
+
 @app.post("/{sessionid}/exec/nodejs")
-async def execute_nodejs(request: CodeRequest):
-    print(f'timeout is {request.timeout}')
+async def execute_nodejs(sessionid: str, request: CodeRequest):
     try:
-        result = await run_in_process(request.code, request.timeout, language="javascript")
+        result = await run_in_process(request.code, request.timeout, language="javascript",
+                                      sessionid=sessionid, inline_images=request.inline_images)
         return result
     except asyncio.TimeoutError:
         raise HTTPException(status_code=408, detail="代码执行超时")
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
+
+@app.post("/{sessionid}/exec/nodejs/stream")
+async def execute_nodejs_stream(sessionid: str, request: CodeRequest):
+    return streaming_response(request, "javascript", sessionid)
+
+###############################
+#    Batch Execution          #
+###############################
+
+BATCH_MAX_ITEMS = int(os.environ.get("SANDBOX_BATCH_MAX_ITEMS", "100"))
+BATCH_MAX_PARALLELISM = int(os.environ.get("SANDBOX_BATCH_MAX_PARALLELISM", str(POOL_SIZE)))
+BATCH_LANGUAGES = {"python": "python", "nodejs": "javascript"}
+
+class BatchItem(BaseModel):
+    code: str
+    language: Literal["python", "nodejs"] = "python"
+    timeout: int = 30
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    parallelism: Optional[int] = None  # 同时执行的条数，默认并且最多为 SANDBOX_BATCH_MAX_PARALLELISM
+    inline_images: bool = False
+
+def batch_parallelism(request: BatchRequest) -> int:
+    if not request.items or len(request.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"A batch must contain 1..{BATCH_MAX_ITEMS} items")
+    return max(1, min(request.parallelism or BATCH_MAX_PARALLELISM, BATCH_MAX_PARALLELISM))
+
+async def run_batch_item(index: int, item: BatchItem, sessionid: str, slots: asyncio.Semaphore,
+                         inline_images: bool) -> dict:
+    """Run one batch item; failures become an error entry instead of failing the whole batch."""
+    async with slots:
+        try:
+            result = await run_in_process(item.code, item.timeout, language=BATCH_LANGUAGES[item.language],
+                                          sessionid=sessionid, inline_images=inline_images)
+            return {"index": index, "type": "result", **result}
+        except asyncio.TimeoutError:
+            return {"index": index, "type": "error", "status_code": 408, "detail": "代码执行超时"}
+        except HTTPException as e:
+            return {"index": index, "type": "error", "status_code": e.status_code, "detail": e.detail}
+        except Exception as e:
+            return {"index": index, "type": "error", "status_code": 500, "detail": f"服务器内部错误: {str(e)}"}
+
+def start_batch(request: BatchRequest, sessionid: str) -> list:
+    slots = asyncio.Semaphore(batch_parallelism(request))
+    return [asyncio.create_task(run_batch_item(index, item, sessionid, slots, request.inline_images))
+            for index, item in enumerate(request.items)]
+
+@app.post("/{sessionid}/exec/batch")
+async def execute_batch(sessionid: str, request: BatchRequest):
+    """
+    并发执行一组代码片段（Python 和/或 Node.js），同时执行的条数受 parallelism 限制，
+    结果按提交的顺序返回，单条失败不影响其他条目。
+    """
+    tasks = start_batch(request, sessionid)
+    try:
+        return {"results": await asyncio.gather(*tasks)}
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def stream_batch(tasks: list):
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield json.dumps(await next_done, ensure_ascii=False, default=str) + "\n"
+    finally:
+        # 客户端断开时取消尚未完成的条目
+        for task in tasks:
+            task.cancel()
+
+@app.post("/{sessionid}/exec/batch/stream")
+async def execute_batch_stream(sessionid: str, request: BatchRequest):
+    """与 /exec/batch 相同，但每条完成后立即以一行 NDJSON 返回，通过 index 对应到提交的条目。"""
+    tasks = start_batch(request, sessionid)
+    return StreamingResponse(stream_batch(tasks), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+###############################
+#    Job Queue                #
+###############################
+
+JOB_QUEUE_SIZE = int(os.environ.get("SANDBOX_JOB_QUEUE_SIZE", "64"))  # 排队中的任务总数上限
+JOB_MAX_PER_SESSION = int(os.environ.get("SANDBOX_JOB_MAX_PER_SESSION", "16"))  # 每个 session 排队中的任务上限
+JOB_WORKERS = int(os.environ.get("SANDBOX_JOB_WORKERS", str(MAX_CONCURRENT_EXECUTIONS)))  # 同时执行的任务数
+JOB_RESULT_TTL = float(os.environ.get("SANDBOX_JOB_RESULT_TTL", "600"))  # 完成的任务保留多久（秒）
+JOB_PRIORITIES = ("high", "normal", "low")
+
+class JobRequest(CodeRequest):
+    language: Literal["python", "nodejs"] = "python"
+    priority: Literal["high", "normal", "low"] = "normal"
+
+class Job:
+    """A submitted execution and its streamed output, kept until JOB_RESULT_TTL after it finishes."""
+
+    def __init__(self, sessionid: str, request: JobRequest):
+        self.job_id = uuid.uuid4().hex
+        self.sessionid = sessionid
+        self.request = request
+        self.status = "queued"
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stdout = []
+        self.stderr = []
+        self.output_chars = 0
+        self.output_truncated = False
+        self.result = None
+        self.error = None
+        self.task = None
+
+    def finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def describe(self, offset: int = 0) -> dict:
+        """offset 为已经读取的 stdout 字符数，只返回之后的部分，用于分页读取运行中的输出。"""
+        stdout = "".join(self.stdout)
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "language": self.request.language,
+            "priority": self.request.priority,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stdout": stdout[offset:],
+            "stderr": "".join(self.stderr),
+            "next_offset": len(stdout),
+            "output_truncated": self.output_truncated,
+            "result": self.result,
+            "error": self.error,
+        }
+
+class JobQueue:
+    """
+    有上限的任务队列。按优先级调度，同一优先级内在 session 之间轮转，
+    一个 session 提交的大量任务不会饿死其他 session；队列满时返回 429 和 Retry-After。
+    """
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_SIZE,
+                 max_per_session: int = JOB_MAX_PER_SESSION):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_session = max_per_session
+        self.queues = {priority: OrderedDict() for priority in JOB_PRIORITIES}  # priority -> sessionid -> deque
+        self.queued = 0
+        self.queued_per_session = defaultdict(int)
+        self.jobs = {}  # job_id -> Job
+        self.latest = {}  # sessionid -> 最近提交的 job_id
+        self.ready = None
+        self.tasks = []
+        self.average_duration = 1.0  # 任务耗时的指数移动平均，用于估算 Retry-After
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "cancelled": 0, "expired": 0}
+
+    def start(self):
+        self.ready = asyncio.Condition()
+        self.tasks = [asyncio.create_task(self.run_forever()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self.expire_forever()))
+
+    def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+
+    def retry_after(self) -> int:
+        return max(1, min(60, round(self.queued * self.average_duration / self.workers)))
+
+    async def submit(self, sessionid: str, request: JobRequest) -> Job:
+        if self.queued >= self.max_queued or self.queued_per_session[sessionid] >= self.max_per_session:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=429, detail="任务队列已满",
+                                headers={"Retry-After": str(self.retry_after())})
+        job = Job(sessionid, request)
+        self.jobs[job.job_id] = job
+        self.latest[sessionid] = job.job_id
+        self.queues[request.priority].setdefault(sessionid, deque()).append(job)
+        self.queued += 1
+        self.queued_per_session[sessionid] += 1
+        self.stats["submitted"] += 1
+        async with self.ready:
+            self.ready.notify()
+        return job
+
+    def dequeue(self, job: Job):
+        self.queued -= 1
+        self.queued_per_session[job.sessionid] -= 1
+        if not self.queued_per_session[job.sessionid]:
+            del self.queued_per_session[job.sessionid]
+
+    def next_job(self) -> Optional[Job]:
+        for priority in JOB_PRIORITIES:
+            sessions = self.queues[priority]
+            if sessions:
+                sessionid, jobs = next(iter(sessions.items()))
+                job = jobs.popleft()
+                if jobs:
+                    sessions.move_to_end(sessionid)  # 轮转到下一个 session
+                else:
+                    del sessions[sessionid]
+                self.dequeue(job)
+                job.status = "starting"  # 已经出队，还没有开始执行
+                return job
+        return None
+
+    async def run_forever(self):
+        while True:
+            async with self.ready:
+                job = self.next_job()
+                while job is None:
+                    await self.ready.wait()
+                    job = self.next_job()
+            if job.status == "cancelled":
+                continue
+            job.task = asyncio.create_task(self.run(job))
+            # 用 wait 而不是直接 await，单个任务被取消时不会连带结束这个调度协程
+            await asyncio.wait([job.task])
+
+    async def run(self, job: Job):
+        async def on_event(kind: str, data: str):
+            # 任务的输出保存在内存中直到过期，超过 MAX_OUTPUT_CHARS 的部分丢弃
+            remaining = MAX_OUTPUT_CHARS - job.output_chars
+            if remaining <= 0:
+                job.output_truncated = True
+                return
+            if len(data) > remaining:
+                data, job.output_truncated = data[:remaining], True
+            job.output_chars += len(data)
+            (job.stdout if kind == "stdout" else job.stderr).append(data)
+
+        job.status = "running"
+        job.started_at = time.time()
+        request = job.request
+        try:
+            job.result = await run_in_process(request.code, request.timeout,
+                                              language=BATCH_LANGUAGES[request.language], sessionid=job.sessionid,
+                                              persistent=request.persistent and request.language == "python",
+                                              on_event=on_event, figures=request_figure_options(request),
+                                              inline_images=request.inline_images)
+            job.status = "done"
+            self.stats["completed"] += 1
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            self.stats["cancelled"] += 1
+            raise
+        except asyncio.TimeoutError:
+            job.status, job.error = "failed", {"status_code": 408, "detail": "代码执行超时"}
+            self.stats["failed"] += 1
+        except HTTPException as e:
+            job.status, job.error = "failed", {"status_code": e.status_code, "detail": e.detail}
+            self.stats["failed"] += 1
+        except Exception as e:
+            job.status, job.error = "failed", {"status_code": 500, "detail": f"服务器内部错误: {str(e)}"}
+            self.stats["failed"] += 1
+        finally:
+            job.finished_at = time.time()
+            self.average_duration = 0.8 * self.average_duration + 0.2 * (job.finished_at - job.started_at)
+
+    def cancel(self, job: Job):
+        if job.status == "queued":
+            self.queues[job.request.priority][job.sessionid].remove(job)
+            if not self.queues[job.request.priority][job.sessionid]:
+                del self.queues[job.request.priority][job.sessionid]
+            self.dequeue(job)
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            self.stats["cancelled"] += 1
+        elif job.status == "starting":
+            # 已经出队但 run 还没有开始，直接标记为取消；任务还没有创建时由 run_forever 跳过
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            self.stats["cancelled"] += 1
+            if job.task is not None:
+                job.task.cancel()
+        elif job.status == "running" and job.task is not None:
+            # 取消执行，worker 会被当作不健康的 worker 回收
+            job.task.cancel()
+
+    def expire(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished() and now - job.finished_at > JOB_RESULT_TTL:
+                del self.jobs[job_id]
+                if self.latest.get(job.sessionid) == job_id:
+                    del self.latest[job.sessionid]
+                self.stats["expired"] += 1
+
+    async def expire_forever(self):
+        while True:
+            await asyncio.sleep(min(JOB_RESULT_TTL, 30))
+            self.expire()
+
+    def get(self, sessionid: str, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None or job.sessionid != sessionid:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return job
+
+    def snapshot(self) -> dict:
+        return {"queued": self.queued, "running": sum(1 for job in self.jobs.values() if job.status == "running"),
+                "retained": len(self.jobs), "average_duration": round(self.average_duration, 3), **self.stats}
+
+job_queue = JobQueue()
+
+@app.on_event("startup")
+async def start_job_queue():
+    job_queue.start()
+
+@app.on_event("shutdown")
+def stop_job_queue():
+    job_queue.shutdown()
+
+@app.post("/{sessionid}/jobs", status_code=202)
+async def submit_job(sessionid: str, request: JobRequest):
+    """提交一个异步执行的任务，立即返回 job_id，之后通过 GET 轮询状态和输出。"""
+    job = await job_queue.submit(sessionid, request)
+    return {"job_id": job.job_id, "status": job.status, "queued": job_queue.queued}
+
+@app.get("/{sessionid}/jobs")
+async def list_jobs(sessionid: str):
+    return {"jobs": [{"job_id": job.job_id, "status": job.status, "submitted_at": job.submitted_at}
+                     for job in job_queue.jobs.values() if job.sessionid == sessionid]}
+
+@app.get("/{sessionid}/jobs/{job_id}")
+async def get_job(sessionid: str, job_id: str, offset: int = 0):
+    return job_queue.get(sessionid, job_id).describe(offset)
+
+@app.delete("/{sessionid}/jobs/{job_id}")
+async def cancel_job(sessionid: str, job_id: str):
+    job = job_queue.get(sessionid, job_id)
+    job_queue.cancel(job)
+    return {"job_id": job_id, "status": job.status}
+
+@app.get("/{sessionid}/result")
+async def get_result(sessionid: str, offset: int = 0):
+    """返回该 session 最近提交的任务的状态、已经产生的输出和结果。"""
+    job_id = job_queue.latest.get(sessionid)
+    if job_id is None:
+        raise HTTPException(status_code=404, detail="No job submitted for this session")
+    return job_queue.jobs[job_id].describe(offset)
+
+###############################
+#    Checkpoint               #
+###############################
+
+CHECKPOINTS_DIR = ".checkpoints"  # 快照的中间文件目录，位于文件区内以便 rename 是原子的
+CHECKPOINT_TIMEOUT = float(os.environ.get("SANDBOX_CHECKPOINT_TIMEOUT", "30"))  # 序列化/恢复命名空间的最长时间（秒）
+CHECKPOINT_MANIFEST = "manifest.json"
+CHECKPOINT_NAMESPACE = "namespace.pkl"
+CHECKPOINT_FILES_PREFIX = "files/"
+
+class CheckpointRequest(BaseModel):
+    base: Dict[str, str] = {}  # 上一次快照中的文件 -> sha256，内容相同的文件不再放进压缩包
+    namespace: bool = True  # 是否包含常驻 kernel 中可以 pickle 的变量
+
+def checkpoint_dir(sessionid: str) -> Path:
+    directory = session_dir(sessionid) / CHECKPOINTS_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+def iter_checkpoint(sessionid: str, names: list, manifest: dict, namespace_path: Optional[Path]):
+    paths = [resolve_file(sessionid, name) for name in names]
+    arcnames = [CHECKPOINT_FILES_PREFIX + name for name in names]
+    if namespace_path is not None:
+        paths.append(namespace_path)
+        arcnames.append(CHECKPOINT_NAMESPACE)
+    try:
+        documents = {CHECKPOINT_MANIFEST: json.dumps(manifest, ensure_ascii=False).encode("utf-8")}
+        yield from iter_zip(paths, zipfile.ZIP_DEFLATED, arcnames, documents)
+    finally:
+        if namespace_path is not None:
+            namespace_path.unlink(missing_ok=True)
+
+@app.post("/{sessionid}/checkpoint")
+async def create_checkpoint(sessionid: str, request: CheckpointRequest):
+    """
+    以 zip 流返回 session 的快照：manifest.json 列出文件区中所有文件的大小、mtime 和 sha256，
+    只有 sha256 与 base 不同的文件放在 files/ 下（增量），常驻 kernel 的变量放在 namespace.pkl 中。
+    """
+    entries = await file_index.sync(sessionid)
+    names = sorted(name for name, entry in entries.items() if request.base.get(name) != entry["sha256"])
+    namespace, namespace_path = None, None
+    if request.namespace and sessionid in kernel_manager.kernels:
+        path = checkpoint_dir(sessionid) / f"namespace-{uuid.uuid4().hex}.pkl"
+        try:
+            namespace = await kernel_manager.call(sessionid, {"dump_namespace": str(path)}, CHECKPOINT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail="序列化命名空间超时")
+        finally:
+            if namespace is None:
+                path.unlink(missing_ok=True)
+        # kernel 在检查之后被回收时 namespace 为 None
+        namespace_path = path if namespace is not None else None
+    manifest = {
+        "sessionid": sessionid,
+        "created_at": time.time(),
+        "files": [entries[name] for name in sorted(entries)],
+        "included": names,
+        "namespace": namespace,
+    }
+    return StreamingResponse(iter_checkpoint(sessionid, names, manifest, namespace_path),
+                             media_type="application/zip",
+                             headers={"Content-Disposition": content_disposition(f"{sessionid}-checkpoint.zip"),
+                                      "X-Checkpoint-Files": str(len(entries)),
+                                      "X-Checkpoint-Included": str(len(names))})
+
+def extract_member(archive: zipfile.ZipFile, name: str, directory: Path) -> tuple:
+    """Extract one member into a temp file under directory, returning (path, sha256)."""
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".restore-")
+    digest = hashlib.sha256()
+    with os.fdopen(fd, "wb") as dest, archive.open(name) as src:
+        while chunk := src.read(UPLOAD_CHUNK_SIZE):
+            dest.write(chunk)
+            digest.update(chunk)
+    return Path(temp_name), digest.hexdigest()
+
+def apply_checkpoint(sessionid: str, archive_path: Path, entries: dict, prune: bool) -> dict:
+    """
+    把快照中的文件写入文件区。压缩包中没有的文件必须已经存在且 sha256 一致（增量恢复），
+    prune 时删除快照中没有的文件。返回 manifest 和解压出的命名空间文件。
+    """
+    directory = checkpoint_dir(sessionid)
+    with zipfile.ZipFile(archive_path) as archive:
+        try:
+            manifest = json.loads(archive.read(CHECKPOINT_MANIFEST))
+        except KeyError:
+            raise HTTPException(status_code=400, detail=f"Checkpoint has no {CHECKPOINT_MANIFEST}")
+        members = set(archive.namelist())
+        wanted = {entry["filename"]: entry for entry in manifest["files"]}
+        missing = [name for name, entry in wanted.items()
+                   if CHECKPOINT_FILES_PREFIX + name not in members
+                   and (entries.get(name) or {}).get("sha256") != entry["sha256"]]
+        if missing:
+            raise HTTPException(status_code=409, detail=f"Checkpoint is missing files: {missing[:10]}")
+        restored = []
+        for name, entry in wanted.items():
+            member = CHECKPOINT_FILES_PREFIX + name
+            if member not in members:
+                continue
+            file_path = resolve_file(sessionid, name)
+            temp_path, sha256 = extract_member(archive, member, directory)
+            if sha256 != entry["sha256"]:
+                temp_path.unlink(missing_ok=True)
+                raise HTTPException(status_code=400, detail=f"Checksum mismatch for {name}")
+            # 恢复原来的 mtime，文件索引可以直接使用 manifest 中的条目
+            os.utime(temp_path, (entry["mtime"], entry["mtime"]))
+            os.replace(temp_path, file_path)
+            restored.append(name)
+        deleted = []
+        if prune:
+            for name in entries:
+                if name not in wanted:
+                    resolve_file(sessionid, name).unlink(missing_ok=True)
+                    deleted.append(name)
+        namespace_path = None
+        if CHECKPOINT_NAMESPACE in members:
+            namespace_path, _ = extract_member(archive, CHECKPOINT_NAMESPACE, directory)
+    return {"manifest": manifest, "restored": restored, "deleted": deleted, "namespace_path": namespace_path}
+
+@app.post("/{sessionid}/checkpoint/restore")
+async def restore_checkpoint(sessionid: str, request: Request, prune: bool = True):
+    """
+    从 /checkpoint 生成的压缩包恢复 session：写入文件区中的文件，
+    有 namespace.pkl 时把变量加载到常驻 kernel（没有时启动一个）。请求体大小不超过 SANDBOX_MAX_UPLOAD_SIZE。
+    """
+    started = time.perf_counter()
+    entries = await file_index.sync(sessionid)
+    fd, temp_name = tempfile.mkstemp(dir=checkpoint_dir(sessionid), prefix=".upload-", suffix=".zip")
+    archive_path = Path(temp_name)
+    namespace_path = None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            size = await write_stream(request.stream(), f, 0, MAX_UPLOAD_SIZE)
+        try:
+            applied = await asyncio.to_thread(apply_checkpoint, sessionid, archive_path, entries, prune)
+        except (zipfile.BadZipFile, ValueError, KeyError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid checkpoint: {e}")
+        namespace_path = applied["namespace_path"]
+        await file_index.sync(sessionid)
+        namespace = None
+        if namespace_path is not None:
+            try:
+                namespace = await kernel_manager.call(sessionid, {"load_namespace": str(namespace_path)},
+                                                      CHECKPOINT_TIMEOUT, start=True)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="恢复命名空间超时")
+    finally:
+        archive_path.unlink(missing_ok=True)
+        if namespace_path is not None:
+            namespace_path.unlink(missing_ok=True)
+    return {
+        "sessionid": sessionid,
+        "files": len(applied["manifest"]["files"]),
+        "restored": len(applied["restored"]),
+        "deleted": applied["deleted"],
+        "size": size,
+        "namespace": namespace,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+###############################
+#    Observability            #
+###############################
+
+PROFILE_ENABLED = os.environ.get("SANDBOX_PROFILE_ENABLED", "0") == "1"  # py-spy 需要 SYS_PTRACE 权限，默认关闭
+PROFILE_MAX_DURATION = int(os.environ.get("SANDBOX_PROFILE_MAX_DURATION", "60"))  # 单次采样的最长秒数
+
+def collect_gauges() -> list:
+    pool, nodejs = python_pool.snapshot(), node_pool.snapshot()
+    executions, kernels = supervisor.snapshot(), kernel_manager.snapshot()
+    cache, jobs = compile_cache.snapshot(), job_queue.snapshot()
+    return [
+        ("sandbox_python_pool_idle_workers", "Idle pre-forked Python workers.", "gauge", pool["idle"]),
+        ("sandbox_python_pool_live_workers", "Live Python workers, idle or busy.", "gauge", pool["live"]),
+        ("sandbox_python_pool_hits_total", "Executions served by a warm Python worker.", "counter", pool["pool_hits"]),
+        ("sandbox_python_pool_cold_starts_total", "Python workers forked on demand.", "counter", pool["cold_starts"]),
+        ("sandbox_python_pool_killed_total", "Python workers killed after a timeout or failure.", "counter",
+         pool["killed"]),
+        ("sandbox_node_pool_idle_workers", "Idle Node.js workers.", "gauge", nodejs["idle"]),
+        ("sandbox_node_pool_cold_starts_total", "Node.js workers spawned on demand.", "counter",
+         nodejs["cold_starts"]),
+        ("sandbox_executions_running", "Executions currently running.", "gauge", executions["running"]),
+        ("sandbox_executions_waiting", "Executions waiting for a free slot.", "gauge", executions["waiting"]),
+        ("sandbox_kernels_active", "Live persistent session kernels.", "gauge", kernels["active"]),
+        ("sandbox_compile_cache_hits_total", "Compile cache hits.", "counter", cache["hits"]),
+        ("sandbox_compile_cache_misses_total", "Compile cache misses.", "counter", cache["misses"]),
+        ("sandbox_compile_cache_bytes", "Bytes of cached code objects.", "gauge", cache["bytes"]),
+        ("sandbox_jobs_queued", "Jobs waiting in the job queue.", "gauge", jobs["queued"]),
+        ("sandbox_jobs_running", "Jobs currently running.", "gauge", jobs["running"]),
+        ("sandbox_jobs_rejected_total", "Job submissions rejected because the queue was full.", "counter",
+         jobs["rejected"]),
+    ]
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的指标：执行各阶段的耗时直方图、执行结果计数和各个池的当前状态。"""
+    lines = []
+    for metric in (execution_stage_seconds, execution_seconds, executions_total):
+        lines += metric.render()
+    lines += render_gauges(collect_gauges())
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def profile(duration: int = Query(10, ge=1), rate: int = Query(100, ge=1, le=1000),
+                  format: Literal["flamegraph", "speedscope", "raw"] = "flamegraph", subprocesses: bool = True):
+    """
+    用 py-spy 对服务进程（默认包括 worker 子进程）采样 duration 秒，返回火焰图（svg）、
+    speedscope（json）或折叠栈（raw）。需要设置 SANDBOX_PROFILE_ENABLED=1。
+    """
+    if not PROFILE_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    data = await record_profile(os.getpid(), min(duration, PROFILE_MAX_DURATION), rate, format, subprocesses)
+    return Response(data, media_type=PROFILE_FORMATS[format])
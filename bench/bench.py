@@ -0,0 +1,284 @@
+"""
+sandbox（app.py）和 gateway（gateway.py）的端到端压测。
+
+默认在本地启动一个假 Kubernetes API server、app.py（5858 端口，gateway 把 pod 固定路由到这个端口）
+和 gateway.py，然后对每个目标（直连 sandbox / 经过 gateway）和每种负载按给定并发发请求，
+报告每个接口的吞吐和 p50/p95/p99 延迟。结果可以写成 JSON，并与之前的结果对比。
+
+    python bench/bench.py --concurrency 8 --requests 200 --output before.json
+    python bench/bench.py --concurrency 8 --requests 200 --compare before.json
+
+已经在运行的服务可以用 --sandbox-url / --gateway-url 指定，此时不会在本地启动。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import fake_k8s  # noqa: E402
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SANDBOX_PORT = 5858  # gateway 总是把请求转发到 pod IP 的 5858 端口
+
+PLOT_CODE = """
+import matplotlib.pyplot as plt
+plt.plot(range(100), [i * i for i in range(100)])
+_ = plt.title("bench")
+"""
+
+# 每种负载：方法、路径（{sid} 替换为 sessionid）和请求参数
+SCENARIOS = {
+    "trivial": ("POST", "/{sid}/exec/python", lambda: {"json": {"code": "1 + 1"}}),
+    "cpu": ("POST", "/{sid}/exec/python", lambda: {"json": {"code": "sum(i * i for i in range(300000))"}}),
+    "plot": ("POST", "/{sid}/exec/python", lambda: {"json": {"code": PLOT_CODE}}),
+    "large_output": ("POST", "/{sid}/exec/python", lambda: {"json": {"code": "print('x' * 1024 * 1024)"}}),
+    "upload": ("POST", "/{sid}/files/upload",
+               lambda: {"files": {"file": (f"bench-{uuid.uuid4().hex}.bin", os.urandom(256 * 1024))}}),
+    "nodejs": ("POST", "/{sid}/exec/nodejs", lambda: {"json": {"code": "console.log(1 + 1)"}}),
+}
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, round(q / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+def summarize(latencies: list, errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 2)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1]) if latencies else 0.0,
+        },
+    }
+
+async def run_scenario(client: httpx.AsyncClient, base_url: str, scenario: str, requests: int,
+                       concurrency: int, warmup: int, sessions: int) -> dict:
+    """
+    以 concurrency 个并发的虚拟用户发送 requests 个请求，每个用户使用 sessions 个 sessionid 中的一个。
+    非 2xx 的响应和连接错误计入 errors，不计入延迟分布。
+    """
+    method, path, make_kwargs = SCENARIOS[scenario]
+    remaining = iter(range(requests))
+    latencies = []
+    errors = []
+
+    async def send(sessionid: str):
+        url = base_url + path.format(sid=sessionid)
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **make_kwargs())
+            if response.is_success:
+                return time.perf_counter() - started, None
+            return None, f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            return None, type(e).__name__
+
+    async def user(index: int):
+        # 各负载共用同一组 session，经过 gateway 时只在第一种负载中创建 pod
+        sessionid = f"bench-{index % sessions}"
+        for _ in range(warmup):
+            await send(sessionid)
+        for _ in remaining:
+            latency, error = await send(sessionid)
+            if error is None:
+                latencies.append(latency)
+            else:
+                errors.append(error)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(index) for index in range(concurrency)))
+    result = summarize(latencies, len(errors), time.perf_counter() - started)
+    result["endpoint"] = f"{method} {path}"
+    if errors:
+        result["error_samples"] = sorted(set(errors))[:5]
+    return result
+
+async def fetch_json(client: httpx.AsyncClient, url: str) -> dict:
+    try:
+        response = await client.get(url)
+        return response.json() if response.is_success else {"status_code": response.status_code}
+    except httpx.HTTPError as e:
+        return {"error": type(e).__name__}
+
+async def run_benchmark(targets: dict, args) -> dict:
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        for target, base_url in targets.items():
+            for scenario in args.scenarios:
+                result = await run_scenario(client, base_url, scenario, args.requests, args.concurrency,
+                                            args.warmup, args.sessions)
+                results.append({"target": target, "scenario": scenario, **result})
+                print_row(results[-1])
+        stats = {}
+        if "sandbox" in targets:
+            stats["sandbox"] = await fetch_json(client, targets["sandbox"] + "/pool/stats")
+        if "gateway" in targets:
+            stats["gateway"] = {name: await fetch_json(client, targets["gateway"] + f"/cluster/{name}")
+                                for name in ("proxy", "placements", "warm-pool")}
+    return {"results": results, "stats": stats}
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+###############################
+#    Local Services           #
+###############################
+
+def start_service(module: str, port: int, env: dict, log_dir: Path) -> subprocess.Popen:
+    log = open(log_dir / f"{module}.log", "w")
+    return subprocess.Popen([sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1",
+                             "--port", str(port), "--log-level", "warning"],
+                            cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).is_success:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+def start_local_services(args, work_dir: Path) -> tuple:
+    """Start the fake cluster, app.py and gateway.py; return the target urls and the processes to stop."""
+    targets, processes = {}, []
+    env = {**os.environ, "SANDBOX_FILES_DIR": str(work_dir / "files")}
+    if not args.sandbox_url:
+        sandbox = start_service("app", SANDBOX_PORT, env, work_dir)
+        processes.append(sandbox)
+        wait_until_up(f"http://127.0.0.1:{SANDBOX_PORT}/pool/stats", sandbox)
+        if "sandbox" in args.targets:
+            targets["sandbox"] = f"http://127.0.0.1:{SANDBOX_PORT}"
+    if "gateway" in args.targets and not args.gateway_url:
+        cluster = fake_k8s.FakeCluster(nodes=args.nodes, pod_start_delay=args.pod_start_delay)
+        fake_k8s.serve(args.k8s_port, cluster)
+        kubeconfig = work_dir / "kubeconfig"
+        kubeconfig.write_text(fake_k8s.kubeconfig(f"http://127.0.0.1:{args.k8s_port}"))
+        # 不溢出到远端集群，所有 session 都放在假集群里
+        gateway_env = {**env, "KUBECONFIG": str(kubeconfig), "K8S_AKS_INGRESS_URL": ""}
+        gateway = start_service("gateway", args.gateway_port, gateway_env, work_dir)
+        processes.append(gateway)
+        wait_until_up(f"http://127.0.0.1:{args.gateway_port}/cluster/routes", gateway)
+        targets["gateway"] = f"http://127.0.0.1:{args.gateway_port}"
+    return targets, processes
+
+###############################
+#    Report                   #
+###############################
+
+def print_row(result: dict):
+    latency = result["latency_ms"]
+    print(f"{result['target']:<8} {result['scenario']:<13} {result['requests']:>6} {result['errors']:>6} "
+          f"{result['throughput']:>9.1f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f}")
+
+def print_header():
+    print(f"{'target':<8} {'scenario':<13} {'reqs':>6} {'errors':>6} {'req/s':>9} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+
+def compare(report: dict, baseline: dict):
+    """Print the change of throughput and latency percentiles against a previous report."""
+    previous = {(r["target"], r["scenario"]): r for r in baseline["results"]}
+    change = lambda new, old: f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+    print(f"\nCompared with {baseline.get('revision', 'baseline')} ({baseline.get('started_at', '')}):")
+    print(f"{'target':<8} {'scenario':<13} {'req/s':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for result in report["results"]:
+        old = previous.get((result["target"], result["scenario"]))
+        if old is None:
+            continue
+        latency, old_latency = result["latency_ms"], old["latency_ms"]
+        print(f"{result['target']:<8} {result['scenario']:<13} "
+              f"{change(result['throughput'], old['throughput']):>9} "
+              + " ".join(f"{change(latency[q], old_latency[q]):>9}" for q in ("p50", "p95", "p99")))
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the sandbox and gateway")
+    parser.add_argument("--targets", default="sandbox,gateway", help="sandbox、gateway，逗号分隔")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="逗号分隔：" + ",".join(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="每种负载的请求数")
+    parser.add_argument("--warmup", type=int, default=1, help="每个虚拟用户正式计时前的请求数")
+    parser.add_argument("--sessions", type=int, default=0, help="使用多少个 session，默认每个虚拟用户一个")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--sandbox-url", help="使用已经运行的 sandbox，不在本地启动")
+    parser.add_argument("--gateway-url", help="使用已经运行的 gateway，不在本地启动")
+    parser.add_argument("--gateway-port", type=int, default=8001)
+    parser.add_argument("--k8s-port", type=int, default=16443)
+    parser.add_argument("--nodes", type=int, default=3, help="假集群的节点数")
+    parser.add_argument("--pod-start-delay", type=float, default=0.5, help="假集群中 pod 从创建到 ready 的秒数")
+    parser.add_argument("--output", help="把结果写成 JSON")
+    parser.add_argument("--compare", help="与之前写出的 JSON 结果对比")
+    args = parser.parse_args()
+    args.targets = [target for target in args.targets.split(",") if target]
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    args.sessions = args.sessions or args.concurrency
+    unknown = set(args.scenarios) - set(SCENARIOS) or set(args.targets) - {"sandbox", "gateway"}
+    if unknown:
+        parser.error(f"unknown scenario or target: {', '.join(sorted(unknown))}")
+
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="sandbox-bench-") as work_dir:
+        try:
+            external = {"sandbox": args.sandbox_url, "gateway": args.gateway_url}
+            if all(external[target] for target in args.targets):
+                targets = {target: external[target].rstrip("/") for target in args.targets}
+            else:
+                targets, processes = start_local_services(args, Path(work_dir))
+                targets.update({target: url.rstrip("/") for target, url in external.items()
+                                if url and target in args.targets})
+            started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+            print_header()
+            report = {
+                "started_at": started_at,
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "config": {"targets": targets, "scenarios": args.scenarios, "concurrency": args.concurrency,
+                           "requests": args.requests, "warmup": args.warmup, "sessions": args.sessions},
+                **asyncio.run(run_benchmark(targets, args)),
+            }
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(report, json.loads(Path(args.compare).read_text()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+基准测试用的假 Kubernetes API server。
+
+只实现 gateway.py 用到的接口：node 的 list/watch、metrics.k8s.io 的节点用量，
+以及 pod 的 list/watch/get/create/patch/delete/deletecollection。创建的 pod 在 --pod-start-delay 秒后
+变成 Running/Ready，pod IP 固定为 --pod-ip，所有 session 都被路由到同一个本地运行的 app.py。
+节点用量 = 基础用量 + 节点上所有 pod 的 requests，pod 越多放置引擎看到的负载越高。
+
+    python bench/fake_k8s.py --port 6443 --nodes 3
+"""
+import argparse
+import copy
+import json
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+POD_PATH = re.compile(r"^/api/v1/namespaces/([^/]+)/pods(?:/([^/]+))?$")
+SELECTOR_TERM = re.compile(r"([\w./-]+)\s+in\s+\(([^)]*)\)|([\w./-]+)\s*(!=|==|=)\s*([^,]*)")
+
+def parse_quantity(value: str) -> float:
+    units = {"m": 1e-3, "Ki": 1024, "Mi": 1024 ** 2, "Gi": 1024 ** 3}
+    for suffix, factor in units.items():
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * factor
+    return float(value)
+
+def match_selector(labels: dict, selector: str) -> bool:
+    for term in SELECTOR_TERM.finditer(selector or ""):
+        if term.group(1):
+            values = {value.strip() for value in term.group(2).split(",")}
+            if labels.get(term.group(1)) not in values:
+                return False
+        elif term.group(4) == "!=":
+            if labels.get(term.group(3)) == term.group(5).strip():
+                return False
+        elif labels.get(term.group(3)) != term.group(5).strip():
+            return False
+    return True
+
+class FakeCluster:
+    """集群状态和事件日志。watch 按 resourceVersion 回放日志中之后的事件。"""
+
+    def __init__(self, nodes: int = 3, node_cpu: str = "8", node_memory: str = "32Gi",
+                 base_usage: float = 0.2, pod_start_delay: float = 0.5, pod_ip: str = "127.0.0.1"):
+        self.lock = threading.Condition()
+        self.version = 1
+        self.events = []  # (resourceVersion, kind, type, object)
+        self.nodes = {}
+        self.pods = {}  # (namespace, name) -> pod
+        self.base_usage = base_usage
+        self.pod_start_delay = pod_start_delay
+        self.pod_ip = pod_ip
+        self.stats = {"requests": 0, "pods_created": 0, "pods_deleted": 0, "conflicts": 0}
+        with self.lock:
+            for index in range(nodes):
+                name = f"fake-node-{index}"
+                self.nodes[name] = self.record("nodes", "ADDED", {
+                    "apiVersion": "v1", "kind": "Node",
+                    "metadata": {"name": name, "uid": str(uuid.uuid4()), "labels": {}},
+                    "status": {"capacity": {"cpu": node_cpu, "memory": node_memory},
+                               "allocatable": {"cpu": node_cpu, "memory": node_memory}},
+                })
+
+    def record(self, kind: str, event_type: str, obj: dict) -> dict:
+        """Bump the resourceVersion of obj and append the change to the event log; caller holds the lock."""
+        self.version += 1
+        obj["metadata"]["resourceVersion"] = str(self.version)
+        self.events.append((self.version, kind, event_type, copy.deepcopy(obj)))
+        self.lock.notify_all()
+        return obj
+
+    def node_metrics(self) -> dict:
+        with self.lock:
+            items = []
+            for index, (name, node) in enumerate(self.nodes.items()):
+                capacity = node["status"]["capacity"]
+                pods = [pod for pod in self.pods.values() if pod["spec"].get("nodeName") == name]
+                requests = [pod["spec"]["containers"][0].get("resources", {}).get("requests", {}) for pod in pods]
+                cpu = parse_quantity(capacity["cpu"]) * self.base_usage + sum(
+                    parse_quantity(request.get("cpu", "0")) for request in requests)
+                memory = parse_quantity(capacity["memory"]) * self.base_usage + sum(
+                    parse_quantity(request.get("memory", "0")) for request in requests)
+                items.append({"metadata": {"name": name}, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                              "window": "15s", "usage": {"cpu": f"{int(cpu * 1000)}m",
+                                                         "memory": f"{int(memory / 1024)}Ki"}})
+            return {"kind": "NodeMetricsList", "apiVersion": "metrics.k8s.io/v1beta1",
+                    "metadata": {}, "items": items}
+
+    def list(self, kind: str, namespace: str = None, selector: str = None) -> dict:
+        with self.lock:
+            if kind == "nodes":
+                items = list(self.nodes.values())
+            else:
+                items = [pod for (ns, _), pod in self.pods.items()
+                         if ns == namespace and match_selector(pod["metadata"].get("labels") or {}, selector)]
+            return {"apiVersion": "v1", "kind": "PodList" if kind == "pods" else "NodeList",
+                    "metadata": {"resourceVersion": str(self.version)}, "items": copy.deepcopy(items)}
+
+    def get_pod(self, namespace: str, name: str) -> tuple:
+        with self.lock:
+            pod = self.pods.get((namespace, name))
+            if pod is None:
+                return 404, status(404, "NotFound", f'pods "{name}" not found')
+            return 200, copy.deepcopy(pod)
+
+    def create_pod(self, namespace: str, body: dict) -> tuple:
+        name = body["metadata"]["name"]
+        with self.lock:
+            if (namespace, name) in self.pods:
+                self.stats["conflicts"] += 1
+                return 409, status(409, "AlreadyExists", f'pods "{name}" already exists')
+            # 优先放到 node affinity 指定的节点上，否则轮流放到各个节点上
+            node = preferred_node(body)
+            if node not in self.nodes:
+                node = list(self.nodes)[self.stats["pods_created"] % len(self.nodes)]
+            pod = copy.deepcopy(body)
+            pod.setdefault("apiVersion", "v1")
+            pod.setdefault("kind", "Pod")
+            pod["metadata"].update({"namespace": namespace, "uid": str(uuid.uuid4()),
+                                    "creationTimestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ")})
+            pod["spec"]["nodeName"] = node
+            pod["status"] = {"phase": "Pending"}
+            self.pods[(namespace, name)] = self.record("pods", "ADDED", pod)
+            self.stats["pods_created"] += 1
+        threading.Timer(self.pod_start_delay, self.start_pod, (namespace, name)).start()
+        return 201, copy.deepcopy(pod)
+
+    def start_pod(self, namespace: str, name: str):
+        with self.lock:
+            pod = self.pods.get((namespace, name))
+            if pod is None:
+                return
+            pod["status"] = {"phase": "Running", "podIP": self.pod_ip, "hostIP": self.pod_ip,
+                             "conditions": [{"type": "Ready", "status": "True"}]}
+            self.record("pods", "MODIFIED", pod)
+
+    def patch_pod(self, namespace: str, name: str, body: dict) -> tuple:
+        with self.lock:
+            pod = self.pods.get((namespace, name))
+            if pod is None:
+                return 404, status(404, "NotFound", f'pods "{name}" not found')
+            metadata = body.get("metadata", {})
+            expected = metadata.get("resourceVersion")
+            if expected and expected != pod["metadata"]["resourceVersion"]:
+                self.stats["conflicts"] += 1
+                return 409, status(409, "Conflict", "the object has been modified")
+            pod["metadata"].setdefault("labels", {}).update(metadata.get("labels", {}))
+            return 200, copy.deepcopy(self.record("pods", "MODIFIED", pod))
+
+    def delete_pods(self, namespace: str, name: str = None, selector: str = None) -> tuple:
+        with self.lock:
+            if name is not None:
+                keys = [(namespace, name)] if (namespace, name) in self.pods else []
+                if not keys:
+                    return 404, status(404, "NotFound", f'pods "{name}" not found')
+            else:
+                keys = [key for key, pod in self.pods.items()
+                        if key[0] == namespace and match_selector(pod["metadata"].get("labels") or {}, selector)]
+            deleted = []
+            for key in keys:
+                pod = self.pods.pop(key)
+                deleted.append(copy.deepcopy(self.record("pods", "DELETED", pod)))
+                self.stats["pods_deleted"] += 1
+        if name is not None:
+            return 200, deleted[0]
+        return 200, {"apiVersion": "v1", "kind": "PodList", "metadata": {}, "items": deleted}
+
+    def watch(self, kind: str, since: int, timeout: float, namespace: str = None, selector: str = None):
+        """Yield (type, object) for every event after resourceVersion since until timeout expires."""
+        deadline = time.monotonic() + timeout
+        position = 0
+        while True:
+            with self.lock:
+                while position < len(self.events) and self.events[position][0] <= since:
+                    position += 1
+                pending = self.events[position:]
+                position = len(self.events)
+                if not pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self.lock.wait(min(remaining, 1))
+                    continue
+            for version, event_kind, event_type, obj in pending:
+                since = version
+                if event_kind != kind:
+                    continue
+                if kind == "pods" and (obj["metadata"].get("namespace") != namespace or
+                                       not match_selector(obj["metadata"].get("labels") or {}, selector)):
+                    continue
+                yield event_type, obj
+
+def preferred_node(body: dict) -> Optional[str]:
+    """The first node named by a preferred metadata.name node affinity, as the gateway sets it."""
+    affinity = body.get("spec", {}).get("affinity", {}).get("nodeAffinity", {})
+    for term in affinity.get("preferredDuringSchedulingIgnoredDuringExecution", []):
+        for field in term.get("preference", {}).get("matchFields", []):
+            if field.get("key") == "metadata.name" and field.get("operator") == "In" and field.get("values"):
+                return field["values"][0]
+    return None
+
+def status(code: int, reason: str, message: str) -> dict:
+    return {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure",
+            "message": message, "reason": reason, "code": code}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # watch 的响应使用 chunked 编码，客户端才能逐个事件读取
+    cluster: FakeCluster = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def route(self):
+        self.cluster.stats["requests"] += 1
+        url = urllib.parse.urlsplit(self.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        match = POD_PATH.match(url.path)
+        return url.path, query, match
+
+    def stream_watch(self, kind: str, query: dict, namespace: str = None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = self.cluster.watch(kind, int(query.get("resourceVersion") or 0),
+                                    float(query.get("timeoutSeconds") or 300), namespace, query.get("labelSelector"))
+        try:
+            for event_type, obj in events:
+                line = json.dumps({"type": event_type, "object": obj}).encode() + b"\n"
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def do_GET(self):
+        path, query, match = self.route()
+        watching = query.get("watch") in ("true", "True", "1")
+        if path == "/api/v1/nodes":
+            if watching:
+                return self.stream_watch("nodes", query)
+            return self.send_json(200, self.cluster.list("nodes"))
+        if path == "/apis/metrics.k8s.io/v1beta1/nodes":
+            return self.send_json(200, self.cluster.node_metrics())
+        if match and match.group(2) is None:
+            if watching:
+                return self.stream_watch("pods", query, match.group(1))
+            return self.send_json(200, self.cluster.list("pods", match.group(1), query.get("labelSelector")))
+        if match:
+            return self.send_json(*self.cluster.get_pod(match.group(1), match.group(2)))
+        self.send_json(404, status(404, "NotFound", path))
+
+    def do_POST(self):
+        path, query, match = self.route()
+        if match and match.group(2) is None:
+            return self.send_json(*self.cluster.create_pod(match.group(1), self.read_body()))
+        self.send_json(404, status(404, "NotFound", path))
+
+    def do_PATCH(self):
+        path, query, match = self.route()
+        if match and match.group(2):
+            return self.send_json(*self.cluster.patch_pod(match.group(1), match.group(2), self.read_body()))
+        self.send_json(404, status(404, "NotFound", path))
+
+    def do_DELETE(self):
+        path, query, match = self.route()
+        if match:
+            self.read_body()
+            return self.send_json(*self.cluster.delete_pods(match.group(1), match.group(2),
+                                                            query.get("labelSelector")))
+        self.send_json(404, status(404, "NotFound", path))
+
+def kubeconfig(url: str) -> str:
+    """A kubeconfig for gateway.py that points the kubernetes client at the fake server."""
+    return (f"apiVersion: v1\nkind: Config\nclusters:\n- cluster: {{server: \"{url}\"}}\n  name: fake\n"
+            f"contexts:\n- context: {{cluster: fake, user: fake}}\n  name: fake\ncurrent-context: fake\n"
+            f"users:\n- name: fake\n  user: {{token: fake}}\n")
+
+def serve(port: int, cluster: FakeCluster, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Start the fake API server in a daemon thread and return it."""
+    handler = type("FakeClusterHandler", (Handler,), {"cluster": cluster})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Kubernetes API and metrics server for benchmarks")
+    parser.add_argument("--port", type=int, default=6443)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--node-cpu", default="8")
+    parser.add_argument("--node-memory", default="32Gi")
+    parser.add_argument("--base-usage", type=float, default=0.2, help="节点上 pod 之外的用量占容量的比例")
+    parser.add_argument("--pod-start-delay", type=float, default=0.5)
+    parser.add_argument("--pod-ip", default="127.0.0.1")
+    parser.add_argument("--kubeconfig", help="把指向该 server 的 kubeconfig 写到这个路径")
+    args = parser.parse_args()
+    cluster = FakeCluster(args.nodes, args.node_cpu, args.node_memory, args.base_usage,
+                          args.pod_start_delay, args.pod_ip)
+    server = serve(args.port, cluster)
+    if args.kubeconfig:
+        with open(args.kubeconfig, "w") as f:
+            f.write(kubeconfig(f"http://127.0.0.1:{args.port}"))
+    print(f"Fake Kubernetes API listening on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
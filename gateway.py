@@ -1,10 +1,28 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 import httpx
 import asyncio
-from kubernetes import client, config
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict, defaultdict, deque
+from typing import Optional, Literal, List, Dict, Any
+from abc import ABC, abstractmethod
+from pathlib import Path
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
+from pydantic import BaseModel
+from metrics import Counter, Histogram, PROFILE_FORMATS, record_profile, render_gauges
 app = FastAPI()
 
 try:
@@ -16,8 +34,6 @@ k8s_metrics_client = client.CustomObjectsApi()
 
 def parse_resource(resource: str) -> float:
     """将 Kubernetes 资源格式转换为数值（CPU: 核，内存: 字节）。"""
-
-    print(f"resource {resource}")
     if not resource:
         return 0.0
     if resource.endswith("n"):  # CPU 纳核
@@ -32,130 +48,376 @@ def parse_resource(resource: str) -> float:
         return float(resource[:-2]) * 1024
     return float(resource)  # 原始 float 值
 
-async def get_cluster_metrics():
+###############################
+#    Metrics                  #
+###############################
+
+# lookup：sessionid 到 pod 地址（route 为 hit 时直接查路由表，miss 时需要访问 Kubernetes 创建或等待 pod）
+route_lookup_seconds = Histogram("gateway_route_lookup_seconds", "Time to resolve the pod of a session.",
+                                 ("route",))
+# proxy：网关自身构造转发请求的开销；upstream：等待 pod 返回响应头
+proxy_stage_seconds = Histogram("gateway_proxy_stage_seconds", "Time spent in each stage of a proxied request.",
+                                ("stage",))
+proxy_requests_total = Counter("gateway_proxy_requests_total", "Proxied requests by method and status code.",
+                               ("method", "status"))
+
+###############################
+#    Cluster Metrics Cache    #
+###############################
+
+METRICS_REFRESH_INTERVAL = float(os.environ.get("GATEWAY_METRICS_REFRESH_INTERVAL", "10"))  # 拉取节点用量的周期（秒）
+METRICS_MAX_STALENESS = float(os.environ.get("GATEWAY_METRICS_MAX_STALENESS", "60"))  # 快照超过该时间未刷新视为不可用
+METRICS_FIRST_SYNC_TIMEOUT = float(os.environ.get("GATEWAY_METRICS_FIRST_SYNC_TIMEOUT", "2"))  # 启动时等待第一次刷新的最长时间（秒）
+NODE_WATCH_TIMEOUT = int(os.environ.get("GATEWAY_NODE_WATCH_TIMEOUT", "300"))  # 每轮 watch 的时长，结束后重新 list
+
+class ClusterMetricsCache:
     """
-    获取所有节点的 CPU/Memory 使用率
+    在后台维护集群的节点容量和用量：容量来自 node watch，用量定期从 metrics.k8s.io 拉取。
+    parse_resource 只在刷新时调用一次，请求路径上只读取组合好的快照，不访问 Kubernetes API。
     """
-    try:
-        # 获取节点指标
-        metrics = await asyncio.to_thread(
-            k8s_metrics_client.list_cluster_custom_object,
-            "metrics.k8s.io", "v1beta1", "nodes"
-        )
-
-        # 获取节点容量信息
-        nodes = k8s_core_v1.list_node()
-        node_capacities = {
-            node.metadata.name: {
-                "cpu": node.status.capacity["cpu"],
-                "memory": node.status.capacity["memory"]
-            } for node in nodes.items
+    def __init__(self, core_api, metrics_api, interval: float = METRICS_REFRESH_INTERVAL,
+                 max_staleness: float = METRICS_MAX_STALENESS, first_sync_timeout: float = METRICS_FIRST_SYNC_TIMEOUT):
+        self.core_api = core_api
+        self.metrics_api = metrics_api
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.first_sync_timeout = first_sync_timeout
+        self.capacities = {}  # node -> {"cpu": 核, "memory": 字节}
+        self.usages = {}  # node -> {"cpu": 核, "memory": 字节}
+        self.nodes = ()  # 组合好的快照，整体替换，读取时不需要加锁
+        self.updated_at = None  # 最近一次成功拉取用量的 time.monotonic()
+        self.last_error = None  # 最近一次拉取失败的原因，成功后清空
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.watcher = None
+        self.poller = None
+        self.ready = None
+        self.started_at = None
+        self.stats = {"polls": 0, "poll_errors": 0, "watch_events": 0, "watch_restarts": 0}
+
+    def start(self):
+        self.ready = asyncio.Event()
+        self.started_at = time.monotonic()
+        self.watcher = threading.Thread(target=self.watch_nodes, daemon=True)
+        self.watcher.start()
+        self.poller = asyncio.create_task(self.poll_forever())
+
+    async def stop(self):
+        self.stopped.set()
+        if self.poller is not None:
+            self.poller.cancel()
+
+    def set_capacity(self, node):
+        capacity = node.status.capacity or {}
+        self.capacities[node.metadata.name] = {
+            "cpu": parse_resource(capacity.get("cpu", "0")),
+            "memory": parse_resource(capacity.get("memory", "0")),
         }
 
-        # 组合数据
-        usage_data = []
-        for item in metrics["items"]:
-            node_name = item["metadata"]["name"]
-            usage = item["usage"]
-            capacity = node_capacities.get(node_name, {})
-
-            usage_data.append({
-                "node": node_name,
-                "cpu": {
-                    "usage": usage.get("cpu", "0"),
-                    "capacity": capacity.get("cpu", "0")
-                },
-                "memory": {
-                    "usage": usage.get("memory", "0"),
-                    "capacity": capacity.get("memory", "0")
+    def watch_nodes(self):
+        """Keep node capacities current: list once, then apply watch events until the watch expires."""
+        while not self.stopped.is_set():
+            try:
+                nodes = self.core_api.list_node()
+                with self.lock:
+                    self.capacities = {}
+                    for node in nodes.items:
+                        self.set_capacity(node)
+                    self.rebuild()
+                node_watch = watch.Watch()
+                for event in node_watch.stream(self.core_api.list_node,
+                                               resource_version=nodes.metadata.resource_version,
+                                               timeout_seconds=NODE_WATCH_TIMEOUT):
+                    if self.stopped.is_set():
+                        node_watch.stop()
+                        break
+                    with self.lock:
+                        if event["type"] == "DELETED":
+                            self.capacities.pop(event["object"].metadata.name, None)
+                        else:
+                            self.set_capacity(event["object"])
+                        self.rebuild()
+                    self.stats["watch_events"] += 1
+            except Exception as e:
+                # resourceVersion 过期（410）或连接断开时重新 list
+                print(f"Node watch failed, relisting: {e}")
+                self.stopped.wait(self.interval)
+            self.stats["watch_restarts"] += 1
+
+    async def poll_forever(self):
+        while True:
+            try:
+                metrics = await asyncio.to_thread(
+                    self.metrics_api.list_cluster_custom_object,
+                    "metrics.k8s.io", "v1beta1", "nodes"
+                )
+                usages = {
+                    item["metadata"]["name"]: {
+                        "cpu": parse_resource(item["usage"].get("cpu", "0")),
+                        "memory": parse_resource(item["usage"].get("memory", "0")),
+                    } for item in metrics["items"]
                 }
+                with self.lock:
+                    self.usages = usages
+                    self.updated_at = time.monotonic()
+                    self.rebuild()
+                self.last_error = None
+                self.stats["polls"] += 1
+            except asyncio.CancelledError:
+                raise
+            except ApiException as e:
+                self.stats["poll_errors"] += 1
+                self.last_error = f"K8s API error: {e.reason}, Status: {e.status}"
+                print(f"K8s API error: {e.reason}, Status: {e.status}, Body: {e.body}")
+            except Exception as e:
+                self.stats["poll_errors"] += 1
+                self.last_error = str(e)
+                print(f"Error details: {str(e)}")
+            # 成功或失败都唤醒等待第一次刷新的调用方
+            self.ready.set()
+            await asyncio.sleep(self.interval)
+
+    def rebuild(self):
+        """Combine capacities and usages into the snapshot read by the scheduler; caller holds the lock."""
+        nodes = []
+        for name, usage in self.usages.items():
+            capacity = self.capacities.get(name)
+            if capacity is None:
+                continue  # watch 还没有看到这个节点
+            nodes.append({
+                "node": name,
+                "cpu": {"usage": usage["cpu"], "capacity": capacity["cpu"],
+                        "percent": usage["cpu"] / capacity["cpu"] * 100 if capacity["cpu"] > 0 else 0},
+                "memory": {"usage": usage["memory"], "capacity": capacity["memory"],
+                           "percent": usage["memory"] / capacity["memory"] * 100 if capacity["memory"] > 0 else 0},
             })
-        print(f"usage_data is {usage_data}")
-        return usage_data
-    except ApiException as e:
-        print(f"K8s API error: {e.reason}, Status: {e.status}, Body: {e.body}")
-        raise HTTPException(status_code=500, detail=f"K8s API error: {e.reason}, Body: {e.body}")
-    except Exception as e:
-        print(f"Error details: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error details: {str(e)}")
+        self.nodes = tuple(nodes)
 
-async def can_schedule_secret_k8s():
-    """
-    检查所有节点的 CPU 和内存使用率是否都不超过80%
-    如果所有节点都不超过80%，返回 True；否则返回 False
-    """
-    try:
-        # 获取节点资源使用数据
-        usage_data = await get_cluster_metrics()
+    def age(self) -> Optional[float]:
+        return None if self.updated_at is None else time.monotonic() - self.updated_at
 
-        print(f'{len(usage_data)}')
+    async def current(self) -> tuple:
+        """
+        返回最新的节点快照。启动后的 first_sync_timeout 秒内等待第一次拉取完成，
+        还没有成功拉取过（包括第一次拉取失败）或快照过期时立即抛出异常，由调用方按保守策略处理。
+        """
+        if self.updated_at is None:
+            remaining = 0 if self.started_at is None else self.started_at + self.first_sync_timeout - time.monotonic()
+            if remaining > 0 and not self.ready.is_set():
+                try:
+                    await asyncio.wait_for(self.ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    raise RuntimeError("Cluster metrics are not available yet")
+            if self.updated_at is None:
+                raise RuntimeError(f"Cluster metrics are not available: {self.last_error or 'not started'}")
+        age = self.age()
+        if age > self.max_staleness:
+            raise RuntimeError(f"Cluster metrics are stale ({age:.1f}s old)")
+        return self.nodes
 
-        # 检查每个节点的使用率
-        for node in usage_data:
-            # 解析 CPU 使用率和容量
-            cpu_usage = parse_resource(node["cpu"]["usage"])
-            cpu_capacity = parse_resource(node["cpu"]["capacity"])
+    def snapshot(self) -> dict:
+        return {"nodes": list(self.nodes), "age": self.age(), "last_error": self.last_error, **self.stats}
 
-            # 解析内存使用率和容量
-            mem_usage = parse_resource(node["memory"]["usage"])
-            mem_capacity = parse_resource(node["memory"]["capacity"])
+cluster_metrics = ClusterMetricsCache(k8s_core_v1, k8s_metrics_client)
 
-            # 计算使用率百分比（避免除以零）
-            cpu_percent = (cpu_usage / cpu_capacity * 100) if cpu_capacity > 0 else 0
-            mem_percent = (mem_usage / mem_capacity * 100) if mem_capacity > 0 else 0
+@app.on_event("startup")
+async def start_cluster_metrics():
+    cluster_metrics.start()
 
-            print(f"Node {node['node']} exceeds 80% usage: CPU={cpu_percent:.2f}%, Memory={mem_percent:.2f}%")
-            if cpu_percent < 80 and mem_percent < 80:
-                print(f"Node {node['node']} exceeds 80% usage: CPU={cpu_percent:.2f}%, Memory={mem_percent:.2f}%")
-                return True
+@app.on_event("shutdown")
+async def stop_cluster_metrics():
+    await cluster_metrics.stop()
 
-        # 所有节点都满足条件
-        print("All nodes have resource usage below 80%")
-        return True
+@app.get("/cluster/metrics")
+async def get_cluster_metrics_snapshot():
+    return cluster_metrics.snapshot()
 
-    except Exception as e:
-        # 记录错误并返回 False（保守决策）
-        print(f"Error checking cluster usage: {str(e)}")
-        return False
+async def can_schedule_secret_k8s():
+    """
+    本地集群是否还能放下一个 sandbox pod（按 pod 的 requests/limits 计算，见 place_pod）。
+    指标不可用时返回 False（保守决策）。
+    """
+    decision = await placement.place(reserve=False)
+    return decision["cluster"] == LOCAL_CLUSTER and decision["reason"] == "fits"
 
 # Kubernetes Ingress base URL
 K8S_LOCAL_INGRESS_URL = "http://sandbox.default.svc.cluster.local:5858"
-K8S_AKS_INGRESS_URL = "http://localhost:80"
+K8S_AKS_INGRESS_URL = os.environ.get("K8S_AKS_INGRESS_URL", "")  # 为空时不溢出到远端集群
+SANDBOX_NAMESPACE = "default"
+SANDBOX_PORT = 5858
+SANDBOX_POD_REQUESTS = {"cpu": "0.5", "memory": "256Mi"}
+SANDBOX_POD_LIMITS = {"cpu": "1", "memory": "512Mi"}
 
 from kubernetes import client, config
 
-pod_mapping = {}
+###############################
+#    Session Registry         #
+###############################
+
+SESSION_REGISTRY_PATH = os.environ.get("GATEWAY_SESSION_REGISTRY_PATH", "")  # 设置后使用共享的 SQLite 注册表
+SESSION_LEASE_TTL = float(os.environ.get("GATEWAY_SESSION_LEASE_TTL", "120"))  # 创建 pod 的租约时长（秒）
+GATEWAY_ID = f"{socket.gethostname()}-{os.getpid()}"
 
-def get_or_create_pod(sessionid: str):
+class SessionRegistry(ABC):
     """
-    根据 sessionid 获取或创建 Kubernetes Pod 配置。
-    Pod 名称以 'sandbox-pod-' 开头，后接 sessionid。
-    如果 pod_mapping 中存在 sessionid，则返回已有 Pod 配置；
-    否则创建一个新的 Pod 配置并存储。
+    session -> pod 的注册表，多个 gateway 进程/副本通过它共享 session。
+    记录的字段：sessionid、owner（持有创建租约的请求）、lease_expires、pod、remote（溢出到的远端地址）、last_active。
 
-    Args:
-        sessionid (str): 会话 ID，用于标识 Pod。
+    第一次请求通过 acquire 原子地创建记录并取得租约，只有租约的持有者会创建或认领 pod；
+    持有者在租约过期前没有完成（例如进程崩溃），其他请求可以接管。
+    外部存储（如 Redis 的 SET NX PX）实现这些方法即可接入。
+    """
+    @abstractmethod
+    def acquire(self, sessionid: str, owner: str, lease_ttl: float) -> dict:
+        """Create the record if absent, or take over an expired unassigned lease; return the current record."""
 
-    Returns:
-        dict: Kubernetes Pod 的配置。
+    @abstractmethod
+    def get(self, sessionid: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def assign(self, sessionid: str, owner: str, pod: Optional[str] = None, remote: Optional[str] = None) -> bool:
+        """Record where the session lives; only the lease owner may do this."""
+
+    @abstractmethod
+    def release(self, sessionid: str, owner: str):
+        """Drop an unassigned record held by owner so the next request can retry."""
+
+    @abstractmethod
+    def touch(self, activity: dict):
+        """Merge {sessionid: last_active} timestamps reported by one gateway process."""
+
+    @abstractmethod
+    def delete(self, sessionid: str):
+        pass
+
+def new_session_record(sessionid: str, owner: str, lease_ttl: float, now: float) -> dict:
+    return {"sessionid": sessionid, "owner": owner, "lease_expires": now + lease_ttl,
+            "pod": None, "remote": None, "last_active": now}
+
+class InMemorySessionRegistry(SessionRegistry):
+    """单进程使用的注册表。"""
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, sessionid: str, owner: str, lease_ttl: float) -> dict:
+        now = time.time()
+        with self.lock:
+            record = self.records.get(sessionid)
+            if record is None or (record["pod"] is None and record["remote"] is None
+                                  and record["lease_expires"] < now):
+                record = self.records[sessionid] = new_session_record(sessionid, owner, lease_ttl, now)
+            return dict(record)
+
+    def get(self, sessionid: str) -> Optional[dict]:
+        with self.lock:
+            record = self.records.get(sessionid)
+            return dict(record) if record else None
+
+    def assign(self, sessionid: str, owner: str, pod: Optional[str] = None, remote: Optional[str] = None) -> bool:
+        with self.lock:
+            record = self.records.get(sessionid)
+            if record is None or record["owner"] != owner:
+                return False
+            record.update(pod=pod, remote=remote)
+            return True
+
+    def release(self, sessionid: str, owner: str):
+        with self.lock:
+            record = self.records.get(sessionid)
+            if record and record["owner"] == owner and record["pod"] is None and record["remote"] is None:
+                del self.records[sessionid]
+
+    def touch(self, activity: dict):
+        with self.lock:
+            for sessionid, last_active in activity.items():
+                record = self.records.get(sessionid)
+                if record:
+                    record["last_active"] = max(record["last_active"], last_active)
+
+    def delete(self, sessionid: str):
+        with self.lock:
+            self.records.pop(sessionid, None)
+
+class SQLiteSessionRegistry(SessionRegistry):
     """
-    # 检查 pod_mapping 中是否已有 sessionid 对应的 Pod
-    if sessionid in pod_mapping:
-        return pod_mapping[sessionid]
+    基于 SQLite 文件的共享注册表，适用于同一台机器上的多个 uvicorn worker，
+    或挂载了同一个卷的多个副本。BEGIN IMMEDIATE 保证 acquire 的读-改-写是原子的。
+    """
+    COLUMNS = ("sessionid", "owner", "lease_expires", "pod", "remote", "last_active")
 
-    pod_name = f"sandbox-pod-{sessionid}"
-    # Kubernetes API 配置（假设已配置好 kubeconfig 或服务账号）
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()  # sqlite3 连接不能跨线程使用
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                sessionid TEXT PRIMARY KEY, owner TEXT, lease_expires REAL,
+                pod TEXT, remote TEXT, last_active REAL)""")
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return conn
+
+    def row(self, conn, sessionid: str) -> Optional[dict]:
+        row = conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM sessions WHERE sessionid = ?",
+                           (sessionid,)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
 
-    # 定义 Pod 配置，名称为 sandbox-pod-<sessionid>
-    pod_manifest = {
+    def acquire(self, sessionid: str, owner: str, lease_ttl: float) -> dict:
+        now = time.time()
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            record = self.row(conn, sessionid)
+            if record is None or (record["pod"] is None and record["remote"] is None
+                                  and record["lease_expires"] < now):
+                record = new_session_record(sessionid, owner, lease_ttl, now)
+                conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                             tuple(record[column] for column in self.COLUMNS))
+            conn.execute("COMMIT")
+            return record
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get(self, sessionid: str) -> Optional[dict]:
+        return self.row(self.connect(), sessionid)
+
+    def assign(self, sessionid: str, owner: str, pod: Optional[str] = None, remote: Optional[str] = None) -> bool:
+        cursor = self.connect().execute("UPDATE sessions SET pod = ?, remote = ? WHERE sessionid = ? AND owner = ?",
+                                        (pod, remote, sessionid, owner))
+        return cursor.rowcount == 1
+
+    def release(self, sessionid: str, owner: str):
+        self.connect().execute("DELETE FROM sessions WHERE sessionid = ? AND owner = ? "
+                               "AND pod IS NULL AND remote IS NULL", (sessionid, owner))
+
+    def touch(self, activity: dict):
+        self.connect().executemany("UPDATE sessions SET last_active = MAX(last_active, ?) WHERE sessionid = ?",
+                                   [(last_active, sessionid) for sessionid, last_active in activity.items()])
+
+    def delete(self, sessionid: str):
+        self.connect().execute("DELETE FROM sessions WHERE sessionid = ?", (sessionid,))
+
+session_registry = (SQLiteSessionRegistry(SESSION_REGISTRY_PATH) if SESSION_REGISTRY_PATH
+                    else InMemorySessionRegistry())
+
+def sandbox_pod_manifest(pod_name: str, labels: dict, node: Optional[str] = None) -> dict:
+    """
+    Pod 配置，session pod 和预热池中的 pod 共用。
+    node 为放置引擎选择的节点，用 preferred 的 node affinity 让 kube-scheduler 优先放到该节点；
+    不用 nodeName，节点实际放不下（用量数据过期）时仍然可以调度到其他节点。
+    """
+    manifest = {
         "apiVersion": "v1",
         "kind": "Pod",
         "metadata": {
             "name": pod_name,
-            "labels": {
-                "app": "sandbox",
-                "sessionid": sessionid
-            }
+            "labels": labels
         },
         "spec": {
             "containers": [
@@ -167,142 +429,1485 @@ def get_or_create_pod(sessionid: str):
                         {"containerPort": 8000},
                         {"containerPort": 5858}
                     ],
+                    # uvicorn 开始监听后 pod 才算 ready，路由表只把 ready 的 pod 交给请求
+                    "readinessProbe": {
+                        "httpGet": {"path": "/pool/stats", "port": SANDBOX_PORT},
+                        "periodSeconds": 1
+                    },
                     "resources": {
-                        "limits": {
-                            "cpu": "1",
-                            "memory": "512Mi"
-                        },
-                        "requests": {
-                            "cpu": "0.5",
-                            "memory": "256Mi"
-                        }
+                        "limits": SANDBOX_POD_LIMITS,
+                        "requests": SANDBOX_POD_REQUESTS
                     }
                 }
             ]
         }
     }
+    if node:
+        manifest["spec"]["affinity"] = {
+            "nodeAffinity": {
+                "preferredDuringSchedulingIgnoredDuringExecution": [{
+                    "weight": 100,
+                    "preference": {"matchFields": [{"key": "metadata.name", "operator": "In", "values": [node]}]}
+                }]
+            }
+        }
+    return manifest
 
-    try:
-        # 尝试创建 Pod
-        namespace = "default"  # 可根据需要修改命名空间
-        k8s_core_v1.create_namespaced_pod(namespace=namespace, body=pod_manifest)
-        print(f"Pod created for sessionid: {sessionid}, name: sandbox-pod-{sessionid}")
+def get_or_create_pod(sessionid: str, node: Optional[str] = None):
+    """
+    根据 sessionid 创建 Kubernetes Pod。
+    Pod 名称以 'sandbox-pod-' 开头，后接 sessionid。
+    如果 Pod 已经存在，则直接返回其名称（是否需要创建由 session_registry 的租约决定）。
+
+    Args:
+        sessionid (str): 会话 ID，用于标识 Pod。
+        node (str): 放置引擎选择的节点，为空时由 kube-scheduler 决定。
 
-        # 存储 Pod 配置到 pod_mapping
-        pod_mapping[sessionid] = pod_name
-        return pod_mapping[sessionid]
+    Returns:
+        dict: Kubernetes Pod 的配置。
+    """
+    pod_name = f"sandbox-pod-{sessionid}"
+    pod_manifest = sandbox_pod_manifest(pod_name, {"app": "sandbox", "sessionid": sessionid}, node)
+    deadline = time.monotonic() + POD_READY_TIMEOUT
+
+    while True:
+        try:
+            # 尝试创建 Pod
+            k8s_core_v1.create_namespaced_pod(namespace=SANDBOX_NAMESPACE, body=pod_manifest)
+            print(f"Pod created for sessionid: {sessionid}, name: sandbox-pod-{sessionid}")
+            return pod_name
 
+        except ApiException as e:
+            if e.status == 409:
+                # session 刚被回收或迁移时，同名的旧 pod 可能还在终止，等它删除后重新创建
+                if pod_terminating(pod_name) and time.monotonic() < deadline:
+                    time.sleep(POD_TERMINATING_POLL_INTERVAL)
+                    continue
+                # 并发的第一次请求已经创建了该 pod
+                return pod_name
+            print(f"Error creating Pod for sessionid {sessionid}: {e}")
+            return None
+        except Exception as e:
+            print(f"Error creating Pod for sessionid {sessionid}: {e}")
+            return None
+
+def pod_terminating(pod_name: str) -> bool:
+    """Whether the pod is being deleted (or already gone), so its name can be reused shortly."""
+    try:
+        pod = k8s_core_v1.read_namespaced_pod(pod_name, SANDBOX_NAMESPACE)
+    except ApiException as e:
+        if e.status == 404:
+            return True
+        raise
+    return pod.metadata.deletion_timestamp is not None
+
+def pod_gone(pod_name: str) -> bool:
+    """Whether the API server reports the pod as not found; other errors do not count as gone."""
+    try:
+        k8s_core_v1.read_namespaced_pod(pod_name, SANDBOX_NAMESPACE)
+    except ApiException as e:
+        return e.status == 404
     except Exception as e:
-        print(f"Error creating Pod for sessionid {sessionid}: {e}")
+        print(f"Error reading Pod {pod_name}: {e}")
+    return False
+
+
+###############################
+#    Session Routing          #
+###############################
+
+POD_READY_TIMEOUT = float(os.environ.get("GATEWAY_POD_READY_TIMEOUT", "60"))  # 等待新 pod ready 的最长时间（秒）
+POD_WATCH_TIMEOUT = int(os.environ.get("GATEWAY_POD_WATCH_TIMEOUT", "300"))
+POD_TERMINATING_POLL_INTERVAL = 0.5  # 等待同名旧 pod 删除时的轮询间隔（秒）
+
+def pod_ready(pod) -> bool:
+    if pod.status is None or pod.status.phase != "Running" or not pod.status.pod_ip:
+        return False
+    return any(condition.type == "Ready" and condition.status == "True"
+               for condition in pod.status.conditions or [])
+
+def pod_node(pod) -> Optional[str]:
+    return pod.spec.node_name if pod.spec else None
+
+class PodRouter:
+    """
+    sessionid -> pod 地址的路由表，由 app=sandbox 的 pod watch 在后台维护。
+    已经 ready 的 session 直接查表；还在启动的 pod 等待 watch 发出的 ready 事件，而不是轮询 API。
+    watch 线程不直接修改 routes 和 warm，而是把事件交给事件循环处理，这两个表只在事件循环中读写。
+    """
+    def __init__(self, core_api, namespace: str = SANDBOX_NAMESPACE):
+        self.core_api = core_api
+        self.namespace = namespace
+        self.routes = {}  # sessionid -> {"pod", "ip", "node", "ready"}
+        self.warm = {}  # 预热池中尚未分配的 pod：name -> {"ready", "node", "resource_version"}
+        self.waiters = {}  # sessionid -> asyncio.Event，pod 状态变化时唤醒等待的请求
+        self.listeners = []  # 发现 session pod 时调用 listener(sessionid)，在事件循环中执行
+        self.loop = None
+        self.stopped = threading.Event()
+        self.synced = threading.Event()  # 第一次 list 完成后才能判断 session 是否已经有 pod
+        self.stats = {"hits": 0, "waits": 0, "timeouts": 0, "watch_events": 0, "watch_restarts": 0}
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.watch_pods, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def apply(self, event_type: str, pod):
+        """Apply one pod event to the tables; runs on the event loop."""
+        labels = pod.metadata.labels or {}
+        sessionid = labels.get("sessionid")
+        if not sessionid:
+            if labels.get("pool") == WARM_POOL_LABEL:
+                self.apply_warm(event_type, pod)
+            return
+        self.warm.pop(pod.metadata.name, None)  # 被其他 gateway 实例认领
+        if event_type == "DELETED" or pod.metadata.deletion_timestamp:
+            # 正在终止的 pod 不再接收请求；session 迁移后已经有了新的 pod，旧 pod 的事件不影响新的路由
+            if self.routes.get(sessionid, {}).get("pod") == pod.metadata.name:
+                self.routes.pop(sessionid, None)
+        else:
+            self.routes[sessionid] = {"pod": pod.metadata.name, "ip": pod.status.pod_ip if pod.status else None,
+                                      "node": pod_node(pod), "ready": pod_ready(pod)}
+            for listener in self.listeners:
+                listener(sessionid)
+        self.notify(sessionid)
+
+    def apply_warm(self, event_type: str, pod):
+        if event_type == "DELETED" or pod.metadata.deletion_timestamp:
+            self.warm.pop(pod.metadata.name, None)
+        else:
+            self.warm[pod.metadata.name] = {"ready": pod_ready(pod), "node": pod_node(pod),
+                                            "resource_version": pod.metadata.resource_version}
+
+    def resync(self, pods: list):
+        """Replace the tables with a fresh pod list; runs on the event loop."""
+        self.warm = {}
+        seen = set()
+        for pod in pods:
+            self.apply("ADDED", pod)
+            seen.add((pod.metadata.labels or {}).get("sessionid"))
+        for sessionid in set(self.routes) - seen:
+            self.routes.pop(sessionid, None)
+        self.synced.set()
+
+    def notify(self, sessionid: str):
+        event = self.waiters.pop(sessionid, None)
+        if event is not None:
+            event.set()
+
+    def watch_pods(self):
+        while not self.stopped.is_set():
+            try:
+                pods = self.core_api.list_namespaced_pod(self.namespace, label_selector="app=sandbox")
+                self.loop.call_soon_threadsafe(self.resync, pods.items)
+                pod_watch = watch.Watch()
+                for event in pod_watch.stream(self.core_api.list_namespaced_pod, self.namespace,
+                                              label_selector="app=sandbox",
+                                              resource_version=pods.metadata.resource_version,
+                                              timeout_seconds=POD_WATCH_TIMEOUT):
+                    if self.stopped.is_set():
+                        pod_watch.stop()
+                        break
+                    self.loop.call_soon_threadsafe(self.apply, event["type"], event["object"])
+                    self.stats["watch_events"] += 1
+            except Exception as e:
+                print(f"Pod watch failed, relisting: {e}")
+                self.stopped.wait(1)
+            self.stats["watch_restarts"] += 1
+
+    def lookup(self, sessionid: str) -> Optional[str]:
+        route = self.routes.get(sessionid)
+        if route and route["ready"]:
+            return f"http://{route['ip']}:{SANDBOX_PORT}"
         return None
 
+    def known(self, sessionid: str) -> bool:
+        return sessionid in self.routes
+
+    def node(self, sessionid: str) -> Optional[str]:
+        return self.routes.get(sessionid, {}).get("node")
+
+    async def wait_ready(self, sessionid: str, timeout: float = POD_READY_TIMEOUT) -> str:
+        """Wait until the session's pod is ready, failing with 504 after timeout seconds."""
+        deadline = self.loop.time() + timeout
+        self.stats["waits"] += 1
+        while True:
+            url = self.lookup(sessionid)
+            if url:
+                return url
+            remaining = deadline - self.loop.time()
+            event = self.waiters.setdefault(sessionid, asyncio.Event())
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                raise HTTPException(status_code=504, detail=f"Pod for session {sessionid} not ready after {timeout}s")
+
+    def snapshot(self) -> dict:
+        ready = sum(1 for route in self.routes.values() if route["ready"])
+        return {"sessions": len(self.routes), "ready": ready, "warm": len(self.warm), **self.stats}
 
-def get_local_url(pod_name: str) -> str:
+pod_router = PodRouter(k8s_core_v1)
+
+@app.on_event("startup")
+async def start_pod_router():
+    pod_router.start()
+
+@app.on_event("shutdown")
+async def stop_pod_router():
+    pod_router.stop()
+
+@app.get("/cluster/routes")
+async def get_routes():
+    return pod_router.snapshot()
+
+###############################
+#    Warm Pod Pool            #
+###############################
+
+WARM_POOL_LABEL = "warm"
+WARM_POOL_LOW = int(os.environ.get("GATEWAY_WARM_POOL_LOW", "2"))  # 空闲 pod 少于该值时开始补充
+WARM_POOL_HIGH = int(os.environ.get("GATEWAY_WARM_POOL_HIGH", "5"))  # 补充到该值，超出的空闲 pod 会被删除
+WARM_POOL_INTERVAL = float(os.environ.get("GATEWAY_WARM_POOL_INTERVAL", "10"))
+
+class WarmPodPool:
+    """
+    预先创建一组已经 ready、尚未分配的 sandbox pod（label pool=warm）。
+    新 session 通过修改 pod 的 label 认领其中一个，不需要等待调度、拉镜像和 uvicorn 启动；
+    池的大小由高低水位控制，在后台补充。
     """
-    根据 Pod 名称生成本地访问 URL。
-    假设 Pod 运行在 Kubernetes 集群中，通过 NodePort 或 ClusterIP 服务暴露端口。
+    def __init__(self, core_api, router: PodRouter, namespace: str = SANDBOX_NAMESPACE,
+                 low: int = WARM_POOL_LOW, high: int = WARM_POOL_HIGH, interval: float = WARM_POOL_INTERVAL):
+        self.core_api = core_api
+        self.router = router
+        self.namespace = namespace
+        self.low = low
+        self.high = max(high, low)
+        self.interval = interval
+        self.creating = {}  # 已经提交创建但 watch 还没看到的 pod：name -> time.monotonic()
+        self.wakeup = None
+        self.task = None
+        self.stats = {"claims": 0, "misses": 0, "conflicts": 0, "created": 0, "deleted": 0}
 
-    Args:
-        pod_name (str): Pod 名称，例如 'sandbox-pod-session123'。
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.refill_forever())
 
-    Returns:
-        str: Pod 的本地访问 URL（例如 'http://<node-ip>:<port>' 或 'http://<cluster-ip>:<port>'）。
-        如果无法获取 URL，则返回空字符串。
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def claim(self, sessionid: str, node: Optional[str] = None) -> Optional[str]:
+        """
+        认领一个 ready 的空闲 pod 并返回其名称，池为空时返回 None，由调用方冷启动。
+        优先认领 node 上的 pod（放置引擎选择的节点），没有时认领其他节点上的。
+        patch 带上 resourceVersion，多个 gateway 实例同时认领同一个 pod 时只有一个成功。
+        """
+        while True:
+            ready = [name for name, pod in self.router.warm.items() if pod["ready"]]
+            name = next((name for name in ready if self.router.warm[name]["node"] == node), None)
+            if name is None:
+                name = next(iter(ready), None)
+            if name is None:
+                self.stats["misses"] += 1
+                self.wakeup.set()
+                return None
+            pod = self.router.warm.pop(name)
+            body = {"metadata": {"labels": {"sessionid": sessionid, "pool": "claimed"},
+                                 "resourceVersion": pod["resource_version"]}}
+            try:
+                claimed = await asyncio.to_thread(self.core_api.patch_namespaced_pod, name, self.namespace, body)
+            except ApiException as e:
+                if e.status in (404, 409):
+                    self.stats["conflicts"] += 1
+                    continue
+                raise
+            # 不等 watch 事件，直接用 patch 的返回值更新路由表
+            self.router.apply("MODIFIED", claimed)
+            self.stats["claims"] += 1
+            self.wakeup.set()
+            return name
+
+    async def refill_forever(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                await self.refill()
+            except Exception as e:
+                print(f"Failed to refill warm pod pool: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def refill(self):
+        if not self.router.synced.is_set():
+            return
+        now = time.monotonic()
+        self.creating = {name: created for name, created in self.creating.items()
+                         if name not in self.router.warm and now - created < POD_READY_TIMEOUT}
+        size = len(self.router.warm) + len(self.creating)
+        if size < self.low:
+            # 预热的 pod 同样占用集群资源，水位不够时不补充
+            if not await can_schedule_secret_k8s():
+                return
+            for _ in range(self.high - size):
+                name = f"sandbox-pod-warm-{uuid.uuid4().hex[:8]}"
+                manifest = sandbox_pod_manifest(name, {"app": "sandbox", "pool": WARM_POOL_LABEL})
+                await asyncio.to_thread(self.core_api.create_namespaced_pod, namespace=self.namespace, body=manifest)
+                self.creating[name] = now
+                self.stats["created"] += 1
+        elif len(self.router.warm) > self.high:
+            for name in list(self.router.warm)[self.high:]:
+                self.router.warm.pop(name, None)
+                await asyncio.to_thread(self.core_api.delete_namespaced_pod, name, self.namespace)
+                self.stats["deleted"] += 1
+
+    def snapshot(self) -> dict:
+        return {"warm": len(self.router.warm), "creating": len(self.creating),
+                "low": self.low, "high": self.high, **self.stats}
+
+warm_pool = WarmPodPool(k8s_core_v1, pod_router)
+
+@app.on_event("startup")
+async def start_warm_pool():
+    warm_pool.start()
+
+@app.on_event("shutdown")
+async def stop_warm_pool():
+    await warm_pool.stop()
+
+@app.get("/cluster/warm-pool")
+async def get_warm_pool():
+    return warm_pool.snapshot()
+
+###############################
+#    Session Reaper           #
+###############################
+
+SESSION_IDLE_TTL = float(os.environ.get("GATEWAY_SESSION_IDLE_TTL", "1800"))  # session 空闲多久后删除其 pod（秒）
+SESSION_REAP_INTERVAL = float(os.environ.get("GATEWAY_SESSION_REAP_INTERVAL", "30"))
+SESSION_REAP_BATCH = int(os.environ.get("GATEWAY_SESSION_REAP_BATCH", "20"))  # 每次 deletecollection 删除的 pod 数
+MAX_SESSIONS = int(os.environ.get("GATEWAY_MAX_SESSIONS", "200"))  # 本实例最多同时保留的 session pod，0 表示不限制
+
+class SessionReaper:
+    """
+    记录每个 session 最后一次请求的时间（按最近使用排序），后台分批删除空闲超过 TTL 的 pod；
+    session 数超过上限时，优先淘汰最久未使用的 session。
+    路由表中发现的 session pod（本实例启动前已经存在，或由其他实例创建）以发现的时间作为最后活动时间，
+    同样会被回收；删除前从注册表读取其他实例记录的活动时间。
     """
-    from kubernetes import client, config
+    def __init__(self, core_api, router: PodRouter, namespace: str = SANDBOX_NAMESPACE,
+                 idle_ttl: float = SESSION_IDLE_TTL, max_sessions: int = MAX_SESSIONS,
+                 batch_size: int = SESSION_REAP_BATCH, interval: float = SESSION_REAP_INTERVAL):
+        self.core_api = core_api
+        self.router = router
+        self.namespace = namespace
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.batch_size = batch_size
+        self.interval = interval
+        self.last_active = OrderedDict()  # sessionid -> time.monotonic()，最久未使用的在前
+        self.dirty = set()  # 上次同步到注册表之后有请求的 session
+        self.task = None
+        self.pod_cpu = parse_resource(SANDBOX_POD_REQUESTS["cpu"])
+        self.pod_memory = parse_resource(SANDBOX_POD_REQUESTS["memory"])
+        self.stats = {"reaped_idle": 0, "evicted_lru": 0, "migrated": 0, "deleted_pods": 0, "delete_errors": 0,
+                      "reclaimed_cpu": 0.0, "reclaimed_memory": 0.0}
+
+    def start(self):
+        self.router.listeners.append(self.discover)
+        for sessionid in list(self.router.routes):
+            self.discover(sessionid)
+        self.task = asyncio.create_task(self.reap_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def discover(self, sessionid: str):
+        """Track a session pod seen by the router, with the time it was found as its last activity."""
+        if sessionid not in self.last_active:
+            # 不标记为 dirty：发现时间不是真实的请求，不写入注册表覆盖其他实例记录的活动时间
+            self.last_active[sessionid] = time.monotonic()
+
+    def touch(self, sessionid: str):
+        self.last_active[sessionid] = time.monotonic()
+        self.last_active.move_to_end(sessionid)
+        self.dirty.add(sessionid)
+
+    async def sync_activity(self, idle: list) -> list:
+        """
+        把本进程最近的活动时间写入共享注册表，并过滤掉在其他 gateway 进程中仍然活跃的 session，
+        请求路径上只更新内存。
+        """
+        now, wall = time.monotonic(), time.time()
+        activity = {sessionid: wall - (now - self.last_active[sessionid])
+                    for sessionid in self.dirty if sessionid in self.last_active}
+        self.dirty = set()
+        if activity:
+            await asyncio.to_thread(session_registry.touch, activity)
+        still_idle = []
+        for sessionid in idle:
+            record = await asyncio.to_thread(session_registry.get, sessionid)
+            if record and wall - record["last_active"] < self.idle_ttl:
+                self.last_active[sessionid] = now - (wall - record["last_active"])
+                self.last_active.move_to_end(sessionid)
+            else:
+                still_idle.append(sessionid)
+        return still_idle
+
+    def live_sessions(self) -> list:
+        """
+        Sessions routed through this gateway that still have a pod, in eviction order:
+        batch 的子 session 在前（随时可以重建），然后是用户的 session，各自按最久未使用排序。
+        """
+        live = [sessionid for sessionid in self.last_active if self.router.known(sessionid)]
+        return ([sessionid for sessionid in live if is_batch_shard(sessionid)]
+                + [sessionid for sessionid in live if not is_batch_shard(sessionid)])
+
+    def idle_sessions(self, now: float) -> list:
+        idle = []
+        for sessionid, last_active in self.last_active.items():
+            if now - last_active < self.idle_ttl:
+                break
+            idle.append(sessionid)
+        return idle
+
+    async def reclaim(self, sessionids: list, reason: str):
+        """Delete the pods of the given sessions, batch_size pods per deletecollection call."""
+        for start in range(0, len(sessionids), self.batch_size):
+            batch = sessionids[start:start + self.batch_size]
+            live = [sessionid for sessionid in batch if self.router.known(sessionid)]
+            if live:
+                selector = f"app=sandbox,sessionid in ({','.join(live)})"
+                try:
+                    await asyncio.to_thread(self.core_api.delete_collection_namespaced_pod,
+                                            self.namespace, label_selector=selector)
+                except Exception as e:
+                    # 保留记录，下一轮重试
+                    self.stats["delete_errors"] += 1
+                    print(f"Failed to delete pods for sessions {live}: {e}")
+                    continue
+            for sessionid in batch:
+                # 不等 watch 的 DELETED 事件，之后的请求会重新分配 pod
+                self.last_active.pop(sessionid, None)
+                remote_sessions.pop(sessionid, None)
+                self.router.routes.pop(sessionid, None)
+                await asyncio.to_thread(session_registry.delete, sessionid)
+            self.stats[reason] += len(live)
+            self.stats["deleted_pods"] += len(live)
+            self.stats["reclaimed_cpu"] += self.pod_cpu * len(live)
+            self.stats["reclaimed_memory"] += self.pod_memory * len(live)
+            if live:
+                print(f"Deleted {len(live)} pods ({reason}): {live}")
+
+    async def make_room(self, shard: bool = False):
+        """
+        Evict least recently used sessions so a new one fits under max_sessions.
+        为 batch 的子 session 腾位置时只淘汰其他子 session，不会挤掉用户的 session，腾不出时返回 503。
+        """
+        if not self.max_sessions:
+            return
+        live = self.live_sessions()
+        excess = len(live) - self.max_sessions + 1
+        if excess <= 0:
+            return
+        if shard and sum(1 for sessionid in live if is_batch_shard(sessionid)) < excess:
+            raise HTTPException(status_code=503, detail="No room for a batch shard")
+        await self.reclaim(live[:excess], "evicted_lru")
+
+    async def reap(self):
+        idle = await self.sync_activity(self.idle_sessions(time.monotonic()))
+        await self.reclaim(idle, "reaped_idle")
+        if self.max_sessions:
+            live = self.live_sessions()
+            if len(live) > self.max_sessions:
+                await self.reclaim(live[:len(live) - self.max_sessions], "evicted_lru")
+
+    async def reap_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                print(f"Failed to reap idle sessions: {e}")
+
+    def snapshot(self) -> dict:
+        return {"tracked": len(self.last_active), "live": len(self.live_sessions()),
+                "idle_ttl": self.idle_ttl, "max_sessions": self.max_sessions, **self.stats}
 
+session_reaper = SessionReaper(k8s_core_v1, pod_router)
+
+@app.on_event("startup")
+async def start_session_reaper():
+    session_reaper.start()
+
+@app.on_event("shutdown")
+async def stop_session_reaper():
+    await session_reaper.stop()
+
+@app.get("/cluster/sessions")
+async def get_sessions():
+    return session_reaper.snapshot()
+
+###############################
+#    Placement                #
+###############################
+
+LOCAL_CLUSTER = "local"
+REMOTE_CLUSTER = "remote"
+PLACEMENT_THRESHOLD = float(os.environ.get("GATEWAY_PLACEMENT_THRESHOLD", "0.8"))  # 放置后节点用量不超过容量的比例
+PLACEMENT_LOG_SIZE = 100  # 保留最近的放置决策条数
+
+def score_node(node: dict, request: dict, limit: dict, threshold: float = PLACEMENT_THRESHOLD,
+               reserved: Optional[tuple] = None) -> Optional[float]:
+    """
+    Score a node for one more sandbox pod, or return None if the pod does not fit.
+    放置后用量加 requests 不超过容量的 threshold，加 limits 不超过容量；
+    分数是放置后 CPU 和内存的平均利用率，越高表示越满（bin-packing，把空闲节点留给后续的 pod）。
+    """
+    cpu, memory = node["cpu"], node["memory"]
+    if cpu["capacity"] <= 0 or memory["capacity"] <= 0:
+        return None
+    reserved_cpu, reserved_memory = reserved or (0.0, 0.0)
+    cpu_used = cpu["usage"] + reserved_cpu
+    memory_used = memory["usage"] + reserved_memory
+    if (cpu_used + request["cpu"] > cpu["capacity"] * threshold
+            or memory_used + request["memory"] > memory["capacity"] * threshold):
+        return None
+    if cpu_used + limit["cpu"] > cpu["capacity"] or memory_used + limit["memory"] > memory["capacity"]:
+        return None
+    return ((cpu_used + request["cpu"]) / cpu["capacity"]
+            + (memory_used + request["memory"]) / memory["capacity"]) / 2
+
+def place_pod(clusters: list, request: dict, limit: dict, threshold: float = PLACEMENT_THRESHOLD,
+              reserved: Optional[dict] = None) -> dict:
+    """
+    Pick a cluster and node for a sandbox pod. Pure function over a cluster snapshot so it can be benchmarked.
+
+    clusters 按优先级排列（本地集群在前），每项为 {"name", "nodes"}，nodes 的格式与 ClusterMetricsCache 的快照相同；
+    第一个有节点放得下的集群胜出，集群内选分数最高的节点。nodes 为 None 表示没有该集群的用量数据
+    （例如远端集群，由它自己的 gateway 决定），前面的集群都放不下时直接溢出到它。
+    """
+    reserved = reserved or {}
+    for cluster in clusters:
+        if cluster["nodes"] is None:
+            return {"cluster": cluster["name"], "node": None, "score": None, "reason": "spillover"}
+        best, best_score = None, None
+        for node in cluster["nodes"]:
+            score = score_node(node, request, limit, threshold, reserved.get(node["node"]))
+            if score is not None and (best_score is None or score > best_score):
+                best, best_score = node["node"], score
+        if best is not None:
+            return {"cluster": cluster["name"], "node": best, "score": round(best_score, 4), "reason": "fits"}
+    return {"cluster": None, "node": None, "score": None, "reason": "no capacity"}
+
+class PlacementEngine:
+    """
+    用缓存的节点快照做放置决策。metrics 刷新之前放置的 pod 还没有体现在用量里，
+    按节点记下它们的 requests，直到下一次刷新。
+    """
+    def __init__(self, metrics: ClusterMetricsCache, remote_url: str = K8S_AKS_INGRESS_URL):
+        self.metrics = metrics
+        self.remote_url = remote_url
+        self.request = {name: parse_resource(value) for name, value in SANDBOX_POD_REQUESTS.items()}
+        self.limit = {name: parse_resource(value) for name, value in SANDBOX_POD_LIMITS.items()}
+        self.reserved = {}  # node -> (cpu, memory)
+        self.reserved_at = None  # reserved 对应的 metrics.updated_at
+        self.reservations = {}  # sessionid -> 预留所在的节点，与 reserved 一起清空
+        self.decisions = deque(maxlen=PLACEMENT_LOG_SIZE)
+        self.stats = {LOCAL_CLUSTER: 0, REMOTE_CLUSTER: 0, "rejected": 0}
+
+    def clusters(self, nodes) -> list:
+        clusters = [{"name": LOCAL_CLUSTER, "nodes": nodes}]
+        if self.remote_url:
+            clusters.append({"name": REMOTE_CLUSTER, "nodes": None})
+        return clusters
+
+    async def place(self, sessionid: Optional[str] = None, reserve: bool = True,
+                    cluster: Optional[str] = None) -> dict:
+        """cluster 不为空时只考虑该集群（迁移时指定目标集群）。"""
+        try:
+            nodes = await self.metrics.current()
+        except Exception as e:
+            print(f"Error checking cluster usage: {str(e)}")
+            nodes = None
+        if nodes is None and cluster != REMOTE_CLUSTER:
+            # 指标不可用不等于本地集群已满：不溢出到远端（溢出会被记录，之后的请求都转发到远端），
+            # 放在本地集群、不指定节点，由 kube-scheduler 调度
+            decision = {"cluster": LOCAL_CLUSTER, "node": None, "score": None, "reason": "metrics unavailable"}
+        else:
+            if self.reserved_at != self.metrics.updated_at:
+                self.reserved = {}
+                self.reservations = {}
+                self.reserved_at = self.metrics.updated_at
+            clusters = [candidate for candidate in self.clusters(nodes or ()) if cluster in (None, candidate["name"])]
+            decision = place_pod(clusters, self.request, self.limit, reserved=self.reserved)
+        if not reserve:
+            return decision
+        if decision["node"] is not None:
+            self.reserve(decision["node"], 1)
+            if sessionid is not None:
+                self.reservations[sessionid] = decision["node"]
+        self.stats[decision["cluster"] or "rejected"] += 1
+        decision = {"sessionid": sessionid, "time": time.time(), **decision}
+        self.decisions.append(decision)
+        print(f"Placement session={sessionid} cluster={decision['cluster']} node={decision['node']} "
+              f"score={decision['score']} reason={decision['reason']}")
+        return decision
+
+    def reserve(self, node: str, count: int):
+        cpu, memory = self.reserved.get(node, (0.0, 0.0))
+        self.reserved[node] = (cpu + count * self.request["cpu"], memory + count * self.request["memory"])
+
+    def settle(self, sessionid: str, node: Optional[str]):
+        """
+        Move the session's reservation to the node its pod actually landed on.
+        认领的预热 pod 可能在其他节点上，新建的 pod 也可能被 kube-scheduler 放到其他节点。
+        """
+        reserved = self.reservations.pop(sessionid, None)
+        if reserved is None or node is None or node == reserved:
+            return
+        self.reserve(reserved, -1)
+        self.reserve(node, 1)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "reserved": {node: {"cpu": cpu, "memory": memory}
+                                           for node, (cpu, memory) in self.reserved.items()},
+                "decisions": list(self.decisions)}
+
+placement = PlacementEngine(cluster_metrics)
+remote_sessions = {}  # 溢出到远端集群的 session -> 远端 gateway 地址
+
+@app.get("/cluster/placements")
+async def get_placements():
+    return placement.snapshot()
+
+async def place_session(sessionid: str, owner: str, cluster: Optional[str] = None) -> str:
+    """Place a new session and claim or create its pod; the caller holds the registry lease."""
     try:
-        # 加载 Kubernetes 配置
-        namespace = "default"  # 可根据需要修改命名空间
-        # 如果未找到匹配的服务，尝试直接通过 Pod IP 和端口
-        pod = k8s_core_v1.read_namespaced_pod(name=pod_name, namespace=namespace)
-        pod_ip = pod.status.pod_ip
-        print(f"pod_name {pod_name} pod_ip {pod_ip}")
-        if pod_ip:
-            url = f"http://{pod_ip}:5858"
-            return url
-
-        return ""  # 未找到有效 URL
-    except client.ApiException as e:
-        print(f"Error retrieving URL for pod {pod_name}: {e}")
-        return ""
-
-client = httpx.AsyncClient()
-
-async def get_host(sessionid):
-    use_local = await can_schedule_secret_k8s()
-    if use_local:
-        pod_name = get_or_create_pod(sessionid)
+        await session_reaper.make_room(shard=is_batch_shard(sessionid))
+        decision = await placement.place(sessionid, cluster=cluster)
+        if decision["cluster"] == REMOTE_CLUSTER:
+            await asyncio.to_thread(session_registry.assign, sessionid, owner, None, placement.remote_url)
+            remote_sessions[sessionid] = placement.remote_url
+            return placement.remote_url
+        if decision["cluster"] is None:
+            raise HTTPException(status_code=503, detail="No capacity to start a sandbox for this session")
+        pod_name = await warm_pool.claim(sessionid, decision["node"])
+        if pod_name is None:
+            pod_name = await asyncio.to_thread(get_or_create_pod, sessionid, decision["node"])
         print(f"pod name {pod_name}")
-        return get_local_url(pod_name)
-    return ''
+        if pod_name is None:
+            raise HTTPException(status_code=500, detail=f"Failed to create pod for session {sessionid}")
+        await asyncio.to_thread(session_registry.assign, sessionid, owner, pod_name)
+    except BaseException:
+        # 释放租约，下一次请求可以重试
+        await asyncio.to_thread(session_registry.release, sessionid, owner)
+        raise
+    host = await pod_router.wait_ready(sessionid)
+    placement.settle(sessionid, pod_router.node(sessionid))
+    return host
+
+async def start_session(sessionid: str, owner: str, cluster: Optional[str] = None) -> str:
+    """
+    启动 session 的 pod。网关保存有该 session 的快照时（pod 崩溃后重建、迁移），先恢复快照再返回地址；
+    恢复期间同一个 session 的其他请求在 lookup_host 中等待。
+    """
+    restoring = checkpoint_store.begin_restore(sessionid)
+    try:
+        host = await place_session(sessionid, owner, cluster)
+        if restoring:
+            await checkpoint_store.recover(sessionid, host)
+        return host
+    finally:
+        if restoring:
+            checkpoint_store.end_restore(sessionid)
+
+async def wait_for_session(sessionid: str) -> str:
+    """
+    等待其他请求（可能在其他 gateway 进程中）完成 session 的创建：
+    pod 由 watch 发现，溢出到远端的 session 需要重新读取注册表。
+    """
+    deadline = time.monotonic() + POD_READY_TIMEOUT
+    while True:
+        try:
+            return await pod_router.wait_ready(sessionid, min(1.0, max(deadline - time.monotonic(), 0)))
+        except HTTPException:
+            record = await asyncio.to_thread(session_registry.get, sessionid)
+            if record and record["remote"]:
+                remote_sessions[sessionid] = record["remote"]
+                return record["remote"]
+            # 本进程的 watch 可能还没有看到其他 gateway 刚创建的 pod，路由表中没有不代表 pod 不存在，
+            # 只有 API 返回 404 才说明记录的 pod 已经被删除（被驱逐、节点故障）
+            if (record is not None and not pod_router.known(sessionid)
+                    and (record["lease_expires"] < time.time()
+                         or (record["pod"] is not None and await asyncio.to_thread(pod_gone, record["pod"])))):
+                # 创建者失败或崩溃，或者记录的 pod 已经不存在，删除记录后重新争取租约
+                await asyncio.to_thread(session_registry.delete, sessionid)
+                record = None
+            if record is None:
+                return await get_host(sessionid)
+            if time.monotonic() >= deadline:
+                raise
 
-class ExecRequest(BaseModel):
-    code: str
+async def get_host(sessionid, cluster: Optional[str] = None):
+    """
+    已有 ready pod 的 session 直接从路由表返回地址，不访问 Kubernetes API；
+    新 session 通过 session_registry 取得创建租约，由放置引擎决定在本地集群创建 pod 并等待它 ready，
+    或者溢出到远端集群（cluster 不为空时只放置到该集群）。没有取得租约的请求等待创建完成。
+    """
+    session_reaper.touch(sessionid)
+    if sessionid in remote_sessions:
+        return remote_sessions[sessionid]
+    url = pod_router.lookup(sessionid)
+    if url:
+        pod_router.stats["hits"] += 1
+        return url
+    if not pod_router.synced.is_set():
+        await asyncio.to_thread(pod_router.synced.wait, POD_READY_TIMEOUT)
+    if pod_router.known(sessionid):
+        return await pod_router.wait_ready(sessionid)
+    # 每次请求使用不同的 owner，同一进程内并发的第一次请求也只有一个会创建 pod
+    owner = f"{GATEWAY_ID}-{uuid.uuid4().hex[:8]}"
+    record = await asyncio.to_thread(session_registry.acquire, sessionid, owner, SESSION_LEASE_TTL)
+    if record["remote"]:
+        remote_sessions[sessionid] = record["remote"]
+        return record["remote"]
+    if record["owner"] == owner:
+        return await start_session(sessionid, owner, cluster)
+    return await wait_for_session(sessionid)
+
+###############################
+#    Reverse Proxy            #
+###############################
+
+PROXY_MAX_CONNECTIONS = int(os.environ.get("GATEWAY_PROXY_MAX_CONNECTIONS", "100"))  # 每个 pod 的最大连接数
+PROXY_MAX_KEEPALIVE = int(os.environ.get("GATEWAY_PROXY_MAX_KEEPALIVE", "20"))  # 每个 pod 保持的空闲连接数
+PROXY_KEEPALIVE_EXPIRY = float(os.environ.get("GATEWAY_PROXY_KEEPALIVE_EXPIRY", "30"))
+PROXY_READ_TIMEOUT = float(os.environ.get("GATEWAY_PROXY_READ_TIMEOUT", "600"))  # 覆盖代码执行和大文件传输
+PROXY_MAX_CLIENTS = int(os.environ.get("GATEWAY_PROXY_MAX_CLIENTS", "512"))  # 最多缓存多少个 pod 的连接池
+PROXY_SAMPLES = 1000  # 计算代理开销分位数时保留的样本数
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+# sandbox pod 上的 uvicorn 只支持 HTTP/1.1，HTTP/2 只在经过 TLS 的远端 gateway 上通过 ALPN 协商
+PROXY_HTTP2 = os.environ.get("GATEWAY_PROXY_HTTP2", "0") == "1" and HTTP2_AVAILABLE
+
+# 逐跳头部不转发（RFC 7230 6.1），Host 由 httpx 按目标地址生成
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                      "te", "trailers", "transfer-encoding", "upgrade", "host"}
+# uvicorn 会为网关的响应生成自己的 Server 和 Date
+PROXY_RESPONSE_EXCLUDED_HEADERS = HOP_BY_HOP_HEADERS | {"server", "date"}
+PROXY_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS"]
+
+class PodClients:
+    """
+    每个 pod 一个 httpx.AsyncClient，使用独立的连接池和 keep-alive，
+    一个繁忙的 pod 不会占满其他 pod 的连接。超过上限时关闭最久未使用的连接池。
+    """
+    def __init__(self, max_clients: int = PROXY_MAX_CLIENTS):
+        self.max_clients = max_clients
+        self.clients = OrderedDict()  # base url -> httpx.AsyncClient
+        self.limits = httpx.Limits(max_connections=PROXY_MAX_CONNECTIONS,
+                                   max_keepalive_connections=PROXY_MAX_KEEPALIVE,
+                                   keepalive_expiry=PROXY_KEEPALIVE_EXPIRY)
+        self.timeout = httpx.Timeout(PROXY_READ_TIMEOUT, connect=5.0)
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        pod_client = self.clients.get(base_url)
+        if pod_client is None:
+            pod_client = self.clients[base_url] = httpx.AsyncClient(
+                base_url=base_url, limits=self.limits, timeout=self.timeout, http2=PROXY_HTTP2)
+            while len(self.clients) > self.max_clients:
+                _, evicted = self.clients.popitem(last=False)
+                asyncio.create_task(evicted.aclose())
+        else:
+            self.clients.move_to_end(base_url)
+        return pod_client
+
+    async def aclose(self):
+        for pod_client in self.clients.values():
+            await pod_client.aclose()
+        self.clients.clear()
+
+pod_clients = PodClients()
+
+class ProxyStats:
+    """代理开销（收到请求到开始向 pod 发送的耗时）和 pod 响应耗时的统计。"""
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.overhead = deque(maxlen=PROXY_SAMPLES)
+        self.upstream = deque(maxlen=PROXY_SAMPLES)
+
+    def record(self, overhead: float, upstream: float):
+        self.requests += 1
+        self.overhead.append(overhead)
+        self.upstream.append(upstream)
+
+    @staticmethod
+    def percentiles(samples) -> dict:
+        ordered = sorted(samples)
+        if not ordered:
+            return {}
+        return {f"p{q}": round(ordered[min(len(ordered) - 1, len(ordered) * q // 100)] * 1000, 3)
+                for q in (50, 95, 99)}
+
+    def snapshot(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "http2": PROXY_HTTP2,
+                "pools": len(pod_clients.clients),
+                "overhead_ms": self.percentiles(self.overhead),
+                "upstream_ms": self.percentiles(self.upstream)}
 
-@app.get("/{sessionid}/processes")
-async def get_processes(sessionid: str):
+proxy_stats = ProxyStats()
+
+async def lookup_host(sessionid: str) -> str:
+    """get_host, recording in /metrics whether the route table answered or Kubernetes was needed."""
+    route = "hit" if sessionid in remote_sessions or pod_router.lookup(sessionid) else "miss"
+    started = time.perf_counter()
     try:
+        # 迁移中的 session 等迁移完成后再查路由；新 pod 在恢复快照完成之前不接收请求
+        await checkpoint_store.wait_restored(sessionid)
         host = await get_host(sessionid)
-        print(f"url is {host}/{sessionid}/processes")
-        response = await client.get(f"{host}/{sessionid}/processes")
-        return response.json()
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to get processes: {str(e)}")
+        await checkpoint_store.wait_restored(sessionid)
+        return host
+    finally:
+        route_lookup_seconds.observe(time.perf_counter() - started, route)
+
+@app.on_event("shutdown")
+async def close_pod_clients():
+    await pod_clients.aclose()
+
+@app.get("/cluster/proxy")
+async def get_proxy_stats():
+    return proxy_stats.snapshot()
+
+###############################
+#    Batch Fan-out            #
+###############################
+
+BATCH_MAX_PODS = int(os.environ.get("GATEWAY_BATCH_MAX_PODS", "4"))  # 一个 batch 最多分发到的 pod 数
+BATCH_SHARD_PATTERN = re.compile(r".+-batch-\d+")
+
+class BatchFanoutRequest(BaseModel):
+    """pod 上 /exec/batch 的请求体加上 pods，条目的字段由 pod 校验。"""
+    items: List[Dict[str, Any]]
+    parallelism: Optional[int] = None
+    inline_images: bool = False
+    pods: int = 1
+
+def is_batch_shard(sessionid: str) -> bool:
+    return BATCH_SHARD_PATTERN.fullmatch(sessionid) is not None
 
-@app.post("/{sessionid}/process/kill/{pid}")
-async def kill_process(sessionid: str, pid: int):
+def batch_shards(sessionid: str, request: BatchFanoutRequest) -> list:
+    """
+    按 round-robin 把 batch 的条目分成若干份：第一份在 session 自己的 pod 上执行，
+    其余的在子 session（{sessionid}-batch-{n}）的 pod 上执行，子 session 空闲后由回收器删除。
+    返回 [(shard sessionid, 分片的请求体, 条目在原 batch 中的下标)]。
+    """
+    items = request.items
+    if not items:
+        raise HTTPException(status_code=400, detail="A batch must contain at least one item")
+    body = request.dict(exclude={"pods"})
+    pods = max(1, min(request.pods, BATCH_MAX_PODS, len(items)))
+    shards = []
+    for shard in range(pods):
+        indices = list(range(shard, len(items), pods))
+        shard_sessionid = sessionid if shard == 0 else f"{sessionid}-batch-{shard}"
+        shards.append((shard_sessionid, {**body, "items": [items[index] for index in indices]}, indices))
+    return shards
+
+async def check_shardable(sessionid: str, shards: list):
+    """
+    子 session 的 pod 是全新的沙箱：没有该 session 上传或生成的文件，也没有常驻 kernel 中的变量。
+    session 已经有文件时拒绝分发到多个 pod，而不是让部分条目在看不到这些文件的 pod 上执行。
+    """
+    if len(shards) < 2:
+        return
+    host = await lookup_host(sessionid)
     try:
-        host = await get_host(sessionid)
-        response = await client.post(f"{host}/{sessionid}/process/kill/{pid}")
-        return response.json()
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to kill process: {str(e)}")
+        response = await pod_clients.get(host).get(f"/{sessionid}/files/list", params={"limit": 1})
+        response.raise_for_status()
+        total = response.json()["total"]
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        raise HTTPException(status_code=502, detail=f"Failed to list files of session {sessionid}: {e}")
+    if total:
+        raise HTTPException(status_code=400,
+                            detail="Session has files; shard pods cannot see them, use pods=1")
 
-@app.post("/{sessionid}/files/upload")
-async def upload_file(sessionid: str):
+async def shard_host(sessionid: str, shard_sessionid: str) -> tuple:
+    """Return (sessionid, host) to run a shard on; without room for a shard pod it runs on the session's own pod."""
     try:
-        host = await get_host(sessionid)
-        response = await client.post(f"{host}/{sessionid}/files/upload")
-        return response.json()
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
+        return shard_sessionid, await lookup_host(shard_sessionid)
+    except HTTPException as e:
+        if e.status_code != 503 or shard_sessionid == sessionid:
+            raise
+        return sessionid, await lookup_host(sessionid)
 
-@app.get("/{sessionid}/files/download/{filename}")
-async def download_file(sessionid: str, filename: str):
+def response_detail(response: httpx.Response):
+    """The detail of an error response, or its text when the body is not JSON."""
     try:
-        host = await get_host(sessionid)
-        response = await client.get(f"{host}/{sessionid}/files/download/{filename}", stream=True)
-        return StreamingResponse(response.aiter_raw(),
-                               headers={"Content-Disposition": f"attachment; filename={filename}"})
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to download file: {str(e)}")
+        body = response.json()
+    except ValueError:
+        return response.text
+    return body.get("detail") if isinstance(body, dict) else body
 
-@app.delete("/{sessionid}/files/delete/{filename}")
-async def delete_file(sessionid: str, filename: str):
+async def run_shard(sessionid: str, shard_sessionid: str, body: dict, indices: list) -> list:
     try:
-        host = await get_host(sessionid)
-        response = await client.delete(f"{host}/{sessionid}/files/delete/{filename}")
-        return response.json()
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to delete file: {str(e)}")
+        target, host = await shard_host(sessionid, shard_sessionid)
+        response = await pod_clients.get(host).post(f"/{target}/exec/batch", json=body)
+        if response.status_code != 200:
+            detail = response_detail(response)
+            return [{"index": index, "type": "error", "status_code": response.status_code, "detail": detail}
+                    for index in indices]
+        results = response.json()["results"]
+    except (httpx.HTTPError, HTTPException) as e:
+        status_code = e.status_code if isinstance(e, HTTPException) else 502
+        return [{"index": index, "type": "error", "status_code": status_code, "detail": str(e)}
+                for index in indices]
+    for result in results:
+        result["index"] = indices[result["index"]]
+    return results
 
-@app.post("/{sessionid}/exec/python")
-async def exec_python(sessionid: str, request: ExecRequest):
+async def stream_shard(sessionid: str, shard_sessionid: str, body: dict, indices: list, lines: asyncio.Queue):
+    """Forward one shard's NDJSON results into lines, rewriting each index to the original batch position."""
     try:
-        host = await get_host(sessionid)
-        response = await client.post(f"{host}/{sessionid}/exec/python",
-                                  json={"code": request.code})
-        return response.json()
-    except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to execute python code: {str(e)}")
+        target, host = await shard_host(sessionid, shard_sessionid)
+        async with pod_clients.get(host).stream("POST", f"/{target}/exec/batch/stream", json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                detail = response_detail(response)
+                for index in indices:
+                    await lines.put({"index": index, "type": "error", "status_code": response.status_code,
+                                     "detail": detail})
+                return
+            async for line in response.aiter_lines():
+                if line:
+                    result = json.loads(line)
+                    result["index"] = indices[result["index"]]
+                    await lines.put(result)
+    except (httpx.HTTPError, HTTPException) as e:
+        status_code = e.status_code if isinstance(e, HTTPException) else 502
+        for index in indices:
+            await lines.put({"index": index, "type": "error", "status_code": status_code, "detail": str(e)})
+    finally:
+        await lines.put(None)
 
-@app.post("/{sessionid}/exec/nodejs")
-async def exec_nodejs(sessionid: str, request: ExecRequest):
+async def merge_shard_streams(sessionid: str, shards: list):
+    lines = asyncio.Queue()
+    tasks = [asyncio.create_task(stream_shard(sessionid, *shard, lines)) for shard in shards]
     try:
-        host = await get_host(sessionid)
-        response = await client.post(f"{host}/{sessionid}/exec/nodejs",
-                                  json={"code": request.code})
-        return response.json()
+        remaining = len(tasks)
+        while remaining:
+            result = await lines.get()
+            if result is None:
+                remaining -= 1
+                continue
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+
+@app.post("/{sessionid}/exec/batch")
+async def exec_batch(sessionid: str, request: BatchFanoutRequest):
+    """
+    请求体与 pod 上的 /exec/batch 相同，另外可以指定 pods：把条目分发到多个 pod 上并行执行，
+    结果按原来的顺序合并返回。
+    """
+    shards = batch_shards(sessionid, request)
+    await check_shardable(sessionid, shards)
+    results = await asyncio.gather(*[run_shard(sessionid, *shard) for shard in shards])
+    return {"results": sorted((result for shard in results for result in shard), key=lambda result: result["index"])}
+
+@app.post("/{sessionid}/exec/batch/stream")
+async def exec_batch_stream(sessionid: str, request: BatchFanoutRequest):
+    shards = batch_shards(sessionid, request)
+    await check_shardable(sessionid, shards)
+    return StreamingResponse(merge_shard_streams(sessionid, shards), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+###############################
+#    Checkpoint & Migration   #
+###############################
+
+CHECKPOINT_DIR = Path(os.environ.get("GATEWAY_CHECKPOINT_DIR",
+                                     os.path.join(tempfile.gettempdir(), "sandbox-checkpoints")))
+CHECKPOINT_INTERVAL = float(os.environ.get("GATEWAY_CHECKPOINT_INTERVAL", "0"))  # 定期为有新请求的 session 做快照（秒），0 表示关闭
+CHECKPOINT_CHUNK_SIZE = 256 * 1024
+CHECKPOINT_COMPRESSLEVEL = 1  # 恢复时重新打包用最快的压缩级别，瓶颈在传输和 pod 写盘
+CHECKPOINT_LIST_LIMIT = 1000  # pod 上 /files/list 的单页上限
+CHECKPOINT_MANIFEST = "manifest.json"
+CHECKPOINT_NAMESPACE = "namespace.pkl"
+CHECKPOINT_FILES_PREFIX = "files/"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+
+checkpoint_seconds = Histogram("gateway_checkpoint_seconds", "Time to checkpoint, restore or migrate a session.",
+                               ("operation",))
+checkpoint_bytes_total = Counter("gateway_checkpoint_bytes_total",
+                                 "Compressed checkpoint bytes pulled from or pushed to pods.", ("direction",))
+
+def session_host(sessionid: str) -> Optional[str]:
+    """The address of a running session, without starting a pod or counting as activity."""
+    return remote_sessions.get(sessionid) or pod_router.lookup(sessionid)
+
+def upstream_error(response: httpx.Response) -> HTTPException:
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        detail = response.text
+    return HTTPException(status_code=response.status_code, detail=detail)
+
+async def iter_archive(path: str):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, CHECKPOINT_CHUNK_SIZE):
+            yield chunk
+
+class CheckpointStore:
+    """
+    网关本地保存的 session 快照，pod 崩溃、被回收或迁移到另一个集群后可以恢复。
+    每个 session 一个目录：manifest.json 是文件列表，文件内容按 sha256 保存在 blobs/ 下，
+    namespace.pkl 是常驻 kernel 的变量。从 pod 拉取快照时只传输 sha256 变化过的文件，
+    恢复时只发送新 pod 上没有或内容不同的文件。
+    """
+    def __init__(self, directory: Path = CHECKPOINT_DIR, interval: float = CHECKPOINT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.locks = defaultdict(asyncio.Lock)
+        self.restoring = {}  # sessionid -> asyncio.Event，恢复或迁移完成后 set
+        self.checkpointed_at = {}  # sessionid -> time.monotonic()，与 session_reaper.last_active 比较
+        self.restores = {}  # sessionid -> 最近一次恢复的结果
+        self.task = None
+        self.stats = {"checkpoints": 0, "restores": 0, "migrations": 0, "errors": 0}
+
+    def start(self):
+        if self.interval > 0:
+            self.task = asyncio.create_task(self.checkpoint_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def path(self, sessionid: str) -> Path:
+        if not SESSION_ID_PATTERN.fullmatch(sessionid):
+            raise HTTPException(status_code=400, detail=f"Invalid session id {sessionid}")
+        return self.directory / sessionid
+
+    def load_manifest(self, sessionid: str) -> Optional[dict]:
+        try:
+            with open(self.path(sessionid) / CHECKPOINT_MANIFEST) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def has_checkpoint(self, sessionid: str) -> bool:
+        return (SESSION_ID_PATTERN.fullmatch(sessionid) is not None
+                and (self.directory / sessionid / CHECKPOINT_MANIFEST).exists())
+
+    def begin_restore(self, sessionid: str) -> bool:
+        """Mark the session as being restored if a checkpoint exists and nobody else is restoring it."""
+        if sessionid in self.restoring or not self.has_checkpoint(sessionid):
+            return False
+        self.restoring[sessionid] = asyncio.Event()
+        return True
+
+    def end_restore(self, sessionid: str):
+        event = self.restoring.pop(sessionid, None)
+        if event is not None:
+            event.set()
+
+    async def wait_restored(self, sessionid: str):
+        event = self.restoring.get(sessionid)
+        if event is not None:
+            await event.wait()
+
+    def store_member(self, archive: zipfile.ZipFile, member: str, directory: Path) -> tuple:
+        """Extract one member into a temp file under directory, returning (path, sha256, size)."""
+        fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".extract-")
+        digest = hashlib.sha256()
+        size = 0
+        with os.fdopen(fd, "wb") as dest, archive.open(member) as src:
+            while chunk := src.read(CHECKPOINT_CHUNK_SIZE):
+                dest.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        return temp_name, digest.hexdigest(), size
+
+    def store(self, sessionid: str, archive_path: str, previous: dict) -> tuple:
+        """
+        把 pod 返回的增量快照合并到已有的快照中，返回 (manifest, 传输的文件数)。
+        文件内容以边解压边计算出的 sha256 为准，不再被引用的 blob 被删除。
+        """
+        directory = self.path(sessionid)
+        blobs = directory / "blobs"
+        blobs.mkdir(parents=True, exist_ok=True)
+        with zipfile.ZipFile(archive_path) as archive:
+            pod_manifest = json.loads(archive.read(CHECKPOINT_MANIFEST))
+            members = set(archive.namelist())
+            files = {}
+            for entry in pod_manifest["files"]:
+                name = entry["filename"]
+                if CHECKPOINT_FILES_PREFIX + name in members:
+                    temp_name, sha256, size = self.store_member(archive, CHECKPOINT_FILES_PREFIX + name, blobs)
+                    os.replace(temp_name, blobs / sha256)
+                    entry = {**entry, "sha256": sha256, "size": size}
+                elif (previous["files"].get(name) or {}).get("sha256") != entry["sha256"]:
+                    raise HTTPException(status_code=502, detail=f"Checkpoint of session {sessionid} is missing {name}")
+                files[name] = entry
+            if CHECKPOINT_NAMESPACE in members:
+                temp_name, _, _ = self.store_member(archive, CHECKPOINT_NAMESPACE, directory)
+                os.replace(temp_name, directory / CHECKPOINT_NAMESPACE)
+            else:
+                (directory / CHECKPOINT_NAMESPACE).unlink(missing_ok=True)
+        manifest = {"sessionid": sessionid, "created_at": pod_manifest["created_at"], "files": files,
+                    "size": sum(entry["size"] for entry in files.values()), "namespace": pod_manifest["namespace"]}
+        fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".manifest-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(temp_name, directory / CHECKPOINT_MANIFEST)
+        referenced = {entry["sha256"] for entry in files.values()}
+        for blob in blobs.iterdir():
+            if blob.name not in referenced:
+                blob.unlink(missing_ok=True)
+        return manifest, len(pod_manifest.get("included") or [])
+
+    async def pull(self, sessionid: str, host: str, namespace: bool = True) -> dict:
+        """Fetch an incremental checkpoint from the session's pod into the store."""
+        started = time.perf_counter()
+        directory = self.path(sessionid)
+        directory.mkdir(parents=True, exist_ok=True)
+        previous = await asyncio.to_thread(self.load_manifest, sessionid) or {"files": {}}
+        base = {name: entry["sha256"] for name, entry in previous["files"].items()}
+        # 在请求 pod 之前记录，做快照期间的新请求会触发下一轮快照
+        self.checkpointed_at[sessionid] = time.monotonic()
+        fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".checkpoint-", suffix=".zip")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                try:
+                    async with pod_clients.get(host).stream("POST", f"/{sessionid}/checkpoint",
+                                                            json={"base": base, "namespace": namespace}) as response:
+                        if response.status_code != 200:
+                            await response.aread()
+                            raise upstream_error(response)
+                        async for chunk in response.aiter_bytes(CHECKPOINT_CHUNK_SIZE):
+                            await asyncio.to_thread(f.write, chunk)
+                except httpx.HTTPError as e:
+                    raise HTTPException(status_code=502, detail=f"Failed to checkpoint session {sessionid}: {e}")
+            archive_size = os.path.getsize(temp_name)
+            try:
+                manifest, transferred = await asyncio.to_thread(self.store, sessionid, temp_name, previous)
+            except (zipfile.BadZipFile, KeyError, ValueError) as e:
+                raise HTTPException(status_code=502, detail=f"Invalid checkpoint from session {sessionid}: {e}")
+        finally:
+            os.unlink(temp_name)
+        seconds = time.perf_counter() - started
+        checkpoint_seconds.observe(seconds, "checkpoint")
+        checkpoint_bytes_total.inc("pull", amount=archive_size)
+        self.stats["checkpoints"] += 1
+        return {"sessionid": sessionid, "files": len(manifest["files"]), "transferred": transferred,
+                "size": manifest["size"], "archive_size": archive_size, "namespace": manifest["namespace"],
+                "seconds": round(seconds, 3)}
+
+    async def pod_files(self, pod_client: httpx.AsyncClient, sessionid: str) -> dict:
+        """{filename: sha256} of the files already on the pod; the first page rescans its directory."""
+        files, offset = {}, 0
+        while True:
+            response = await pod_client.get(f"/{sessionid}/files/list", params={
+                "offset": offset, "limit": CHECKPOINT_LIST_LIMIT, "refresh": str(offset == 0).lower()})
+            if response.status_code != 200:
+                raise upstream_error(response)
+            page = response.json()
+            files.update((entry["filename"], entry["sha256"]) for entry in page["files"])
+            offset += len(page["files"])
+            if not page["files"] or offset >= page["total"]:
+                return files
+
+    def pack(self, sessionid: str, manifest: dict, present: dict, archive_path: str) -> int:
+        """Write a restore archive with the files the pod does not have yet; returns how many were included."""
+        directory = self.path(sessionid)
+        included = [name for name, entry in sorted(manifest["files"].items()) if present.get(name) != entry["sha256"]]
+        pod_manifest = {"sessionid": sessionid, "created_at": manifest["created_at"],
+                        "files": list(manifest["files"].values()), "included": included,
+                        "namespace": manifest["namespace"]}
+        with zipfile.ZipFile(archive_path, "w", compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=CHECKPOINT_COMPRESSLEVEL) as archive:
+            archive.writestr(CHECKPOINT_MANIFEST, json.dumps(pod_manifest, ensure_ascii=False))
+            for name in included:
+                archive.write(directory / "blobs" / manifest["files"][name]["sha256"], CHECKPOINT_FILES_PREFIX + name)
+            if (directory / CHECKPOINT_NAMESPACE).exists():
+                archive.write(directory / CHECKPOINT_NAMESPACE, CHECKPOINT_NAMESPACE)
+        return len(included)
+
+    async def push(self, sessionid: str, host: str) -> dict:
+        """Restore the stored checkpoint onto the pod at host."""
+        started = time.perf_counter()
+        manifest = await asyncio.to_thread(self.load_manifest, sessionid)
+        if manifest is None:
+            raise HTTPException(status_code=404, detail=f"No checkpoint for session {sessionid}")
+        pod_client = pod_clients.get(host)
+        fd, temp_name = tempfile.mkstemp(dir=self.path(sessionid), prefix=".restore-", suffix=".zip")
+        os.close(fd)
+        try:
+            try:
+                present = await self.pod_files(pod_client, sessionid)
+                transferred = await asyncio.to_thread(self.pack, sessionid, manifest, present, temp_name)
+                archive_size = os.path.getsize(temp_name)
+                response = await pod_client.post(f"/{sessionid}/checkpoint/restore", content=iter_archive(temp_name),
+                                                 headers={"Content-Type": "application/zip"})
+            except httpx.HTTPError as e:
+                raise HTTPException(status_code=502, detail=f"Failed to restore session {sessionid}: {e}")
+            if response.status_code != 200:
+                raise upstream_error(response)
+        finally:
+            os.unlink(temp_name)
+        restored = response.json()
+        seconds = time.perf_counter() - started
+        checkpoint_seconds.observe(seconds, "restore")
+        checkpoint_bytes_total.inc("push", amount=archive_size)
+        self.stats["restores"] += 1
+        result = {"sessionid": sessionid, "host": host, "files": len(manifest["files"]), "transferred": transferred,
+                  "deleted": len(restored["deleted"]), "size": manifest["size"], "archive_size": archive_size,
+                  "namespace": restored["namespace"], "checkpoint_created_at": manifest["created_at"],
+                  "finished_at": time.time(), "seconds": round(seconds, 3)}
+        self.restores[sessionid] = result
+        return result
+
+    async def checkpoint(self, sessionid: str, namespace: bool = True) -> dict:
+        host = session_host(sessionid)
+        if host is None:
+            raise HTTPException(status_code=404, detail=f"Session {sessionid} has no running sandbox")
+        if sessionid in self.restoring:
+            raise HTTPException(status_code=409, detail=f"Session {sessionid} is being restored")
+        async with self.locks[sessionid]:
+            return await self.pull(sessionid, host, namespace)
+
+    async def recover(self, sessionid: str, host: str):
+        """
+        在新 pod 上恢复快照，由 start_session 调用。恢复失败时记录错误，session 以空的状态继续使用，
+        快照保留，可以通过 /cluster/sessions/{sessionid}/restore 重试。
+        """
+        async with self.locks[sessionid]:
+            try:
+                result = await self.push(sessionid, host)
+                print(f"Restored session {sessionid}: {result['transferred']}/{result['files']} files, "
+                      f"{result['archive_size']} bytes in {result['seconds']}s")
+            except Exception as e:
+                self.stats["errors"] += 1
+                self.restores[sessionid] = {"sessionid": sessionid, "host": host, "error": str(e),
+                                            "finished_at": time.time()}
+                print(f"Failed to restore checkpoint of session {sessionid}: {e}")
+
+    async def restore(self, sessionid: str) -> dict:
+        if not self.has_checkpoint(sessionid):
+            raise HTTPException(status_code=404, detail=f"No checkpoint for session {sessionid}")
+        host = await lookup_host(sessionid)
+        async with self.locks[sessionid]:
+            return await self.push(sessionid, host)
+
+    async def migrate(self, sessionid: str, cluster: Optional[str] = None) -> dict:
+        """
+        把 session 迁移到新的 pod：做一次快照，删除旧 pod，由放置引擎（或指定的 cluster）选择新的位置，
+        再恢复快照。迁移期间该 session 的请求在 lookup_host 中等待，迁移完成后转发到新的 pod。
+        """
+        if cluster == REMOTE_CLUSTER and not placement.remote_url:
+            raise HTTPException(status_code=400, detail="No remote cluster is configured")
+        source = session_host(sessionid)
+        if source is None:
+            raise HTTPException(status_code=404, detail=f"Session {sessionid} has no running sandbox")
+        if sessionid in self.restoring:
+            raise HTTPException(status_code=409, detail=f"Session {sessionid} is being restored")
+        started = time.perf_counter()
+        self.restoring[sessionid] = asyncio.Event()
+        try:
+            async with self.locks[sessionid]:
+                checkpoint = await self.pull(sessionid, source)
+                await session_reaper.reclaim([sessionid], "migrated")
+                host = await get_host(sessionid, cluster)
+                restore = await self.push(sessionid, host)
+        finally:
+            self.end_restore(sessionid)
+        seconds = time.perf_counter() - started
+        checkpoint_seconds.observe(seconds, "migrate")
+        self.stats["migrations"] += 1
+        print(f"Migrated session {sessionid} from {source} to {host} in {seconds:.3f}s")
+        return {"sessionid": sessionid, "from": source, "to": host, "checkpoint": checkpoint, "restore": restore,
+                "seconds": round(seconds, 3)}
+
+    async def delete(self, sessionid: str) -> bool:
+        directory = self.path(sessionid)
+        async with self.locks[sessionid]:
+            self.checkpointed_at.pop(sessionid, None)
+            self.restores.pop(sessionid, None)
+            if not directory.exists():
+                return False
+            await asyncio.to_thread(shutil.rmtree, directory)
+            return True
+
+    async def checkpoint_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for sessionid, last_active in list(session_reaper.last_active.items()):
+                if (last_active <= self.checkpointed_at.get(sessionid, 0) or sessionid in self.restoring
+                        or session_host(sessionid) is None):
+                    continue
+                try:
+                    await self.checkpoint(sessionid)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"Failed to checkpoint session {sessionid}: {e}")
+
+    def describe(self, sessionid: str) -> dict:
+        manifest = self.load_manifest(sessionid)
+        if manifest is None:
+            raise HTTPException(status_code=404, detail=f"No checkpoint for session {sessionid}")
+        return {"sessionid": sessionid, "created_at": manifest["created_at"], "files": len(manifest["files"]),
+                "size": manifest["size"], "namespace": manifest["namespace"],
+                "last_restore": self.restores.get(sessionid)}
+
+    def snapshot(self) -> dict:
+        return {"directory": str(self.directory), "interval": self.interval, "restoring": len(self.restoring),
+                **self.stats}
+
+checkpoint_store = CheckpointStore()
+
+@app.on_event("startup")
+async def start_checkpoint_store():
+    checkpoint_store.start()
+
+@app.on_event("shutdown")
+async def stop_checkpoint_store():
+    await checkpoint_store.stop()
+
+@app.get("/cluster/checkpoints")
+async def get_checkpoints():
+    return checkpoint_store.snapshot()
+
+@app.get("/cluster/sessions/{sessionid}/checkpoint")
+async def get_checkpoint(sessionid: str):
+    return await asyncio.to_thread(checkpoint_store.describe, sessionid)
+
+@app.post("/cluster/sessions/{sessionid}/checkpoint")
+async def create_checkpoint(sessionid: str, namespace: bool = True):
+    """从 session 的 pod 拉取增量快照（文件区和常驻 kernel 的变量）保存在网关，返回快照大小和耗时。"""
+    return await checkpoint_store.checkpoint(sessionid, namespace)
+
+@app.delete("/cluster/sessions/{sessionid}/checkpoint")
+async def delete_checkpoint(sessionid: str):
+    if await checkpoint_store.delete(sessionid):
+        return {"message": f"Deleted checkpoint of session {sessionid}"}
+    raise HTTPException(status_code=404, detail=f"No checkpoint for session {sessionid}")
+
+@app.post("/cluster/sessions/{sessionid}/restore")
+async def restore_checkpoint(sessionid: str):
+    """把保存的快照恢复到 session 当前的 pod（没有 pod 时创建），返回传输的大小和耗时。"""
+    return await checkpoint_store.restore(sessionid)
+
+@app.post("/cluster/sessions/{sessionid}/migrate")
+async def migrate_session(sessionid: str, cluster: Optional[Literal["local", "remote"]] = None):
+    return await checkpoint_store.migrate(sessionid, cluster)
+
+###############################
+#    Observability            #
+###############################
+
+PROFILE_ENABLED = os.environ.get("GATEWAY_PROFILE_ENABLED", "0") == "1"  # py-spy 需要 SYS_PTRACE 权限，默认关闭
+PROFILE_MAX_DURATION = int(os.environ.get("GATEWAY_PROFILE_MAX_DURATION", "60"))  # 单次采样的最长秒数
+
+def collect_gauges() -> list:
+    routes, warm, reaper = pod_router.snapshot(), warm_pool.snapshot(), session_reaper.snapshot()
+    metrics_age = cluster_metrics.age()
+    return [
+        ("gateway_sessions_routed", "Sessions with a pod in the route table.", "gauge", routes["sessions"]),
+        ("gateway_sessions_ready", "Sessions whose pod is ready.", "gauge", routes["ready"]),
+        ("gateway_sessions_remote", "Sessions placed on the remote cluster.", "gauge", len(remote_sessions)),
+        ("gateway_route_waits_total", "Requests that waited for a pod to become ready.", "counter", routes["waits"]),
+        ("gateway_route_timeouts_total", "Requests that gave up waiting for a pod.", "counter", routes["timeouts"]),
+        ("gateway_warm_pods", "Unclaimed pods in the warm pool.", "gauge", warm["warm"]),
+        ("gateway_warm_pool_claims_total", "Sessions started on a warm pod.", "counter", warm["claims"]),
+        ("gateway_warm_pool_misses_total", "Sessions that found the warm pool empty.", "counter", warm["misses"]),
+        ("gateway_reaper_deleted_pods_total", "Session pods deleted by the reaper.", "counter",
+         reaper["deleted_pods"]),
+        ("gateway_placements_local_total", "Sessions placed on the local cluster.", "counter",
+         placement.stats[LOCAL_CLUSTER]),
+        ("gateway_placements_remote_total", "Sessions spilled over to the remote cluster.", "counter",
+         placement.stats[REMOTE_CLUSTER]),
+        ("gateway_placements_rejected_total", "Sessions that could not be placed.", "counter",
+         placement.stats["rejected"]),
+        ("gateway_cluster_metrics_age_seconds", "Age of the cached node metrics snapshot.", "gauge",
+         metrics_age if metrics_age is not None else "NaN"),
+        ("gateway_proxy_pools", "Per-pod HTTP connection pools.", "gauge", len(pod_clients.clients)),
+        ("gateway_checkpoints_total", "Checkpoints pulled from session pods.", "counter",
+         checkpoint_store.stats["checkpoints"]),
+        ("gateway_checkpoint_restores_total", "Checkpoints restored onto pods.", "counter",
+         checkpoint_store.stats["restores"]),
+        ("gateway_session_migrations_total", "Sessions moved to a new pod.", "counter",
+         checkpoint_store.stats["migrations"]),
+        ("gateway_checkpoint_errors_total", "Failed checkpoints and restores.", "counter",
+         checkpoint_store.stats["errors"]),
+    ]
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus 文本格式的指标：路由查找和代理各阶段的耗时直方图、请求计数和调度组件的当前状态。"""
+    lines = []
+    for metric in (route_lookup_seconds, proxy_stage_seconds, proxy_requests_total, checkpoint_seconds,
+                   checkpoint_bytes_total):
+        lines += metric.render()
+    lines += render_gauges(collect_gauges())
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def profile(duration: int = Query(10, ge=1), rate: int = Query(100, ge=1, le=1000),
+                  format: Literal["flamegraph", "speedscope", "raw"] = "flamegraph"):
+    """
+    用 py-spy 对网关进程采样 duration 秒，返回火焰图（svg）、speedscope（json）或折叠栈（raw）。
+    需要设置 GATEWAY_PROFILE_ENABLED=1。
+    """
+    if not PROFILE_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiling is disabled")
+    data = await record_profile(os.getpid(), min(duration, PROFILE_MAX_DURATION), rate, format)
+    return Response(data, media_type=PROFILE_FORMATS[format])
+
+@app.api_route("/{sessionid}/{path:path}", methods=PROXY_METHODS)
+async def proxy(sessionid: str, path: str, request: Request):
+    """
+    将 /{sessionid}/... 的所有请求转发到该 session 的 pod：请求体和响应体都以流的方式转发，
+    不在网关中解码或缓冲；状态码和头部（除逐跳头部外）原样返回。
+    Server-Timing 头中的 gateway 是网关自身的开销（路由和建立请求），upstream 是等待 pod 响应头的时间。
+    """
+    started = time.perf_counter()
+    host = await lookup_host(sessionid)
+    looked_up = time.perf_counter()
+    pod_client = pod_clients.get(host)
+    headers = [(name, value) for name, value in request.headers.items() if name not in HOP_BY_HOP_HEADERS]
+    content = request.stream() if request.method in ("POST", "PUT", "PATCH") else None
+    upstream = pod_client.build_request(request.method, f"/{sessionid}/{path}", params=request.url.query,
+                                        headers=headers, content=content)
+    sent = time.perf_counter()
+    try:
+        response = await pod_client.send(upstream, stream=True)
     except httpx.HTTPError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to execute nodejs code: {str(e)}")
\ No newline at end of file
+        proxy_stats.errors += 1
+        proxy_requests_total.inc(request.method, 502)
+        raise HTTPException(status_code=502, detail=f"Failed to proxy request: {str(e)}")
+    received = time.perf_counter()
+    proxy_stats.record(sent - started, received - sent)
+    proxy_stage_seconds.observe(sent - looked_up, "proxy")
+    proxy_stage_seconds.observe(received - sent, "upstream")
+    proxy_requests_total.inc(request.method, response.status_code)
+    proxied = StreamingResponse(response.aiter_raw(), status_code=response.status_code,
+                                background=BackgroundTask(response.aclose))
+    proxied.raw_headers = [(name.encode("latin-1"), value.encode("latin-1"))
+                           for name, value in response.headers.multi_items()
+                           if name not in PROXY_RESPONSE_EXCLUDED_HEADERS]
+    proxied.raw_headers.append((b"server-timing", f"gateway;dur={(sent - started) * 1000:.3f}, "
+                                                  f"upstream;dur={(received - sent) * 1000:.3f}".encode()))
+    return proxied
@@ -0,0 +1,105 @@
+"""
+app.py 和 gateway.py 共用的 Prometheus 指标类型和 py-spy 采样，两个服务在各自的进程中分别持有指标和采样锁。
+"""
+from fastapi import HTTPException
+from collections import defaultdict
+from pathlib import Path
+from typing import Optional
+import asyncio
+import shutil
+import tempfile
+
+# 覆盖从编译缓存命中（亚毫秒）到长时间执行（分钟级）的耗时
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+PROFILE_FORMATS = {"flamegraph": "image/svg+xml", "speedscope": "application/json", "raw": "text/plain"}
+profile_lock = asyncio.Lock()
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    """Prometheus counter with a fixed set of label names; only updated from the event loop."""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1.0):
+        self.values[labels] += amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus histogram with cumulative buckets."""
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [每个桶的计数..., sum, count]
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self.series.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, ('le', bound))} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {series[-1]}")
+        return lines
+
+def render_gauges(gauges: list) -> list:
+    """gauges 为 [(name, help, type, value)]，用于在抓取时从各组件的 snapshot 导出当前值。"""
+    lines = []
+    for name, help, kind, value in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return lines
+
+async def record_profile(pid: int, duration: int, rate: int, format: str, subprocesses: bool = False) -> bytes:
+    """Sample pid with py-spy for duration seconds and return the rendered profile."""
+    py_spy = shutil.which("py-spy")
+    if py_spy is None:
+        raise HTTPException(status_code=503, detail="py-spy is not installed")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already being recorded")
+    async with profile_lock:
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / "profile"
+            # --nonblocking 不暂停被采样的进程，对正在处理的请求影响最小
+            args = [py_spy, "record", "--pid", str(pid), "--duration", str(duration), "--rate", str(rate),
+                    "--format", format, "--output", str(output), "--nonblocking"]
+            if subprocesses:
+                args.append("--subprocesses")
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL,
+                                                           stderr=asyncio.subprocess.PIPE)
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), duration + 30)
+            except asyncio.TimeoutError:
+                process.kill()
+                raise HTTPException(status_code=504, detail="py-spy did not finish in time")
+            if process.returncode != 0 or not output.exists():
+                raise HTTPException(status_code=500, detail=f"采样失败: {stderr.decode(errors='replace').strip()}")
+            return output.read_bytes()
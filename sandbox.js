@@ -1,55 +1,106 @@
 const { VM } = require('vm2');
-const fs = require('fs');
-
-const filePath = process.argv[2];
-const timeout = parseInt(process.argv[3]) || 30000;
-const output = [];
-let error = null;
-
-let code;
-try {
-    code = fs.readFileSync(filePath, 'utf8');
-    console.log('Received code:', code);
-} catch (e) {
-    error = { name: e.name, message: e.message, stack: e.stack };
-    console.log('Error reading file:', error);
+const readline = require('readline');
+
+// 常驻 worker：从 stdin 逐行读取 JSON 任务 {id, code, timeout}，
+// 每个任务使用独立的 vm2 上下文执行，结果以 __RESULT__: 开头的一行 JSON 写回 stdout。
+const RESULT_PREFIX = '__RESULT__:';
+
+function send(frame) {
+    process.stdout.write(RESULT_PREFIX + JSON.stringify(frame) + '\n');
+}
+
+// 每个任务使用自己的 setTimeout，任务结束时清除尚未触发的定时器，
+// 回调不会在之后的任务中执行（向之后任务的输出或结果写入内容）。
+function jobTimers() {
+    const pending = new Set();
+    const wrappedSetTimeout = (callback, delay, ...args) => {
+        if (typeof callback !== 'function') {
+            throw new TypeError('The "callback" argument must be of type function');
+        }
+        const handle = setTimeout(() => {
+            pending.delete(handle);
+            callback(...args);
+        }, delay);
+        pending.add(handle);
+        return handle;
+    };
+    const wrappedClearTimeout = (handle) => {
+        if (pending.delete(handle)) {
+            clearTimeout(handle);
+        }
+    };
+    const clearAll = () => {
+        for (const handle of pending) {
+            clearTimeout(handle);
+        }
+        pending.clear();
+    };
+    return { setTimeout: wrappedSetTimeout, clearTimeout: wrappedClearTimeout, clearAll };
 }
 
-const vm = new VM({
-    timeout: timeout * 1000,
-    sandbox: {
-        console: {
-            log: (...args) => {
-                output.push(args.join(' '));
-            }
+function runJob(job) {
+    const output = [];
+    // 流式任务每次输出都立即发回一帧，非流式任务在结束时一次性返回
+    const emit = (text, newline) => {
+        if (job.stream) {
+            send({ id: job.id, type: 'stdout', data: newline ? text + '\n' : text });
+        } else {
+            output.push(text);
+        }
+    };
+    let error = null;
+    let image = null;
+    const timeout = parseInt(job.timeout) || 30;
+    const timers = jobTimers();
+
+    const vm = new VM({
+        timeout: timeout * 1000,
+        sandbox: {
+            console: {
+                log: (...args) => {
+                    emit(args.join(' '), true);
+                }
+            },
+            setTimeout: timers.setTimeout,
+            clearTimeout: timers.clearTimeout,
+            Plotly: typeof Plotly !== 'undefined' ? Plotly : undefined,
+            // 提供模拟的 process 对象，写入 stdout 的内容计入输出而不是破坏协议帧
+            process: { stdin: null, stdout: { write: (chunk) => { emit(String(chunk), false); return true; } } }
         },
-        setTimeout,
-        Plotly: typeof Plotly !== 'undefined' ? Plotly : undefined,
-        process: { stdin: null, stdout: process.stdout } // 提供模拟的 process 对象
-    },
-    require: {
-        builtin: ['readline'] // 允许 readline 模块
-    }
-});
+        require: {
+            builtin: ['readline'] // 允许 readline 模块
+        }
+    });
 
-if (!error) {
     try {
-        console.log('Starting code execution');
-        vm.run(code);
-        console.log('Code execution completed');
+        vm.run(job.code);
         if (vm.run('typeof Plotly !== "undefined"')) {
-            console.log('Plotly detected, generating image');
             const fig = vm.run('fig || { data: [], layout: {} }');
             const img = vm.run(`Plotly.toImage(${JSON.stringify(fig)}, {format: 'png', width: 800, height: 600})`);
-            fs.writeFileSync('/tmp/plot.png', img.replace(/^data:image\/png;base64,/, ''), 'base64');
+            image = img.replace(/^data:image\/png;base64,/, '');
         }
     } catch (e) {
         error = { name: e.name, message: e.message, stack: e.stack };
-        console.log('Execution error:', error);
     }
+    timers.clearAll();
+
+    send({ id: job.id, type: 'done', output, error, image });
 }
 
-console.log('__OUTPUT__:' + JSON.stringify(output));
-if (error) {
-    console.log('__ERROR__:' + JSON.stringify(error));
-}
\ No newline at end of file
+const rl = readline.createInterface({ input: process.stdin, terminal: false });
+
+rl.on('line', (line) => {
+    if (!line.trim()) {
+        return;
+    }
+    let job;
+    try {
+        job = JSON.parse(line);
+    } catch (e) {
+        send({ id: null, output: [], error: { name: e.name, message: e.message, stack: e.stack }, image: null });
+        return;
+    }
+    runJob(job);
+});
+
+rl.on('close', () => process.exit(0));
@@ -0,0 +1,14 @@
+"""gateway 在导入时加载 kubeconfig（kubernetes.config 导入时读取 KUBECONFIG），测试中指向一个不会被访问的地址。"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+if "KUBECONFIG" not in os.environ:
+    kubeconfig = Path(tempfile.mkdtemp()) / "kubeconfig"
+    kubeconfig.write_text("apiVersion: v1\nkind: Config\nclusters:\n- cluster: {server: \"http://127.0.0.1:1\"}\n"
+                          "  name: fake\ncontexts:\n- context: {cluster: fake, user: fake}\n  name: fake\n"
+                          "current-context: fake\nusers:\n- name: fake\n  user: {token: fake}\n")
+    os.environ["KUBECONFIG"] = str(kubeconfig)
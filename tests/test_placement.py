@@ -0,0 +1,95 @@
+"""place_pod 和 PlacementEngine 在合成的集群快照上的放置决策。"""
+import asyncio
+
+import gateway
+
+GI = 1024 ** 3
+
+
+def node(name: str, cpu_usage: float, memory_usage: float, cpu: float = 4, memory: float = 8 * GI) -> dict:
+    return {"node": name, "cpu": {"usage": cpu_usage, "capacity": cpu},
+            "memory": {"usage": memory_usage, "capacity": memory}}
+
+
+def place(nodes, remote: bool = False, reserved=None) -> dict:
+    clusters = [{"name": gateway.LOCAL_CLUSTER, "nodes": nodes}]
+    if remote:
+        clusters.append({"name": gateway.REMOTE_CLUSTER, "nodes": None})
+    engine = gateway.PlacementEngine(None, remote_url="")
+    return gateway.place_pod(clusters, engine.request, engine.limit, reserved=reserved)
+
+
+class StaticMetrics:
+    """ClusterMetricsCache stand-in returning a fixed snapshot, or failing when nodes is None."""
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.updated_at = 1.0
+
+    async def current(self):
+        if self.nodes is None:
+            raise RuntimeError("Cluster metrics are not available")
+        return self.nodes
+
+
+def test_place_pod_packs_the_fullest_node_that_fits():
+    decision = place([node("idle", 0.5, 1 * GI), node("busy", 2.5, 4 * GI)])
+    assert decision["cluster"] == gateway.LOCAL_CLUSTER
+    assert decision["node"] == "busy"
+    assert decision["reason"] == "fits"
+
+
+def test_place_pod_skips_nodes_over_the_threshold():
+    # 2.9 + 0.5 核超过 4 核的 80%
+    decision = place([node("idle", 0.5, 1 * GI), node("busy", 2.9, 4 * GI)])
+    assert decision["node"] == "idle"
+
+
+def test_place_pod_counts_reserved_requests():
+    reserved = {"busy": (0.5, 256 * 1024 ** 2)}
+    decision = place([node("idle", 0.5, 1 * GI), node("busy", 2.5, 4 * GI)], reserved=reserved)
+    assert decision["node"] == "idle"
+
+
+def test_place_pod_spills_over_when_the_local_cluster_is_full():
+    full = [node("a", 3.5, 1 * GI), node("b", 0.5, 7 * GI)]
+    decision = place(full, remote=True)
+    assert decision["cluster"] == gateway.REMOTE_CLUSTER
+    assert decision["reason"] == "spillover"
+    assert place(full)["reason"] == "no capacity"
+
+
+def test_engine_reserves_until_the_next_refresh():
+    metrics = StaticMetrics((node("a", 2.0, 2 * GI), node("b", 1.0, 2 * GI)))
+    engine = gateway.PlacementEngine(metrics, remote_url="")
+
+    async def main():
+        first = await engine.place("s1")
+        second = await engine.place("s2")
+        # 两个 pod 的预留让 a 放不下第三个
+        third = await engine.place("s3")
+        metrics.updated_at = 2.0
+        refreshed = await engine.place("s4")
+        return first, second, third, refreshed
+
+    first, second, third, refreshed = asyncio.run(main())
+    assert (first["node"], second["node"], third["node"]) == ("a", "a", "b")
+    assert refreshed["node"] == "a"
+    assert engine.reserved == {"a": (0.5, 256 * 1024 ** 2)}
+
+
+def test_engine_moves_the_reservation_to_the_actual_node():
+    engine = gateway.PlacementEngine(StaticMetrics((node("a", 2.0, 2 * GI), node("b", 1.0, 2 * GI))), remote_url="")
+    asyncio.run(engine.place("s1"))
+    engine.settle("s1", "b")
+    assert engine.reserved["a"] == (0.0, 0.0)
+    assert engine.reserved["b"] == (0.5, 256 * 1024 ** 2)
+
+
+def test_engine_does_not_spill_when_metrics_are_unavailable():
+    engine = gateway.PlacementEngine(StaticMetrics(None), remote_url="http://remote")
+    decision = asyncio.run(engine.place("s1"))
+    assert decision["cluster"] == gateway.LOCAL_CLUSTER
+    assert decision["node"] is None
+    assert decision["reason"] == "metrics unavailable"
+    assert engine.reserved == {}
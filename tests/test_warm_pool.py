@@ -0,0 +1,167 @@
+"""WarmPodPool 的认领和补充，用内存中的 core_api 代替 Kubernetes API。"""
+import asyncio
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+import gateway
+
+
+def make_pod(name: str, labels: dict, version: int, node: str = "node-0", ready: bool = True) -> client.V1Pod:
+    conditions = [client.V1PodCondition(type="Ready", status="True" if ready else "False")]
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(name=name, labels=dict(labels), resource_version=str(version)),
+        spec=client.V1PodSpec(containers=[], node_name=node),
+        status=client.V1PodStatus(phase="Running", pod_ip="10.0.0.1", conditions=conditions))
+
+
+class FakeCoreApi:
+    """The pod calls WarmPodPool makes, against an in-memory pod table with resourceVersion checks."""
+
+    def __init__(self):
+        self.pods = {}
+        self.version = 0
+        self.created = []
+        self.deleted = []
+
+    def add(self, name: str, node: str = "node-0", ready: bool = True) -> client.V1Pod:
+        self.version += 1
+        pod = make_pod(name, {"app": "sandbox", "pool": gateway.WARM_POOL_LABEL}, self.version, node, ready)
+        self.pods[name] = pod
+        return pod
+
+    def patch_namespaced_pod(self, name, namespace, body):
+        pod = self.pods.get(name)
+        if pod is None:
+            raise ApiException(status=404, reason="Not Found")
+        if body["metadata"].get("resourceVersion") != pod.metadata.resource_version:
+            raise ApiException(status=409, reason="Conflict")
+        self.version += 1
+        pod.metadata.labels.update(body["metadata"]["labels"])
+        pod.metadata.resource_version = str(self.version)
+        return pod
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body["metadata"]["name"])
+
+    def delete_namespaced_pod(self, name, namespace):
+        self.deleted.append(name)
+        self.pods.pop(name, None)
+
+
+def make_pool(core_api: FakeCoreApi, low: int = 2, high: int = 4) -> gateway.WarmPodPool:
+    router = gateway.PodRouter(core_api)
+    for pod in core_api.pods.values():
+        router.apply("ADDED", pod)
+    router.synced.set()
+    pool = gateway.WarmPodPool(core_api, router, low=low, high=high)
+    pool.wakeup = asyncio.Event()
+    return pool
+
+
+def test_claim_labels_the_pod_and_routes_the_session():
+    core_api = FakeCoreApi()
+    core_api.add("warm-a", ready=False)
+    core_api.add("warm-b")
+
+    async def main():
+        pool = make_pool(core_api)
+        name = await pool.claim("s1")
+        return pool, name
+
+    pool, name = asyncio.run(main())
+    assert name == "warm-b"
+    assert core_api.pods["warm-b"].metadata.labels["sessionid"] == "s1"
+    assert pool.router.lookup("s1") == f"http://10.0.0.1:{gateway.SANDBOX_PORT}"
+    assert list(pool.router.warm) == ["warm-a"]
+    assert pool.stats["claims"] == 1
+
+
+def test_claim_prefers_the_placed_node():
+    core_api = FakeCoreApi()
+    core_api.add("warm-a", node="node-0")
+    core_api.add("warm-b", node="node-1")
+
+    async def main():
+        return await make_pool(core_api).claim("s1", "node-1")
+
+    assert asyncio.run(main()) == "warm-b"
+
+
+def test_claim_conflict_moves_on_to_the_next_pod():
+    core_api = FakeCoreApi()
+    core_api.add("warm-a")
+    core_api.add("warm-b")
+
+    async def main():
+        pool = make_pool(core_api)
+        # 另一个 gateway 实例先认领了 warm-a，路由表中的 resourceVersion 已经过期
+        core_api.patch_namespaced_pod("warm-a", "default", {"metadata": {
+            "labels": {"sessionid": "other", "pool": "claimed"},
+            "resourceVersion": core_api.pods["warm-a"].metadata.resource_version}})
+        name = await pool.claim("s1")
+        return pool, name
+
+    pool, name = asyncio.run(main())
+    assert name == "warm-b"
+    assert core_api.pods["warm-a"].metadata.labels["sessionid"] == "other"
+    assert pool.stats["conflicts"] == 1
+    assert pool.stats["claims"] == 1
+
+
+def test_claim_returns_none_when_the_pool_is_empty():
+    async def main():
+        pool = make_pool(FakeCoreApi())
+        return pool, await pool.claim("s1")
+
+    pool, name = asyncio.run(main())
+    assert name is None
+    assert pool.stats["misses"] == 1
+    assert pool.wakeup.is_set()
+
+
+def test_refill_respects_the_watermarks(monkeypatch):
+    async def can_schedule():
+        return True
+
+    monkeypatch.setattr(gateway, "can_schedule_secret_k8s", can_schedule)
+    core_api = FakeCoreApi()
+    core_api.add("warm-a")
+
+    async def main():
+        pool = make_pool(core_api, low=2, high=4)
+        # 低于低水位：补充到高水位，正在创建的 pod 也计入池的大小
+        await pool.refill()
+        assert len(core_api.created) == 3
+        await pool.refill()
+        assert len(core_api.created) == 3
+        # 介于两个水位之间：不创建也不删除
+        for name in core_api.created:
+            pool.router.apply("ADDED", core_api.add(name))
+        pool.router.apply("DELETED", core_api.pods["warm-a"])
+        await pool.refill()
+        assert len(core_api.created) == 3 and core_api.deleted == []
+        # 高于高水位：删除多出来的空闲 pod
+        for name in ("warm-x", "warm-y"):
+            pool.router.apply("ADDED", core_api.add(name))
+        await pool.refill()
+        return pool
+
+    pool = asyncio.run(main())
+    assert len(core_api.deleted) == 1
+    assert len(pool.router.warm) == 4
+    assert pool.stats["created"] == 3 and pool.stats["deleted"] == 1
+
+
+def test_refill_waits_for_capacity(monkeypatch):
+    async def can_schedule():
+        return False
+
+    monkeypatch.setattr(gateway, "can_schedule_secret_k8s", can_schedule)
+    core_api = FakeCoreApi()
+
+    async def main():
+        await make_pool(core_api).refill()
+
+    asyncio.run(main())
+    assert core_api.created == []